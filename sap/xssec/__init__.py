@@ -3,28 +3,46 @@ from typing import Dict
 
 from sap.xssec.security_context_ias import SecurityContextIAS
 from sap.xssec.security_context_xsuaa import SecurityContextXSUAA
+from sap.xssec.key_prefetch import prefetch
+from sap.xssec.token_cache import ValidatedTokenCache
+from sap.xssec.token_validator import TokenValidator
+from sap.xssec.security_context_async import create_security_context_xsuaa_async, \
+    create_security_context_ias_async
 
 
-def create_security_context_xsuaa(token, service_credentials: Dict[str, str]):
+def create_security_context_xsuaa(token, service_credentials: Dict[str, str], key_cache=None,
+                                  token_cache: ValidatedTokenCache = None):
     """
     Creates the XSUAA Security Context by validating the received access token.
 
     :param token: string containing the access_token
     :param service_credentials: dict containing the uaa/ias credentials
+    :param key_cache: key_cache_v2.VerificationKeyCache or KeyCache to use instead of
+        SecurityContextXSUAA.verificationKeyCache
+    :param token_cache: ValidatedTokenCache, which returns the security context of a token validated before
     :return: SecurityContextXSUAA object
     """
-    return SecurityContextXSUAA(token, service_credentials)
+    if token_cache is not None:
+        return token_cache.get_or_create("xsuaa", token, service_credentials,
+                                         lambda: SecurityContextXSUAA(token, service_credentials, key_cache=key_cache))
+    return SecurityContextXSUAA(token, service_credentials, key_cache=key_cache)
 
 
-def create_security_context_ias(token, service_credentials: Dict[str, str]):
+def create_security_context_ias(token, service_credentials: Dict[str, str], key_cache=None,
+                                token_cache: ValidatedTokenCache = None):
     """
     Creates the IAS Security Context by validating the received access token.
 
     :param token: string containing the access_token
     :param service_credentials: dict containing the uaa/ias credentials
+    :param key_cache: key_cache_v2.VerificationKeyCache to use instead of key_cache_v2.default_key_cache
+    :param token_cache: ValidatedTokenCache, which returns the security context of a token validated before
     :return: SecurityContextIAS object
     """
-    return SecurityContextIAS(token, service_credentials)
+    if token_cache is not None:
+        return token_cache.get_or_create("ias", token, service_credentials,
+                                         lambda: SecurityContextIAS(token, service_credentials, key_cache=key_cache))
+    return SecurityContextIAS(token, service_credentials, key_cache=key_cache)
 
 
 create_security_context = create_security_context_xsuaa
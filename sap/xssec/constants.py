@@ -10,9 +10,33 @@ GRANTTYPE_PASSWORD = 'password'
 GRANTTYPE_CLIENTCREDENTIAL = 'client_credentials'
 GRANTTYPE_SAML2BEARER = 'urn:ietf:params:oauth:grant-type:saml2-bearer'
 GRANTTYPE_JWT_BEARER = 'urn:ietf:params:oauth:grant-type:jwt-bearer'
-KEYCACHE_DEFAULT_CACHE_SIZE = 100
-KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES = 15
+KEYCACHE_DEFAULT_CACHE_SIZE = int(os.getenv("XSSEC_KEY_CACHE_SIZE", 100))
+KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES = int(os.getenv("XSSEC_KEY_CACHE_EXPIRATION_TIME_IN_MINUTES", 15))
+KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES = int(os.getenv("XSSEC_KEY_CACHE_GRACE_PERIOD_IN_MINUTES", 15))
+# bounds for the expiration time of a key set sent by the server with Cache-Control: max-age
+KEYCACHE_MIN_EXPIRATION_TIME_IN_SECONDS = int(os.getenv("XSSEC_KEY_CACHE_MIN_EXPIRATION_TIME_IN_SECONDS", 60))
+KEYCACHE_MAX_EXPIRATION_TIME_IN_SECONDS = int(os.getenv("XSSEC_KEY_CACHE_MAX_EXPIRATION_TIME_IN_SECONDS", 6 * 60 * 60))
+KEYCACHE_DEFAULT_MISSING_KEY_CACHE_SIZE = 1000
+KEYCACHE_DEFAULT_MISSING_KEY_EXPIRATION_TIME_IN_SECONDS = 60
+KEYCACHE_DEFAULT_MIN_REFRESH_INTERVAL_IN_SECONDS = 10
+KEYCACHE_OPENID_CONFIGURATION_CACHE_SIZE = 100
+KEYCACHE_OPENID_CONFIGURATION_EXPIRATION_TIME_IN_MINUTES = int(
+    os.getenv("XSSEC_OPENID_CONFIGURATION_EXPIRATION_TIME_IN_MINUTES", 12 * 60))
+KEYCACHE_FILE = os.getenv("XSSEC_KEY_CACHE_FILE")
+KEYCACHE_SHARED_DIRECTORY = os.getenv("XSSEC_SHARED_KEY_CACHE_DIR")
+# number of lock files of the shared key store, the key sets are distributed among them by hash
+KEYCACHE_SHARED_LOCK_COUNT = 64
+PREFETCH_DEFAULT_MAX_PARALLEL_REQUESTS = 10
+IAS_ISSUER_VALIDATION_CACHE_SIZE = 1000
+VALIDATED_TOKEN_CACHE_DEFAULT_SIZE = int(os.getenv("XSSEC_VALIDATED_TOKEN_CACHE_SIZE", 1000))
 HTTP_TIMEOUT_IN_SECONDS = int(os.getenv("XSSEC_HTTP_TIMEOUT_IN_SECONDS", 2))
+HTTP_POOL_MAX_CONNECTIONS = int(os.getenv("XSSEC_HTTP_POOL_MAX_CONNECTIONS", 100))
+HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("XSSEC_HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS", 20))
+HTTP_POOL_KEEPALIVE_EXPIRY_IN_SECONDS = 60
 HTTP_RETRY_NUMBER_RETRIES = 3
 HTTP_RETRY_ON_ERROR_CODE = [502, 503, 504]
-HTTP_RETRY_BACKOFF_FACTOR = 0.5  # retry after 0s, 1s, 2s
+HTTP_RETRY_BACKOFF_FACTOR = 0.5  # retry after a random delay of up to 0.5s, 1s, 2s
+HTTP_RETRY_DEADLINE_IN_SECONDS = int(os.getenv("XSSEC_HTTP_RETRY_DEADLINE_IN_SECONDS", 10))
+HTTP_CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.getenv("XSSEC_HTTP_CIRCUIT_BREAKER_FAILURE_THRESHOLD", 5))
+HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT_IN_SECONDS = int(os.getenv("XSSEC_HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT_IN_SECONDS", 30))
+HTTP_CIRCUIT_BREAKER_MAX_HOSTS = 1000
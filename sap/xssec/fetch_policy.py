@@ -0,0 +1,177 @@
+"""
+Shared policy for requests to the uaa/ias, e.g. to download verification keys or the openid configuration.
+Timeouts, connection errors and HTTP_RETRY_ON_ERROR_CODE are retried up to HTTP_RETRY_NUMBER_RETRIES times with
+exponential backoff and full jitter, so workers failing at the same moment do not retry at the same moment.
+No retry is started after HTTP_RETRY_DEADLINE_IN_SECONDS.
+After HTTP_CIRCUIT_BREAKER_FAILURE_THRESHOLD consecutive failed requests to a host, further requests to it fail
+immediately with CircuitOpenError for HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT_IN_SECONDS. Then a single request is let
+through, which closes the circuit again if it succeeds.
+"""
+import asyncio
+import logging
+import random
+import time
+from threading import Lock
+from typing import Dict, Optional
+
+import httpx
+from cachetools import LRUCache
+
+from sap.xssec import metrics
+from sap.xssec.constants import HTTP_RETRY_NUMBER_RETRIES, HTTP_RETRY_ON_ERROR_CODE, HTTP_RETRY_BACKOFF_FACTOR, \
+    HTTP_RETRY_DEADLINE_IN_SECONDS, HTTP_CIRCUIT_BREAKER_FAILURE_THRESHOLD, \
+    HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT_IN_SECONDS, HTTP_CIRCUIT_BREAKER_MAX_HOSTS
+from sap.xssec.http_client import get_http_client, get_async_http_client
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(httpx.TransportError):
+    """ Raised without sending a request while the circuit of the host is open """
+
+
+class CircuitBreaker(object):
+    """ Counts consecutive failed requests to a host and rejects requests while the circuit is open """
+
+    def __init__(self, failure_threshold: int = HTTP_CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout_in_seconds: float = HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT_IN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_in_seconds = reset_timeout_in_seconds
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+
+    def before_request(self, host: str):
+        """
+        :raises CircuitOpenError: if the circuit is open
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout_in_seconds:
+                raise CircuitOpenError("Requests to {} are suspended after repeated failures".format(host))
+            # half open: let this request through, the others keep failing fast until it has finished
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+
+_circuit_breakers = LRUCache(maxsize=HTTP_CIRCUIT_BREAKER_MAX_HOSTS)  # host -> CircuitBreaker
+_circuit_breakers_lock = Lock()
+
+
+def get_circuit_breaker(host: str) -> CircuitBreaker:
+    with _circuit_breakers_lock:
+        circuit_breaker = _circuit_breakers.get(host)
+        if circuit_breaker is None:
+            circuit_breaker = _circuit_breakers[host] = CircuitBreaker()
+        return circuit_breaker
+
+
+def reset_circuit_breakers():
+    """ closes the circuits of all hosts """
+    with _circuit_breakers_lock:
+        _circuit_breakers.clear()
+
+
+def get_with_retry(url: str, timeout: float, metrics_prefix: str, headers: Dict[str, str] = None,
+                   allow_not_modified: bool = False) -> httpx.Response:
+    """
+    GET url with the shared http client according to the fetch policy.
+    Retries are counted in the metric <metrics_prefix>.retries, rejected requests in <metrics_prefix>.circuit_open.
+
+    :param headers: request headers, only passed to the client if given
+    :param allow_not_modified: return 304 responses, e.g. to a conditional request, instead of raising
+    :raises httpx.HTTPError: if the request still fails after the retries
+    """
+    host = httpx.URL(url).host
+    circuit_breaker = get_circuit_breaker(host)
+    kwargs = {"headers": headers} if headers else {}
+    deadline = time.monotonic() + HTTP_RETRY_DEADLINE_IN_SECONDS
+    retries = 0
+    while True:
+        _before_request(circuit_breaker, host, metrics_prefix)
+        try:
+            return _check_response(get_http_client().get(url, timeout=timeout, **kwargs), circuit_breaker,
+                                   allow_not_modified)
+        except httpx.HTTPError as e:
+            delay = _record_error(e, circuit_breaker, retries, deadline, url, metrics_prefix)
+        retries += 1
+        time.sleep(delay)
+
+
+async def get_with_retry_async(url: str, timeout: float, metrics_prefix: str, headers: Dict[str, str] = None,
+                               allow_not_modified: bool = False) -> httpx.Response:
+    """
+    like get_with_retry, but with the shared async http client without blocking the event loop
+    """
+    host = httpx.URL(url).host
+    circuit_breaker = get_circuit_breaker(host)
+    kwargs = {"headers": headers} if headers else {}
+    deadline = time.monotonic() + HTTP_RETRY_DEADLINE_IN_SECONDS
+    retries = 0
+    while True:
+        _before_request(circuit_breaker, host, metrics_prefix)
+        try:
+            return _check_response(await get_async_http_client().get(url, timeout=timeout, **kwargs),
+                                   circuit_breaker, allow_not_modified)
+        except httpx.HTTPError as e:
+            delay = _record_error(e, circuit_breaker, retries, deadline, url, metrics_prefix)
+        retries += 1
+        await asyncio.sleep(delay)
+
+
+def _before_request(circuit_breaker: CircuitBreaker, host: str, metrics_prefix: str):
+    try:
+        circuit_breaker.before_request(host)
+    except CircuitOpenError:
+        metrics.increment(metrics_prefix + ".circuit_open")
+        raise
+
+
+def _check_response(response: httpx.Response, circuit_breaker: CircuitBreaker,
+                    allow_not_modified: bool) -> httpx.Response:
+    if not (allow_not_modified and response.status_code == 304):
+        response.raise_for_status()
+    circuit_breaker.record_success()
+    return response
+
+
+def _is_transient(e: httpx.HTTPError) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in HTTP_RETRY_ON_ERROR_CODE
+    return isinstance(e, httpx.TransportError)
+
+
+def _record_error(e: httpx.HTTPError, circuit_breaker: CircuitBreaker, retries: int, deadline: float, url: str,
+                  metrics_prefix: str) -> float:
+    """
+    :return: the delay before the next attempt
+    :raises httpx.HTTPError: e, if the request is not retried
+    """
+    if isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500 or _is_transient(e):
+        circuit_breaker.record_failure()
+    else:
+        # the host is reachable, e.g. a 404 of an unknown tenant
+        circuit_breaker.record_success()
+    if not _is_transient(e) or retries >= HTTP_RETRY_NUMBER_RETRIES:
+        raise e
+    delay = random.uniform(0, 2 ** retries * HTTP_RETRY_BACKOFF_FACTOR)
+    if time.monotonic() + delay >= deadline:
+        raise e
+    metrics.increment(metrics_prefix + ".retries")
+    logger.warning("Error while requesting %s: %s. Start retry attempt %d", url, e, retries + 1)
+    return delay
@@ -0,0 +1,124 @@
+"""
+Shared http client for requests to the uaa/ias, e.g. to download verification keys.
+The client keeps connections alive and reuses them for subsequent requests to the same host,
+so most requests do not need a new TCP connection and TLS handshake.
+For asynchronous requests there is one shared async http client per event loop.
+"""
+import asyncio
+import atexit
+import os
+import weakref
+from threading import Lock
+from typing import Any, Dict, Optional
+
+import httpx
+
+from sap.xssec.constants import HTTP_TIMEOUT_IN_SECONDS, HTTP_POOL_MAX_CONNECTIONS, \
+    HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS, HTTP_POOL_KEEPALIVE_EXPIRY_IN_SECONDS
+
+_lock = Lock()
+_client = None
+_client_pid = None
+_client_kwargs: Dict[str, Any] = {}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> async client
+
+
+def _default_client_kwargs() -> Dict[str, Any]:
+    return {
+        "timeout": HTTP_TIMEOUT_IN_SECONDS,
+        "limits": httpx.Limits(max_connections=HTTP_POOL_MAX_CONNECTIONS,
+                               max_keepalive_connections=HTTP_POOL_MAX_KEEPALIVE_CONNECTIONS,
+                               keepalive_expiry=HTTP_POOL_KEEPALIVE_EXPIRY_IN_SECONDS),
+    }
+
+
+def get_http_client() -> httpx.Client:
+    """
+    :return: the shared http client, which is created on first use
+    """
+    global _client, _client_pid
+    client = _client
+    if client is not None and _client_pid == os.getpid():
+        return client
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            # connections of a client created before a fork must not be used by the child process
+            _client = httpx.Client(**{**_default_client_kwargs(), **_client_kwargs})
+            _client_pid = os.getpid()
+        return _client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    :return: the shared async http client of the running event loop, which is created on first use
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None or client.is_closed:
+        client = _async_clients[loop] = httpx.AsyncClient(**{**_default_client_kwargs(), **_client_kwargs})
+    return client
+
+
+async def close_async_http_client():
+    """
+    Closes the shared async http client of the running event loop, e.g. on shutdown of an asgi application.
+    """
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def configure_http_client(**kwargs):
+    """
+    Configures the shared http clients, e.g. configure_http_client(limits=httpx.Limits(max_connections=50)).
+    The keyword arguments are passed to httpx.Client and httpx.AsyncClient and override the defaults.
+    A client which has already been created is closed and replaced on next use.
+    Async clients which have already been created are used until they are closed with close_async_http_client.
+    """
+    global _client_kwargs
+    with _lock:
+        _client_kwargs = dict(kwargs)
+    close_http_client()
+
+
+def close_http_client():
+    """
+    Closes the shared http client and its connections. A new client is created on next use.
+    """
+    global _client, _client_pid
+    with _lock:
+        client, _client, _client_pid = _client, None, None
+    if client is not None:
+        client.close()
+
+
+def get_max_age(response: httpx.Response) -> Optional[int]:
+    """
+    :return: the max-age of the Cache-Control header in seconds, 0 for no-cache/no-store or None if not given
+    """
+    for directive in response.headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        name = name.lower()
+        if name in ("no-cache", "no-store"):
+            return 0
+        if name == "max-age":
+            try:
+                return max(int(value.strip('"')), 0)
+            except ValueError:
+                return None
+    return None
+
+
+def get_conditional_headers(etag: Optional[str], last_modified: Optional[str]) -> Dict[str, str]:
+    """
+    :return: headers to revalidate a cached response, which is answered with 304 if it has not changed
+    """
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    return headers
+
+
+atexit.register(close_http_client)
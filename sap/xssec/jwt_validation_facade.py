@@ -1,5 +1,12 @@
+import binascii
+import time
+from typing import Any, Dict, NamedTuple, Union
+
 import jwt
 import json
+from jwt.utils import base64url_decode
+
+from sap.xssec.key_tools import pem_to_public_key
 
 ALGORITHMS = ['RS256', 'RS384', 'RS512',
               'PS256', 'PS384', 'PS512',
@@ -9,50 +16,89 @@ OPTIONS = {
 }
 
 
+class ParsedToken(NamedTuple):
+    """ the unverified header and payload of a token, which are decoded once and shared by all validation steps """
+    token: Union[str, bytes]
+    header: Dict[str, Any]
+    payload: Dict[str, Any]
+
+
 class JwtValidationFacade(object):
     """
     Hides if either sapjwt or pyjwt library is used for the validation.
+    The unverified header and payload of the last token are only decoded once and shared between
+    decode and get_unverified_header, e.g. for the jku, kid and zid. checkToken verifies the token with pyjwt.
     """
     def __init__(self):
         self._pem = None
         self._payload = None
         self._error_desc = None
         self._error_code = 0
+        self._parsed_token = None
 
     def decode(self, token, verify=True):
         try:
+            if not verify:
+                return self.parse(token).payload
             return jwt.decode(token, options={"verify_signature": verify})
         except jwt.exceptions.DecodeError as e:
             raise DecodeError(e)
 
     def get_unverified_header(self, token):
         try:
-            return jwt.get_unverified_header(token)
+            return self.parse(token).header
         except jwt.exceptions.DecodeError as e:
             raise DecodeError(e)
 
+    def parse(self, token) -> ParsedToken:
+        """
+        :return: the decoded segments of the token, without verifying them
+        :raises jwt.exceptions.DecodeError: if the token is malformed
+        """
+        if self._parsed_token is None or self._parsed_token.token != token:
+            self._parsed_token = _parse(token)
+        return self._parsed_token
+
     def has_token_expired(self, token) -> bool:
         try:
-            jwt.decode(token, options={"verify_signature": False, 'verify_exp': True})
+            _validate_exp(self.parse(token).payload, time.time())
             return False
-        except jwt.exceptions.ExpiredSignatureError as e:
+        except jwt.exceptions.ExpiredSignatureError:
             return True
 
+    def is_token_valid_yet(self, token) -> bool:
+        """
+        :return: False if the token must not be accepted before its `nbf` claim
+        """
+        try:
+            _validate_nbf(self.parse(token).payload, time.time())
+            return True
+        except jwt.exceptions.ImmatureSignatureError:
+            return False
+
     def loadPEM(self, verification_key):
+        """
+        :param verification_key: pem encoded public key or a public key object of the cryptography library
+        """
+        if isinstance(verification_key, str):
+            verification_key = pem_to_public_key(verification_key)
         self._pem = verification_key
         return 0
 
-    def checkToken(self, token):
+    def checkToken(self, token, verify_time_claims=True):
+        """
+        :param verify_time_claims: False to only verify the signature, e.g. of archived tokens which have expired
+        """
+        options = OPTIONS if verify_time_claims else dict(OPTIONS, verify_exp=False, verify_nbf=False,
+                                                          verify_iat=False)
         try:
-            if "-----BEGIN PUBLIC KEY-----" in self._pem and '\n' not in self._pem:
-                self._pem = self._pem.replace('-----BEGIN PUBLIC KEY-----', '-----BEGIN PUBLIC KEY-----\n').replace('-----END PUBLIC KEY-----','\n-----END PUBLIC KEY-----')
-            self._payload = jwt.decode(token, self._pem, algorithms=ALGORITHMS, options=OPTIONS)
+            self._payload = jwt.decode(token, self._pem, algorithms=ALGORITHMS, options=options)
             self._error_desc = ''
             self._error_code = 0
         except (jwt.exceptions.InvalidTokenError, jwt.exceptions.InvalidKeyError) as e:
             self._error_desc = str(e)
             self._error_code = 1
-        except ValueError as e:
+        except (ValueError, TypeError) as e:
             self._error_desc = str(e)
             self._error_code = 1
 
@@ -66,5 +112,61 @@ class JwtValidationFacade(object):
         return self._payload
 
 
+def _parse(token) -> ParsedToken:
+    if isinstance(token, str):
+        token_bytes = token.encode("utf-8")
+    elif isinstance(token, bytes):
+        token_bytes = token
+    else:
+        raise jwt.exceptions.DecodeError("Invalid token type. Token must be a {0}".format(bytes))
+    try:
+        signing_input, _signature_segment = token_bytes.rsplit(b".", 1)
+        header_segment, payload_segment = signing_input.split(b".", 1)
+    except ValueError as e:
+        raise jwt.exceptions.DecodeError("Not enough segments") from e
+    header = _decode_segment(header_segment, "header")
+    if "kid" in header and not isinstance(header["kid"], str):
+        # the kid is used to look up the key in the key caches
+        raise jwt.exceptions.DecodeError("Key ID header parameter must be a string")
+    payload = _decode_segment(payload_segment, "payload")
+    return ParsedToken(token, header, payload)
+
+
+def _decode_segment(segment: bytes, name: str) -> Dict[str, Any]:
+    try:
+        data = base64url_decode(segment)
+    except (TypeError, binascii.Error) as e:
+        raise jwt.exceptions.DecodeError("Invalid {0} padding".format(name)) from e
+    try:
+        decoded = json.loads(data)
+    except ValueError as e:
+        raise jwt.exceptions.DecodeError("Invalid {0} string: {1}".format(name, e)) from e
+    if not isinstance(decoded, dict):
+        raise jwt.exceptions.DecodeError("Invalid {0} string: must be a json object".format(name))
+    return decoded
+
+
+def _validate_nbf(payload: Dict[str, Any], now: float):
+    if "nbf" not in payload:
+        return
+    try:
+        nbf = int(payload["nbf"])
+    except (ValueError, TypeError, OverflowError):
+        raise jwt.exceptions.DecodeError("Not Before claim (nbf) must be an integer.") from None
+    if nbf > now:
+        raise jwt.exceptions.ImmatureSignatureError("The token is not yet valid (nbf)")
+
+
+def _validate_exp(payload: Dict[str, Any], now: float):
+    if "exp" not in payload:
+        return
+    try:
+        exp = int(payload["exp"])
+    except (ValueError, TypeError, OverflowError):
+        raise jwt.exceptions.DecodeError("Expiration Time claim (exp) must be an integer.") from None
+    if exp <= now:
+        raise jwt.exceptions.ExpiredSignatureError("Signature has expired")
+
+
 class DecodeError(Exception):
     pass
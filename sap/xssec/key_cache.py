@@ -1,98 +1,40 @@
-import logging
-import time
-from httpx import HTTPError, HTTPStatusError, TimeoutException
-
-import httpx
-from collections import OrderedDict
-from threading import Lock
-
 from sap.xssec.constants import *
+from sap.xssec.key_cache_v2 import VerificationKeyCache
 
-lock = Lock()
-
-
-class CacheEntry(object):
-    def __init__(self, key, insert_timestamp):
-        self.key = key
-        self.insert_timestamp = insert_timestamp
 
-    def is_valid(self):
-        return self.insert_timestamp + KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES * 60 >= time.time()
-
-
-class KeyCache(object):
+class KeyCache(VerificationKeyCache):
     """
-    Thread safe cache for verification keys. Each verification key is identified by its jku and pid.
-    There are a maximum of KEYCACHE_DEFAULT_CACHE_SIZE keys in the cache and
-    keys are invalid if KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES have passed since the key
-    has been in inserted in the cache.
+    Thread safe cache for verification keys, which returns the keys of the UAA as pem strings.
+    It is a key_cache_v2.VerificationKeyCache with its own section of the cache file and the shared key store, and
+    has the same limits, e.g. a maximum of max_size (default: KEYCACHE_DEFAULT_CACHE_SIZE) key sets which are
+    invalid if expiration_time_in_minutes (default: KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES) have
+    passed since they have been downloaded, unless the UAA sends Cache-Control: max-age.
+    A KeyCache can be passed as key_cache to SecurityContextXSUAA instead of the default cache, which is a
+    key_cache_v2.VerificationKeyCache shared with SecurityContextIAS.
+
+    If a cache file is given (default: environment variable XSSEC_KEY_CACHE_FILE), the cached keys are
+    stored in this file and restored from it on first use.
+    If a shared key store directory is given (default: environment variable XSSEC_SHARED_KEY_CACHE_DIR), the keys
+    are shared with all other processes using this directory, so they are downloaded only once per host.
     """
 
-    def __init__(self):
-        self._cache = OrderedDict()
-        self._logger = logging.getLogger(__name__)
-
-    def load_key(self, jku, kid):
-        """
-        Either returns key from cache or retrieves it from the UAA.
-        :param jku: jku of token
-        :param kid: kid of token
-        :return: verification key
-        """
-        with lock:
-            self._logger.debug("Loading verification key for 'jku'={} and kid={}".format(jku, kid))
-            cache_key = self._create_cache_key(jku, kid)
-
-            if cache_key in self._cache:
-                if self._cache[cache_key].is_valid():
-                    self._logger.debug("Using cached verification key")
-                    return self._cache[cache_key].key
-                else:
-                    self._logger.debug("Verification key expired. Retrieving key from uua.")
-                    self._cache.pop(cache_key)
+    CACHE_FILE_SECTION = "xsuaa"
 
-            self._logger.debug("Key not cached. Retrieving key from uua.")
+    def __init__(self, cache_file=KEYCACHE_FILE, shared_key_store_directory=KEYCACHE_SHARED_DIRECTORY,
+                 max_size=KEYCACHE_DEFAULT_CACHE_SIZE,
+                 expiration_time_in_minutes=KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES,
+                 grace_period_in_minutes=KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES,
+                 http_timeout_in_seconds=HTTP_TIMEOUT_IN_SECONDS):
+        super(KeyCache, self).__init__(max_size=max_size, expiration_time_in_minutes=expiration_time_in_minutes,
+                                       grace_period_in_minutes=grace_period_in_minutes,
+                                       http_timeout_in_seconds=http_timeout_in_seconds, cache_file=cache_file,
+                                       shared_key_store_directory=shared_key_store_directory)
 
-            key = self._retrieve_key(jku, kid)
-            self._cache[cache_key] = CacheEntry(key, time.time())
-
-            # remove oldest key if cache is full
-            if len(self._cache) > KEYCACHE_DEFAULT_CACHE_SIZE:
-                self._cache.popitem(last=False)
-
-            return key
-
-    def _retrieve_key(self, jku, kid):
-        try:
-            r = self._request_key_with_retry(jku)
-            r_json = r.json()
-
-            for key in r_json.get('keys', {}):
-                if key.get('kid', "") == kid:
-                    return key['value']
-
-            raise ValueError("Could not find key with kid {}".format(kid))
-        except HTTPError as e:
-            self._logger.error("Error while trying to get key from uaa. {}".format(e))
-            raise
-
-    def _request_key_with_retry(self, jku):
-        i = 0
-        while True:
-            try:
-                r = httpx.get(jku, timeout=HTTP_TIMEOUT_IN_SECONDS)
-                r.raise_for_status()
-                return r
-            except (HTTPStatusError, TimeoutException) as e:
-                if i < HTTP_RETRY_NUMBER_RETRIES and (isinstance(e, TimeoutException) or
-                                                      e.response.status_code in HTTP_RETRY_ON_ERROR_CODE):
-                    i = i + 1
-                    self._logger.warning("Warning: Error while trying to get key from uaa. {}. Start retry attempt {}".
-                                         format(e, str(i)))
-                    time.sleep(2**(i-1) * HTTP_RETRY_BACKOFF_FACTOR)
-                else:
-                    raise
+    @staticmethod
+    def _parse_token_keys(token_keys):
+        # the pem strings of the UAA are returned as they are
+        return {key.get('kid', ""): key['value'] for key in token_keys.get('keys', {}) if 'value' in key}
 
     @staticmethod
-    def _create_cache_key(jku, kid):
-        return jku + kid
+    def _parse_stored_keys(keys):
+        return dict(keys)
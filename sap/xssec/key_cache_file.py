@@ -0,0 +1,99 @@
+"""
+File backed snapshot of cached verification keys.
+The key sets of the key caches are written to a json file after each download and read again on first use,
+so a restarted application can validate tokens without requesting the keys again while they are still valid.
+The file is replaced atomically, so concurrent readers never see a partially written snapshot.
+The file is neither read nor written unless it and its directory are owned by the current user and not writable
+by other users.
+"""
+import json
+import logging
+import os
+import tempfile
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Tuple
+
+from sap.xssec.shared_key_store import check_is_private
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+class KeyCacheFile(object):
+    """
+    Stores the key sets of one or more key caches, each in its own section of the file.
+    Each key set is stored with its cache key, the time it has been downloaded and its keys as pem strings.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self.enabled = True
+        try:
+            check_is_private(os.path.dirname(os.path.abspath(path)), "Key cache file directory")
+            if os.path.exists(path):
+                check_is_private(path, "Key cache file")
+        except (OSError, ValueError) as e:
+            logger.warning("Key cache file is disabled: %s", e)
+            self.enabled = False
+
+    def load(self, section: str) -> List[Tuple[Any, float, Dict[str, str]]]:
+        """
+        :return: list of (cache key, fetch timestamp, keys by kid) of the given section
+        """
+        if not self.enabled:
+            return []
+        snapshot = self._read()
+        entries = []
+        for item in snapshot.get(section, []):
+            try:
+                cache_key = item["cache_key"]
+                if isinstance(cache_key, list):
+                    cache_key = tuple(cache_key)
+                entries.append((cache_key, float(item["fetch_timestamp"]), dict(item["keys"])))
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning("Ignoring invalid entry in key cache file %s: %s", self.path, e)
+        return entries
+
+    def save(self, section: str, entries: Iterable[Tuple[Any, float, Dict[str, str]]]):
+        """
+        replaces the given section with the entries, other sections are kept
+        """
+        if not self.enabled:
+            return
+        items = [{"cache_key": cache_key, "fetch_timestamp": fetch_timestamp, "keys": keys}
+                 for cache_key, fetch_timestamp, keys in entries]
+        with self._lock:
+            snapshot = self._read()
+            snapshot["version"] = SNAPSHOT_VERSION
+            snapshot[section] = items
+            self._write(snapshot)
+
+    def _read(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning("Could not read key cache file %s: %s", self.path, e)
+            return {}
+        if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+            logger.warning("Ignoring key cache file %s with unknown format", self.path)
+            return {}
+        return snapshot
+
+    def _write(self, snapshot: Dict[str, Any]):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".xssec-keys-", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Could not write key cache file %s: %s", self.path, e)
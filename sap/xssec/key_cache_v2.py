@@ -1,88 +1,768 @@
 """
 Thread safe cache for verification keys.
-For XSUAA, each verification key is identified by its jku and kid.
-For IAS, each verification key is identified by issuer_url, zone_id and kid.
-There are a maximum of KEYCACHE_DEFAULT_CACHE_SIZE keys in the cache and
-keys are invalid if KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES have passed since the key
-has been in inserted in the cache.
+All keys of a downloaded key set are cached together and looked up by their kid.
+Both XSUAA and IAS key sets are kept in the same cache and share its limits, locking, metrics and retries.
+For XSUAA, each key set is identified by its jku.
+For IAS, each key set is identified by issuer_url, app_tid, azp and client_id.
+By default, there are a maximum of KEYCACHE_DEFAULT_CACHE_SIZE key sets in the cache, the least recently used
+key set is evicted first, and key sets are invalid if KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES
+have passed since they have been in inserted in the cache. An expired key set is still used for another
+KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES while it is refreshed in the background.
+Caches with other limits can be created with VerificationKeyCache, the module level functions use default_key_cache.
+Keys that could not be found are remembered for KEYCACHE_DEFAULT_MISSING_KEY_EXPIRATION_TIME_IN_SECONDS
+and a key set is downloaded at most once per KEYCACHE_DEFAULT_MIN_REFRESH_INTERVAL_IN_SECONDS.
+If the server sends Cache-Control: max-age, it is used as expiration time within
+KEYCACHE_MIN_EXPIRATION_TIME_IN_SECONDS and KEYCACHE_MAX_EXPIRATION_TIME_IN_SECONDS. Expired key sets are
+revalidated with If-None-Match/If-Modified-Since, so unchanged keys are neither downloaded nor parsed again.
+Keys and openid configurations are requested according to the retry and circuit breaker policy of fetch_policy.
+The jwks_uri of the IAS openid configuration is cached per issuer for
+KEYCACHE_OPENID_CONFIGURATION_EXPIRATION_TIME_IN_MINUTES, so a missing key set costs a single request.
+If the environment variable XSSEC_KEY_CACHE_FILE is set, the cached key sets are stored in this file
+and restored from it on first use.
+If the environment variable XSSEC_SHARED_KEY_CACHE_DIR is set, the key sets are shared with all other processes
+using this directory, so they are downloaded only once per host.
 
-Improvement: use dedicated lock for each cache entry key
+Concurrent loads of the same key set share one download, whichever kid they are looking for,
+threads waiting for it get its keys or its error.
 """
-from collections import defaultdict
-from functools import _make_key # noqa
-from threading import Lock
-from typing import List, Dict, Any
+import asyncio
+import logging
+import time
+from contextlib import contextmanager
+from threading import Lock, Thread
+from typing import List, Dict, Any, Awaitable, Callable, Optional, Tuple
 
-import httpx
-from cachetools import cached, TTLCache
+from cachetools import TTLCache
+from httpx import HTTPStatusError, Response
 
+from sap.xssec import metrics
 from sap.xssec.constants import HTTP_TIMEOUT_IN_SECONDS, KEYCACHE_DEFAULT_CACHE_SIZE, \
-    KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES
-from sap.xssec.key_tools import jwk_to_pem
+    KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES, KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES, \
+    KEYCACHE_DEFAULT_MISSING_KEY_CACHE_SIZE, KEYCACHE_DEFAULT_MISSING_KEY_EXPIRATION_TIME_IN_SECONDS, \
+    KEYCACHE_DEFAULT_MIN_REFRESH_INTERVAL_IN_SECONDS, KEYCACHE_FILE, KEYCACHE_SHARED_DIRECTORY, \
+    KEYCACHE_OPENID_CONFIGURATION_CACHE_SIZE, KEYCACHE_OPENID_CONFIGURATION_EXPIRATION_TIME_IN_MINUTES, \
+    KEYCACHE_MIN_EXPIRATION_TIME_IN_SECONDS, KEYCACHE_MAX_EXPIRATION_TIME_IN_SECONDS
+from sap.xssec.fetch_policy import get_with_retry, get_with_retry_async
+from sap.xssec.http_client import get_max_age, get_conditional_headers
+from sap.xssec.key_cache_file import KeyCacheFile
+from sap.xssec.shared_key_store import LOCK_POLL_INTERVAL_IN_SECONDS, create_shared_key_store
+from sap.xssec.key_tools import jwk_to_public_key, pem_to_public_key, public_key_to_pem
 
+logger = logging.getLogger(__name__)
 
-def thread_safe_by_args(func):
-    lock_dict = defaultdict(Lock)
+IAS_METRICS_PREFIX = "key_cache.ias"
+XSUAA_METRICS_PREFIX = "key_cache.xsuaa"
+# responses which mean that a key set does not exist, other client errors like 408 or 429 are temporary
+NOT_FOUND_STATUS_CODES = (404, 410)
 
-    def _thread_safe_func(*args, **kwargs):
-        key = _make_key(args, kwargs, typed=False)
-        with lock_dict[key]:
-            return func(*args, **kwargs)
+# jwks_uri of the openid configuration per issuer, it hardly ever changes
+jwks_uri_cache = TTLCache(maxsize=KEYCACHE_OPENID_CONFIGURATION_CACHE_SIZE,
+                          ttl=KEYCACHE_OPENID_CONFIGURATION_EXPIRATION_TIME_IN_MINUTES * 60)
+_jwks_uri_cache_lock = Lock()
 
-    return _thread_safe_func
 
+class _LoadLock(object):
+    """ Lock for the loads of a single key set, removed from the lock table once no thread uses it anymore. """
+    def __init__(self):
+        self.lock = Lock()
+        self.waiters = 0
+        # number of finished loads and the error of the last one, shared with the threads waiting for it
+        self.calls = 0
+        self.error: Optional[Exception] = None
+
+
+class _LoadLockTable(object):
+    """ Keeps only the locks of loads in progress, so the table does not grow with the number of key sets. """
+    def __init__(self):
+        self._lock = Lock()
+        self.locks: Dict[Any, _LoadLock] = {}
+
+    def acquire(self, key) -> Tuple[_LoadLock, int]:
+        """
+        :return: the lock of key and the number of loads which had finished when it was requested
+        """
+        with self._lock:
+            load_lock = self.locks.get(key)
+            if load_lock is None:
+                load_lock = self.locks[key] = _LoadLock()
+            load_lock.waiters += 1
+            return load_lock, load_lock.calls
+
+    def release(self, key, load_lock: _LoadLock):
+        with self._lock:
+            load_lock.waiters -= 1
+            if load_lock.waiters == 0:
+                del self.locks[key]
+
+
+def _get_cached_verification_key_url_ias(issuer_url: str) -> str:
+    with _jwks_uri_cache_lock:
+        return jwks_uri_cache.get(issuer_url)
 
-def _fetch_verification_key_url_ias(issuer_url: str) -> str:
-    """
-    get the verification key url from issuer's well-known endpoint
-    """
-    resp = httpx.get(issuer_url + '/.well-known/openid-configuration', headers={'Accept': 'application/json'},
-                     timeout=HTTP_TIMEOUT_IN_SECONDS)
-    resp.raise_for_status()
-    return resp.json()["jwks_uri"]
 
+def _set_cached_verification_key_url_ias(issuer_url: str, verification_key_url: str):
+    with _jwks_uri_cache_lock:
+        jwks_uri_cache[issuer_url] = verification_key_url
 
-def _download_verification_key_ias(verification_key_url: str, app_tid: str, azp: str,
-                                   client_id: str) -> List[Dict[str, Any]]:
+
+def _raise_error_of_finished_load(load_lock: _LoadLock, calls: int):
+    if load_lock.calls != calls and load_lock.error is not None:
+        # the download we have been waiting for has failed, it is not repeated by each waiting thread
+        raise load_lock.error
+
+
+def _is_not_found(e: Exception) -> bool:
+    return isinstance(e, HTTPStatusError) and e.response.status_code in NOT_FOUND_STATUS_CODES
+
+
+def _invalidate_verification_key_url_ias(issuer_url: str, e: HTTPStatusError):
+    # the jwks_uri may have changed, request the openid configuration again on next download
+    if e.response.status_code == 404:
+        with _jwks_uri_cache_lock:
+            jwks_uri_cache.pop(issuer_url, None)
+
+
+def _fetch_verification_key_url_ias(issuer_url: str, timeout: float = HTTP_TIMEOUT_IN_SECONDS) -> str:
     """
-    get all the keys from verification key url
+    get the verification key url from issuer's well-known endpoint, unless it is cached
     """
+    verification_key_url = _get_cached_verification_key_url_ias(issuer_url)
+    if verification_key_url is None:
+        resp = get_with_retry(issuer_url + '/.well-known/openid-configuration', timeout, IAS_METRICS_PREFIX,
+                              {'Accept': 'application/json'})
+        verification_key_url = resp.json()["jwks_uri"]
+        _set_cached_verification_key_url_ias(issuer_url, verification_key_url)
+    return verification_key_url
+
+
+async def _fetch_verification_key_url_ias_async(issuer_url: str, timeout: float = HTTP_TIMEOUT_IN_SECONDS) -> str:
+    verification_key_url = _get_cached_verification_key_url_ias(issuer_url)
+    if verification_key_url is None:
+        resp = await get_with_retry_async(issuer_url + '/.well-known/openid-configuration', timeout,
+                                          IAS_METRICS_PREFIX, {'Accept': 'application/json'})
+        verification_key_url = resp.json()["jwks_uri"]
+        _set_cached_verification_key_url_ias(issuer_url, verification_key_url)
+    return verification_key_url
+
+
+def _verification_key_headers_ias(app_tid: str, azp: str, client_id: str) -> Dict[str, str]:
     headers = {
         'x-app_tid': app_tid,
         'x-azp': azp,
         'x-client_id': client_id,
         'Accept': 'application/json',
     }
-    headers = {k: v for k, v in headers.items() if v is not None}
-    resp = httpx.get(verification_key_url, headers=headers, timeout=HTTP_TIMEOUT_IN_SECONDS)
-    resp.raise_for_status()
-    return resp.json()["keys"]
+    return {k: v for k, v in headers.items() if v is not None}
+
+
+def _download_verification_key_ias(verification_key_url: str, app_tid: str, azp: str, client_id: str,
+                                   timeout: float = HTTP_TIMEOUT_IN_SECONDS,
+                                   conditional_headers: Dict[str, str] = None) -> Response:
+    """
+    get all the keys from verification key url, the response is 304 if the conditional headers still match
+    """
+    headers = {**_verification_key_headers_ias(app_tid, azp, client_id), **(conditional_headers or {})}
+    return get_with_retry(verification_key_url, timeout, IAS_METRICS_PREFIX, headers,
+                          allow_not_modified=bool(conditional_headers))
+
+
+async def _download_verification_key_ias_async(verification_key_url: str, app_tid: str, azp: str, client_id: str,
+                                               timeout: float = HTTP_TIMEOUT_IN_SECONDS,
+                                               conditional_headers: Dict[str, str] = None) -> Response:
+    headers = {**_verification_key_headers_ias(app_tid, azp, client_id), **(conditional_headers or {})}
+    return await get_with_retry_async(verification_key_url, timeout, IAS_METRICS_PREFIX, headers,
+                                      allow_not_modified=bool(conditional_headers))
+
+
+def _download_verification_key_xsuaa(jku: str, timeout: float = HTTP_TIMEOUT_IN_SECONDS,
+                                     conditional_headers: Dict[str, str] = None) -> Response:
+    """
+    get all the keys of the jku, the response is 304 if the conditional headers still match
+    """
+    return get_with_retry(jku, timeout, XSUAA_METRICS_PREFIX, conditional_headers,
+                          allow_not_modified=bool(conditional_headers))
+
+
+async def _download_verification_key_xsuaa_async(jku: str, timeout: float = HTTP_TIMEOUT_IN_SECONDS,
+                                                 conditional_headers: Dict[str, str] = None) -> Response:
+    return await get_with_retry_async(jku, timeout, XSUAA_METRICS_PREFIX, conditional_headers,
+                                      allow_not_modified=bool(conditional_headers))
+
+
+def _keys_to_pem(keys: Dict[str, Any]) -> Dict[str, str]:
+    return {kid: key if isinstance(key, str) else public_key_to_pem(key) for kid, key in keys.items()}
+
+
+def _keys_from_pem(keys: Dict[str, str]) -> Dict[str, Any]:
+    return {kid: pem_to_public_key(pem) for kid, pem in keys.items()}
+
+
+def _token_keys_to_dict(token_keys: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    the xsuaa token keys contain the pem encoded key as value in addition to the jwk parameters
+    """
+    keys = {}
+    for key in token_keys.get("keys", []):
+        try:
+            keys[key.get("kid", "")] = pem_to_public_key(key["value"]) if "value" in key else jwk_to_public_key(key)
+        except (KeyError, ValueError, TypeError) as e:
+            logger.debug("Ignoring unsupported verification key %s: %s", key.get("kid"), e)
+    return keys
+
+
+def _jwks_to_dict(verification_key_list: List[Dict[str, Any]]) -> Dict[str, Any]:
+    keys = {}
+    for jwk in verification_key_list:
+        try:
+            keys[jwk["kid"]] = jwk_to_public_key(jwk)
+        except (KeyError, ValueError, TypeError) as e:
+            logger.debug("Ignoring unsupported verification key %s: %s", jwk.get("kid"), e)
+    return keys
+
+
+class CacheEntry(object):
+    def __init__(self, keys: Dict[str, Any], fetch_timestamp: float,
+                 expiration_time_in_seconds: float = KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES * 60,
+                 grace_period_in_seconds: float = KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES * 60,
+                 etag: Optional[str] = None, last_modified: Optional[str] = None,
+                 pems: Optional[Dict[str, str]] = None):
+        self.keys = keys
+        self.fetch_timestamp = fetch_timestamp
+        self.expiration_time_in_seconds = expiration_time_in_seconds
+        self.grace_period_in_seconds = grace_period_in_seconds
+        # validators of the response, used to revalidate the key set with a conditional request
+        self.etag = etag
+        self.last_modified = last_modified
+        self._pems = pems
+        # the expiration is counted once, not on each read until the entry is refreshed
+        self.expiration_counted = False
+
+    def get_pems(self) -> Dict[str, str]:
+        """
+        the keys as pem strings for the cache file and the shared key store, serialized once per key set
+        """
+        if self._pems is None:
+            self._pems = _keys_to_pem(self.keys)
+        return self._pems
+
+    def is_stale(self) -> bool:
+        return self.fetch_timestamp + self.expiration_time_in_seconds < time.time()
+
+    def is_recently_fetched(self) -> bool:
+        return self.fetch_timestamp + KEYCACHE_DEFAULT_MIN_REFRESH_INTERVAL_IN_SECONDS > time.time()
+
+    def is_expired(self) -> bool:
+        return self.fetch_timestamp + self.expiration_time_in_seconds + self.grace_period_in_seconds < time.time()
+
+
+class VerificationKeyCache(object):
+    """
+    Cache for the verification key sets of XSUAA and IAS with its own size, lifetime and http timeout.
+    An instance can be passed as key_cache to SecurityContextXSUAA and SecurityContextIAS.
+    """
+
+    # section of the cache file and the shared key store
+    CACHE_FILE_SECTION = "verification_keys"
+
+    # the key sets are cached as public key objects, KeyCache overrides these to cache the pem strings instead
+    _parse_token_keys = staticmethod(_token_keys_to_dict)
+    _parse_stored_keys = staticmethod(_keys_from_pem)
+
+    def __init__(self, max_size: int = KEYCACHE_DEFAULT_CACHE_SIZE,
+                 expiration_time_in_minutes: float = KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES,
+                 grace_period_in_minutes: float = KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES,
+                 http_timeout_in_seconds: float = HTTP_TIMEOUT_IN_SECONDS,
+                 cache_file: Optional[str] = None, shared_key_store_directory: Optional[str] = None):
+        self.expiration_time_in_seconds = expiration_time_in_minutes * 60
+        self.grace_period_in_seconds = grace_period_in_minutes * 60
+        self.http_timeout_in_seconds = http_timeout_in_seconds
+        # entries are dropped once the grace period has passed as well, stale entries are refreshed before that.
+        # entries may expire earlier or later as requested by the server, see CacheEntry.is_expired.
+        # a full cache evicts the least recently used key set
+        self.key_cache = TTLCache(maxsize=max_size,
+                                  ttl=max(self.expiration_time_in_seconds, KEYCACHE_MAX_EXPIRATION_TIME_IN_SECONDS) +
+                                  self.grace_period_in_seconds)
+        # (key set, kid) pairs which could not be found recently
+        self.missing_key_cache = TTLCache(maxsize=KEYCACHE_DEFAULT_MISSING_KEY_CACHE_SIZE,
+                                          ttl=KEYCACHE_DEFAULT_MISSING_KEY_EXPIRATION_TIME_IN_SECONDS)
+        self.cache_file = KeyCacheFile(cache_file) if cache_file else None
+        self.shared_key_store = create_shared_key_store(shared_key_store_directory, self.key_cache.ttl)
+        self._lock = Lock()
+        self._refreshing = set()
+        # locks of the key sets being downloaded
+        self._load_locks = _LoadLockTable()
+        self._restored = self.cache_file is None
+        self._restore_lock = Lock()
+        self._async_loads = {}
+
+    def get_verification_key_ias(self, issuer_url: str, app_tid: str, azp: str, client_id: str, kid: str) -> Any:
+        """
+        get verification key for ias as public key object
+        """
+        return self._get_cached_or_load(self._load_verification_keys_ias, (issuer_url, app_tid, azp, client_id), kid)
+
+    def is_verification_key_ias_cached(self, issuer_url: str, app_tid: str, azp: str, client_id: str,
+                                       kid: str) -> bool:
+        """
+        :return: True if get_verification_key_ias returns without downloading keys
+        """
+        return self._is_cached((issuer_url, app_tid, azp, client_id), kid)
+
+    async def get_verification_key_ias_async(self, issuer_url: str, app_tid: str, azp: str, client_id: str,
+                                             kid: str) -> Any:
+        """
+        get verification key for ias, missing keys are downloaded without blocking the event loop
+        """
+        cache_key = (issuer_url, app_tid, azp, client_id)
+        await self._restore_from_file_async()
+        if not self._is_cached(cache_key, kid):
+            async def download(cached: Optional[CacheEntry]) -> CacheEntry:
+                with metrics.fetching(IAS_METRICS_PREFIX):
+                    verification_key_url: str = await _fetch_verification_key_url_ias_async(
+                        issuer_url, self.http_timeout_in_seconds)
+                    try:
+                        resp = await _download_verification_key_ias_async(
+                            verification_key_url, app_tid, azp, client_id, self.http_timeout_in_seconds,
+                            self._get_conditional_headers(cached))
+                    except HTTPStatusError as e:
+                        _invalidate_verification_key_url_ias(issuer_url, e)
+                        raise
+                    return self._create_entry_from_response(resp, cached)
+
+            await self._load_keys_async(cache_key, kid, download)
+        return self.get_verification_key_ias(issuer_url, app_tid, azp, client_id, kid)
+
+    def prefetch_verification_keys_ias(self, issuer_url: str, app_tid: str, azp: str, client_id: str):
+        """
+        download the key set for ias unless it is cached, e.g. on startup
+        """
+        self._prefetch((issuer_url, app_tid, azp, client_id),
+                       lambda cached: self._download_verification_keys_ias(issuer_url, app_tid, azp, client_id,
+                                                                           cached))
+
+    def prefetch_verification_key_url_ias(self, service_credentials: Dict[str, str]) -> str:
+        """
+        request the openid configuration of the ias instance bound by service_credentials, e.g. on startup,
+        so the first missing key set of its issuer costs a single request
+        """
+        return _fetch_verification_key_url_ias(service_credentials["url"], self.http_timeout_in_seconds)
+
+    def get_verification_key_xsuaa(self, jku: str, kid: str) -> Any:
+        """
+        get verification key for xsuaa as public key object
+        """
+        return self._get_cached_or_load(self._load_verification_keys_xsuaa, (jku,), kid)
+
+    def is_verification_key_xsuaa_cached(self, jku: str, kid: str) -> bool:
+        """
+        :return: True if get_verification_key_xsuaa returns without downloading keys
+        """
+        return self._is_cached((jku,), kid)
+
+    async def get_verification_key_xsuaa_async(self, jku: str, kid: str) -> Any:
+        """
+        get verification key for xsuaa, missing keys are downloaded without blocking the event loop
+        """
+        cache_key = (jku,)
+        await self._restore_from_file_async()
+        if not self._is_cached(cache_key, kid):
+            async def download(cached: Optional[CacheEntry]) -> CacheEntry:
+                with metrics.fetching(XSUAA_METRICS_PREFIX):
+                    resp = await _download_verification_key_xsuaa_async(jku, self.http_timeout_in_seconds,
+                                                                         self._get_conditional_headers(cached))
+                    return self._create_entry_from_response(resp, cached, self._parse_token_keys)
 
+            await self._load_keys_async(cache_key, kid, download)
+        return self.get_verification_key_xsuaa(jku, kid)
 
-key_cache = TTLCache(
-    maxsize=KEYCACHE_DEFAULT_CACHE_SIZE, ttl=KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES * 60)
+    def prefetch_verification_keys_xsuaa(self, jku: str):
+        """
+        download the key set for xsuaa unless it is cached, e.g. on startup
+        """
+        self._prefetch((jku,), lambda cached: self._download_verification_keys_xsuaa(jku, cached))
+
+    # the interface of KeyCache, so an instance can replace it for SecurityContextXSUAA
+    load_key = get_verification_key_xsuaa
+    is_cached = is_verification_key_xsuaa_cached
+    load_key_async = get_verification_key_xsuaa_async
+    prefetch_keys = prefetch_verification_keys_xsuaa
+
+    def _load_verification_keys_ias(self, issuer_url: str, app_tid: str, azp: str, client_id: str,
+                                    kid: str) -> CacheEntry:
+        return self._load_keys((issuer_url, app_tid, azp, client_id), kid,
+                               lambda cached: self._download_verification_keys_ias(
+                                   issuer_url, app_tid, azp, client_id, cached))
+
+    def _download_verification_keys_ias(self, issuer_url: str, app_tid: str, azp: str, client_id: str,
+                                        cached: Optional[CacheEntry] = None) -> CacheEntry:
+        with metrics.fetching(IAS_METRICS_PREFIX):
+            verification_key_url: str = _fetch_verification_key_url_ias(issuer_url, self.http_timeout_in_seconds)
+            try:
+                resp = _download_verification_key_ias(verification_key_url, app_tid, azp, client_id,
+                                                      self.http_timeout_in_seconds,
+                                                      self._get_conditional_headers(cached))
+            except HTTPStatusError as e:
+                _invalidate_verification_key_url_ias(issuer_url, e)
+                raise
+            return self._create_entry_from_response(resp, cached)
+
+    def _load_verification_keys_xsuaa(self, jku: str, kid: str) -> CacheEntry:
+        return self._load_keys((jku,), kid, lambda cached: self._download_verification_keys_xsuaa(jku, cached))
+
+    def _download_verification_keys_xsuaa(self, jku: str, cached: Optional[CacheEntry] = None) -> CacheEntry:
+        with metrics.fetching(XSUAA_METRICS_PREFIX):
+            resp = _download_verification_key_xsuaa(jku, self.http_timeout_in_seconds,
+                                                    self._get_conditional_headers(cached))
+            return self._create_entry_from_response(resp, cached, self._parse_token_keys)
+
+    def _prefetch(self, cache_key: Tuple, download: Callable[[Optional[CacheEntry]], CacheEntry]):
+        if not self._restored:
+            self._restore_from_file()
+        entry = self._get_cache_entry(cache_key, include_expired=True)
+        if entry is None or entry.is_stale():
+            self._put_cache_entry(cache_key, self._download_shared(cache_key, None, download, entry))
+
+    def _create_entry_from_response(self, resp: Response, cached: Optional[CacheEntry],
+                                    parse_keys: Callable[[Dict[str, Any]], Dict[str, Any]] = None) -> CacheEntry:
+        pems = None
+        if resp.status_code == 304 and cached is not None:
+            logger.debug("Verification keys not modified")
+            keys = cached.keys
+            pems = cached._pems  # pylint: disable=protected-access
+            etag = resp.headers.get("ETag") or cached.etag
+            last_modified = resp.headers.get("Last-Modified") or cached.last_modified
+        else:
+            keys = parse_keys(resp.json()) if parse_keys else _jwks_to_dict(resp.json()["keys"])
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+        max_age = get_max_age(resp)
+        expiration_time_in_seconds = self.expiration_time_in_seconds if max_age is None else \
+            min(max(max_age, KEYCACHE_MIN_EXPIRATION_TIME_IN_SECONDS), KEYCACHE_MAX_EXPIRATION_TIME_IN_SECONDS)
+        return CacheEntry(keys, time.time(), expiration_time_in_seconds, self.grace_period_in_seconds,
+                          etag, last_modified, pems)
+
+    @staticmethod
+    def _metrics_prefix(cache_key: Tuple) -> str:
+        # xsuaa key sets are identified by the jku only
+        return XSUAA_METRICS_PREFIX if len(cache_key) == 1 else IAS_METRICS_PREFIX
+
+    @staticmethod
+    def _get_conditional_headers(cached: Optional[CacheEntry]) -> Dict[str, str]:
+        return get_conditional_headers(cached.etag, cached.last_modified) if cached is not None else {}
+
+    def _create_entry(self, keys: Dict[str, Any], fetch_timestamp: float,
+                      pems: Optional[Dict[str, str]] = None) -> CacheEntry:
+        return CacheEntry(keys, fetch_timestamp, self.expiration_time_in_seconds, self.grace_period_in_seconds,
+                          pems=pems)
+
+    def _get_cache_entry(self, cache_key: Tuple, include_expired: bool = False) -> CacheEntry:
+        """
+        :param include_expired: return expired entries as well, e.g. to revalidate them with a conditional request
+        """
+        with self._lock:
+            entry = self.key_cache.get(cache_key)
+        if entry is not None and not include_expired and entry.is_expired():
+            self._count_expiration(cache_key, entry)
+            return None
+        return entry
+
+    def _count_expiration(self, cache_key: Tuple, entry: CacheEntry):
+        with self._lock:
+            if entry.expiration_counted:
+                return
+            entry.expiration_counted = True
+        metrics.increment(self._metrics_prefix(cache_key) + ".expirations")
+
+    def _set_cache_entry(self, cache_key: Tuple, keys: Dict[str, Any], fetch_timestamp: float = None) -> CacheEntry:
+        return self._put_cache_entry(
+            cache_key, self._create_entry(keys, time.time() if fetch_timestamp is None else fetch_timestamp))
+
+    def _put_cache_entry(self, cache_key: Tuple, entry: CacheEntry) -> CacheEntry:
+        self._insert_cache_entry(cache_key, entry)
+        self._save_to_file()
+        return entry
+
+    def _insert_cache_entry(self, cache_key: Tuple, entry: CacheEntry):
+        with self._lock:
+            self.key_cache.expire()
+            if cache_key not in self.key_cache and len(self.key_cache) >= self.key_cache.maxsize:
+                metrics.increment(self._metrics_prefix(cache_key) + ".evictions")
+            self.key_cache[cache_key] = entry
+
+    def _restore_from_file(self):
+        with self._restore_lock:
+            if self._restored:
+                return
+            entries = self.cache_file.load(self.CACHE_FILE_SECTION)
+            for cache_key, fetch_timestamp, keys in sorted(entries, key=lambda e: e[1]):
+                entry = self._create_entry(self._parse_stored_keys(keys), fetch_timestamp, keys)
+                if not entry.is_expired():
+                    with self._lock:
+                        self.key_cache[cache_key] = entry
+            self._restored = True
+
+    async def _restore_from_file_async(self):
+        if not self._restored:
+            await asyncio.get_running_loop().run_in_executor(None, self._restore_from_file)
+
+    def _save_to_file(self):
+        if self.cache_file is None:
+            return
+        with self._lock:
+            entries = list(self.key_cache.items())
+        # serialized outside of the lock, which every cache lookup has to acquire
+        self.cache_file.save(self.CACHE_FILE_SECTION, [(cache_key, entry.fetch_timestamp, entry.get_pems())
+                                                       for cache_key, entry in entries])
+
+    def _get_cached_or_load(self, load: Callable[..., CacheEntry], cache_key: Tuple, kid: str):
+        """
+        return the cached key, load the key set if the kid is missing and refresh it in the background if stale
+        """
+        if not self._restored:
+            self._restore_from_file()
+        entry = self._get_cache_entry(cache_key)
+        if entry is None or kid not in entry.keys:
+            metrics.increment(self._metrics_prefix(cache_key) + ".misses")
+            self._raise_if_missing(cache_key, kid)
+            entry = load(*cache_key, kid)
+            if kid not in entry.keys:
+                raise ValueError("Could not find key with kid {}".format(kid))
+            return entry.keys[kid]
+        if entry.is_stale():
+            self._count_expiration(cache_key, entry)
+            self._refresh_in_background(load, cache_key, kid)
+        metrics.increment(self._metrics_prefix(cache_key) + ".hits")
+        return entry.keys[kid]
+
+    def _refresh_in_background(self, load: Callable[..., CacheEntry], cache_key: Tuple, kid: str):
+        with self._lock:
+            if cache_key in self._refreshing:
+                return
+            self._refreshing.add(cache_key)
+
+        def refresh():
+            try:
+                load(*cache_key, kid)
+            except Exception as e:  # pylint: disable=broad-except
+                logger.warning("Could not refresh verification keys %s: %s", cache_key, e)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(cache_key)
+
+        Thread(target=refresh, daemon=True).start()
+
+    def _raise_if_missing(self, cache_key: Tuple, kid: str):
+        with self._lock:
+            missing = (cache_key, kid) in self.missing_key_cache
+        if missing:
+            raise ValueError("Could not find key with kid {}".format(kid))
+
+    def _set_missing(self, cache_key: Tuple, kid: str):
+        with self._lock:
+            self.missing_key_cache[(cache_key, kid)] = True
+
+    def _load_keys(self, cache_key: Tuple, kid: str,
+                   download: Callable[[Optional[CacheEntry]], CacheEntry]) -> CacheEntry:
+        """
+        download the key set unless it has been loaded by another thread in the meantime
+        or the kid is known to be missing.
+        Concurrent loads of the same key set share one download, whichever kid they are looking for.
+        """
+        load_lock, calls = self._load_locks.acquire(cache_key)
+        try:
+            with load_lock.lock:
+                _raise_error_of_finished_load(load_lock, calls)
+                entry = self._get_cache_entry(cache_key, include_expired=True)
+                if entry is not None and not entry.is_stale() and kid in entry.keys:
+                    return entry
+                if self._is_missing(cache_key, kid, entry):
+                    raise ValueError("Could not find key with kid {}".format(kid))
+                with self._downloading(cache_key, kid, load_lock):
+                    entry = self._download_shared(cache_key, kid, download, entry)
+                if kid not in entry.keys:
+                    self._set_missing(cache_key, kid)
+                return self._put_cache_entry(cache_key, entry)
+        finally:
+            self._load_locks.release(cache_key, load_lock)
+
+    def _is_missing(self, cache_key: Tuple, kid: str, entry: Optional[CacheEntry]) -> bool:
+        """
+        :return: True if the kid is known to be missing or not contained in the recently downloaded entry
+        """
+        with self._lock:
+            if (cache_key, kid) in self.missing_key_cache:
+                return True
+        if entry is not None and kid not in entry.keys and entry.is_recently_fetched():
+            self._set_missing(cache_key, kid)
+            return True
+        return False
+
+    @contextmanager
+    def _downloading(self, cache_key: Tuple, kid: str, load_lock: _LoadLock):
+        """
+        shares the outcome of the download with the threads waiting for load_lock
+        """
+        try:
+            yield
+            load_lock.error = None
+        except Exception as e:
+            load_lock.error = e
+            if _is_not_found(e):
+                self._set_missing(cache_key, kid)
+            raise
+        finally:
+            load_lock.calls += 1
+
+    def _is_cached(self, cache_key: Tuple, kid: str) -> bool:
+        """
+        :return: True if the key can be returned without a download, i.e. it is cached or known to be missing
+        """
+        if not self._restored:
+            self._restore_from_file()
+        entry = self._get_cache_entry(cache_key)
+        if entry is not None and (kid in entry.keys or entry.is_recently_fetched()):
+            return True
+        with self._lock:
+            return (cache_key, kid) in self.missing_key_cache
+
+    async def _load_keys_async(self, cache_key: Tuple, kid: str,
+                               download: Callable[[Optional[CacheEntry]], Awaitable[CacheEntry]]):
+        """
+        like _load_keys, but without blocking the event loop. Concurrent calls of an event loop for the same key set
+        share one task, which waits for the downloads of other threads and processes like _load_keys.
+        A missing kid is not raised here, but by the get_verification_key_*_async call of each caller.
+        """
+        loop = asyncio.get_running_loop()
+
+        async def load():
+            load_lock, calls = self._load_locks.acquire(cache_key)
+            try:
+                # polled, a cancelled task must not get the lock later in an executor thread
+                while not load_lock.lock.acquire(blocking=False):
+                    await asyncio.sleep(LOCK_POLL_INTERVAL_IN_SECONDS)
+                try:
+                    _raise_error_of_finished_load(load_lock, calls)
+                    entry = self._get_cache_entry(cache_key, include_expired=True)
+                    if entry is not None and not entry.is_stale() and kid in entry.keys or \
+                            self._is_missing(cache_key, kid, entry):
+                        return
+                    with self._downloading(cache_key, kid, load_lock):
+                        entry = await self._download_shared_async(cache_key, kid, download, entry)
+                    if kid not in entry.keys:
+                        self._set_missing(cache_key, kid)
+                    self._insert_cache_entry(cache_key, entry)
+                    await loop.run_in_executor(None, self._save_to_file)
+                finally:
+                    load_lock.lock.release()
+            finally:
+                self._load_locks.release(cache_key, load_lock)
+
+        loop_key = (loop, cache_key)
+        task = self._async_loads.get(loop_key)
+        if task is None:
+            task = self._async_loads[loop_key] = asyncio.ensure_future(load())
+            task.add_done_callback(lambda _: self._async_loads.pop(loop_key, None))
+        # a cancelled caller must not cancel the download other callers are waiting for
+        await asyncio.shield(task)
+
+    def _download_shared(self, cache_key: Tuple, kid: str, download: Callable[[Optional[CacheEntry]], CacheEntry],
+                         cached: Optional[CacheEntry] = None) -> CacheEntry:
+        """
+        download the key set, or take it from the shared key store if another process has just downloaded it
+        """
+        if self.shared_key_store is None:
+            return download(cached)
+
+        downloaded = []
+
+        def download_pem() -> Dict[str, str]:
+            downloaded.append(download(cached))
+            return downloaded[0].get_pems()
+
+        fetch_timestamp, keys = self.shared_key_store.load(
+            self.CACHE_FILE_SECTION, cache_key, lambda *stored: self._is_stored_key_set_usable(kid, *stored),
+            download_pem)
+        # the response headers are only known to the process which has downloaded the key set
+        return downloaded[0] if downloaded else \
+            self._create_entry(self._parse_stored_keys(keys), fetch_timestamp, keys)
+
+    async def _download_shared_async(self, cache_key: Tuple, kid: str,
+                                     download: Callable[[Optional[CacheEntry]], Awaitable[CacheEntry]],
+                                     cached: Optional[CacheEntry] = None) -> CacheEntry:
+        """
+        like _download_shared, but without blocking the event loop
+        """
+        if self.shared_key_store is None:
+            return await download(cached)
+
+        downloaded = []
+
+        async def download_pem() -> Dict[str, str]:
+            downloaded.append(await download(cached))
+            return downloaded[0].get_pems()
+
+        fetch_timestamp, keys = await self.shared_key_store.load_async(
+            self.CACHE_FILE_SECTION, cache_key, lambda *stored: self._is_stored_key_set_usable(kid, *stored),
+            download_pem)
+        return downloaded[0] if downloaded else \
+            self._create_entry(self._parse_stored_keys(keys), fetch_timestamp, keys)
+
+    def _is_stored_key_set_usable(self, kid: Optional[str], fetch_timestamp: float, keys: Dict[str, str]) -> bool:
+        entry = self._create_entry(keys, fetch_timestamp)
+        return not entry.is_stale() and (kid is None or kid in keys or entry.is_recently_fetched())
+
+
+default_key_cache = VerificationKeyCache(cache_file=KEYCACHE_FILE,
+                                         shared_key_store_directory=KEYCACHE_SHARED_DIRECTORY)
+key_cache = default_key_cache.key_cache
+missing_key_cache = default_key_cache.missing_key_cache
+
+
+def get_verification_key_ias(issuer_url: str, app_tid: str, azp: str, client_id: str, kid: str) -> Any:
+    """
+    get verification key for ias as public key object
+    """
+    return default_key_cache.get_verification_key_ias(issuer_url, app_tid, azp, client_id, kid)
+
+
+def is_verification_key_ias_cached(issuer_url: str, app_tid: str, azp: str, client_id: str, kid: str) -> bool:
+    """
+    :return: True if get_verification_key_ias returns without downloading keys
+    """
+    return default_key_cache.is_verification_key_ias_cached(issuer_url, app_tid, azp, client_id, kid)
+
+
+async def get_verification_key_ias_async(issuer_url: str, app_tid: str, azp: str, client_id: str, kid: str) -> Any:
+    """
+    get verification key for ias, missing keys are downloaded without blocking the event loop
+    """
+    return await default_key_cache.get_verification_key_ias_async(issuer_url, app_tid, azp, client_id, kid)
+
+
+def prefetch_verification_key_url_ias(service_credentials: Dict[str, str]) -> str:
+    """
+    request the openid configuration of the ias instance bound by service_credentials, e.g. on startup,
+    so the first missing key set of its issuer costs a single request
+    """
+    return default_key_cache.prefetch_verification_key_url_ias(service_credentials)
+
+
+def get_verification_key_xsuaa(jku: str, kid: str) -> Any:
+    """
+    get verification key for xsuaa as public key object
+    """
+    return default_key_cache.get_verification_key_xsuaa(jku, kid)
 
 
-@thread_safe_by_args
-@cached(cache=key_cache)
-def get_verification_key_ias(issuer_url: str, app_tid: str, azp: str, client_id: str, kid: str) -> str:
+def is_verification_key_xsuaa_cached(jku: str, kid: str) -> bool:
     """
-    get verification key for ias
+    :return: True if get_verification_key_xsuaa returns without downloading keys
     """
-    verification_key_url: str = _fetch_verification_key_url_ias(issuer_url)
-    verification_key_list: List[Dict[str, Any]] = _download_verification_key_ias(verification_key_url, app_tid, azp,
-                                                                                 client_id)
-    found = list(filter(lambda k: k["kid"] == kid, verification_key_list))
-    if len(found) == 0:
-        raise ValueError("Could not find key with kid {}".format(kid))
-    return jwk_to_pem(found[0])
+    return default_key_cache.is_verification_key_xsuaa_cached(jku, kid)
 
 
-@thread_safe_by_args
-@cached(cache=key_cache)
-def get_verification_key_xsuaa(jku: str, kid: str) -> str:
+async def get_verification_key_xsuaa_async(jku: str, kid: str) -> Any:
     """
-    get verification key for xsuaa
+    get verification key for xsuaa, missing keys are downloaded without blocking the event loop
     """
-    # TODO
-    raise NotImplementedError()
+    return await default_key_cache.get_verification_key_xsuaa_async(jku, kid)
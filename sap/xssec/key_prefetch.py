@@ -0,0 +1,63 @@
+""" Prefetching of verification keys for known tenants, e.g. on startup """
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple, Union
+
+from sap.xssec import key_cache_v2
+from sap.xssec.constants import PREFETCH_DEFAULT_MAX_PARALLEL_REQUESTS
+from sap.xssec.security_context_xsuaa import SecurityContextXSUAA, _compose_jku
+
+logger = logging.getLogger(__name__)
+
+
+def prefetch(service_credentials: Dict[str, str], zone_ids: Iterable[str] = None,
+             issuers: Iterable[Union[str, Tuple[str, str]]] = None, key_cache=None,
+             max_parallel_requests: int = PREFETCH_DEFAULT_MAX_PARALLEL_REQUESTS) -> Dict[Any, Optional[Exception]]:
+    """
+    Downloads the verification keys of the given tenants concurrently, so their first requests need no download.
+
+    :param service_credentials: dict containing the uaa/ias credentials
+    :param zone_ids: zone ids of the XSUAA tenants
+    :param issuers: issuer urls of the IAS tenants, or (issuer url, app_tid) tuples.
+        The keys are prefetched for tokens issued to the client id of service_credentials.
+    :param key_cache: key_cache_v2.VerificationKeyCache (or KeyCache for XSUAA) to fill instead of the default cache
+    :param max_parallel_requests: maximum number of tenants whose keys are downloaded at the same time
+    :return: dict mapping each zone id or issuer to None on success, or to the error raised for it
+    """
+    if (zone_ids is None) == (issuers is None):
+        raise ValueError('Either zone_ids or issuers should be provided')
+
+    if zone_ids is not None:
+        key_cache = key_cache or SecurityContextXSUAA.verificationKeyCache
+        tasks = {zid: _prefetch_xsuaa_task(key_cache, service_credentials, zid) for zid in zone_ids}
+    else:
+        key_cache = key_cache or key_cache_v2.default_key_cache
+        tasks = {issuer: _prefetch_ias_task(key_cache, service_credentials, issuer) for issuer in issuers}
+
+    if not tasks:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_parallel_requests) as executor:
+        results = dict(zip(tasks.keys(), executor.map(_run, tasks.values())))
+    failed = [tenant for tenant, error in results.items() if error is not None]
+    if failed:
+        logger.warning("Could not prefetch verification keys of %d of %d tenants", len(failed), len(results))
+    return results
+
+
+def _prefetch_xsuaa_task(key_cache, service_credentials: Dict[str, str], zid: str) -> Callable[[], None]:
+    return lambda: key_cache.prefetch_keys(_compose_jku(service_credentials, zid))
+
+
+def _prefetch_ias_task(key_cache, service_credentials: Dict[str, str],
+                       issuer: Union[str, Tuple[str, str]]) -> Callable[[], None]:
+    issuer_url, app_tid = (issuer, None) if isinstance(issuer, str) else issuer
+    client_id = service_credentials["clientid"]
+    return lambda: key_cache.prefetch_verification_keys_ias(issuer_url, app_tid, client_id, client_id)
+
+
+def _run(task: Callable[[], None]) -> Optional[Exception]:
+    try:
+        task()
+        return None
+    except Exception as e:  # pylint: disable=broad-except
+        return e
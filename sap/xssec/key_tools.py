@@ -1,14 +1,46 @@
 import json
+from functools import lru_cache
+from typing import Any, Union
 
+from cryptography.exceptions import UnsupportedAlgorithm
 from cryptography.hazmat.primitives._serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
 from jwt.algorithms import ECAlgorithm, RSAAlgorithm
 
+from sap.xssec.constants import KEYCACHE_DEFAULT_CACHE_SIZE
 
-def jwk_to_pem(jwk) -> str:
+PEM_HEADER = '-----BEGIN PUBLIC KEY-----'
+PEM_FOOTER = '-----END PUBLIC KEY-----'
+
+
+def jwk_to_public_key(jwk) -> Any:
+    """
+    converts a jwk into a public key object of the cryptography library, which can be used for validation directly
+    """
     jwk = {k: v.strip() if isinstance(v, str) else v for k, v in jwk.items()}
     if jwk.get("kty") == "EC":
-        pubkey = ECAlgorithm.from_jwk(json.dumps(jwk))
-    else:
-        pubkey = RSAAlgorithm.from_jwk(json.dumps(jwk))
-    pem = pubkey.public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo).decode()
-    return pem
+        return ECAlgorithm.from_jwk(json.dumps(jwk))
+    return RSAAlgorithm.from_jwk(json.dumps(jwk))
+
+
+def jwk_to_pem(jwk) -> str:
+    return public_key_to_pem(jwk_to_public_key(jwk))
+
+
+def public_key_to_pem(public_key) -> str:
+    return public_key.public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo).decode()
+
+
+@lru_cache(maxsize=KEYCACHE_DEFAULT_CACHE_SIZE)
+def pem_to_public_key(pem: str) -> Union[Any, str]:
+    """
+    parses a pem encoded public key once and returns the cached key object for subsequent calls.
+    Keys without line breaks (as configured in some service bindings) are accepted as well.
+    Strings that are no public keys are returned unchanged, so they can still be used e.g. as HMAC secret.
+    """
+    if PEM_HEADER in pem and '\n' not in pem:
+        pem = pem.replace(PEM_HEADER, PEM_HEADER + '\n').replace(PEM_FOOTER, '\n' + PEM_FOOTER)
+    try:
+        return load_pem_public_key(pem.encode())
+    except (ValueError, TypeError, UnsupportedAlgorithm):
+        return pem
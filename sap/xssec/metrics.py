@@ -0,0 +1,126 @@
+"""
+Metrics of the key caches and the token validation.
+By default metrics are discarded. Use set_metrics_sink to collect them, e.g. with an InMemoryMetricsSink whose
+snapshot can be exported to Prometheus, or with an own MetricsSink forwarding them to a metrics library.
+
+Key cache metrics are named key_cache.<xsuaa|ias>.<metric>:
+hits, misses, expirations, evictions, fetch_errors, retries and circuit_open (requests rejected by an open
+circuit breaker) are counters,
+fetch_seconds is a histogram and fetches_in_flight is a gauge.
+Validation metrics are histograms named validation.<xsuaa|ias>.<stage>_seconds.
+A ValidatedTokenCache counts validated_token_cache.hits and validated_token_cache.misses.
+"""
+import time
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Dict
+
+
+class MetricsSink(object):
+    """ Receives metrics and discards them, subclasses override the methods to record them """
+
+    def increment(self, name: str, value: float = 1):
+        """ increments the counter name by value """
+
+    def observe(self, name: str, value: float):
+        """ records value in the histogram name """
+
+    def update_gauge(self, name: str, delta: float):
+        """ adds delta, which may be negative, to the gauge name """
+
+
+class InMemoryMetricsSink(MetricsSink):
+    """ Thread safe sink which keeps all metrics in memory """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters: Dict[str, float] = {}
+        self._histograms: Dict[str, Dict[str, float]] = {}
+        self._gauges: Dict[str, float] = {}
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                self._histograms[name] = {"count": 1, "sum": value, "min": value, "max": value}
+            else:
+                histogram["count"] += 1
+                histogram["sum"] += value
+                histogram["min"] = min(histogram["min"], value)
+                histogram["max"] = max(histogram["max"], value)
+
+    def update_gauge(self, name: str, delta: float):
+        with self._lock:
+            self._gauges[name] = self._gauges.get(name, 0) + delta
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        :return: copy of the current metrics as {"counters": {...}, "histograms": {...}, "gauges": {...}},
+            each histogram has the keys count, sum, min and max
+        """
+        with self._lock:
+            return {
+                "counters": dict(self._counters),
+                "histograms": {name: dict(histogram) for name, histogram in self._histograms.items()},
+                "gauges": dict(self._gauges),
+            }
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._gauges.clear()
+
+
+_sink = MetricsSink()
+
+
+def set_metrics_sink(sink: MetricsSink):
+    """ replaces the sink receiving all metrics, MetricsSink() discards them again """
+    global _sink
+    _sink = sink
+
+
+def get_metrics_sink() -> MetricsSink:
+    return _sink
+
+
+def increment(name: str, value: float = 1):
+    _sink.increment(name, value)
+
+
+def observe(name: str, value: float):
+    _sink.observe(name, value)
+
+
+def update_gauge(name: str, delta: float):
+    _sink.update_gauge(name, delta)
+
+
+@contextmanager
+def timed(name: str):
+    """ records the duration of the with block in seconds in the histogram name """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _sink.observe(name, time.perf_counter() - start)
+
+
+@contextmanager
+def fetching(prefix: str):
+    """ records duration, errors and concurrency of a key download as <prefix>.fetch_* metrics """
+    _sink.update_gauge(prefix + ".fetches_in_flight", 1)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        _sink.increment(prefix + ".fetch_errors")
+        raise
+    finally:
+        _sink.observe(prefix + ".fetch_seconds", time.perf_counter() - start)
+        _sink.update_gauge(prefix + ".fetches_in_flight", -1)
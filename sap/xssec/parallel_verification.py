@@ -0,0 +1,102 @@
+"""
+Verification of many tokens in parallel with JwtValidationFacade, e.g. to re-validate archived tokens in batch jobs.
+The signature verification is CPU bound, a ParallelTokenVerifier spreads it across a pool of processes, or threads.
+The verification keys are sent to each worker process once when it starts, not with every token.
+"""
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+import jwt
+
+from sap.xssec.jwt_validation_facade import JwtValidationFacade
+from sap.xssec.key_tools import public_key_to_pem
+
+
+class VerificationResult(NamedTuple):
+    """ the payload of a valid token, or the error description of an invalid one """
+    payload: Optional[Dict[str, Any]]
+    error: Optional[str]
+
+
+class ParallelTokenVerifier(object):
+    """
+    Verifies tokens with the key of their `kid` in a pool of worker processes (or threads):
+
+        with ParallelTokenVerifier({"key-id-0": pem}) as verifier:
+            results = verifier.verify(tokens)
+    """
+
+    def __init__(self, verification_keys: Dict[str, Any], max_workers: int = None, use_processes: bool = True,
+                 verify_time_claims: bool = True):
+        """
+        :param verification_keys: pem encoded public keys or public key objects of the cryptography library by kid
+        :param max_workers: size of the pool, by default the number of CPUs
+        :param use_processes: False to use a thread pool, e.g. for small batches
+        :param verify_time_claims: False to only verify the signatures, e.g. of archived tokens which have expired
+        """
+        # key objects can not be pickled, the workers parse the pem once
+        pems = {kid: key if isinstance(key, str) else public_key_to_pem(key) for kid, key in verification_keys.items()}
+        self._executor: Executor
+        if use_processes:
+            self._executor = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                                 initargs=(pems, verify_time_claims))
+            self._verify = _verify_in_worker
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+            self._verify = _TokenVerifier(pems, verify_time_claims).verify
+
+    def verify(self, tokens: Iterable[str], chunk_size: int = 100) -> List[VerificationResult]:
+        """
+        :param chunk_size: number of tokens sent to a worker process at once
+        :return: the result of each token, in the order of tokens
+        """
+        return list(self._executor.map(self._verify, tokens, chunksize=chunk_size))
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class _TokenVerifier(object):
+
+    def __init__(self, pems: Dict[str, str], verify_time_claims: bool):
+        self._pems = pems
+        self._verify_time_claims = verify_time_claims
+
+    def verify(self, token: str) -> VerificationResult:
+        try:
+            return self._verify(token)
+        except Exception as e:  # pylint: disable=broad-except
+            # a single bad token must not abort the batch
+            return VerificationResult(None, str(e) or type(e).__name__)
+
+    def _verify(self, token: str) -> VerificationResult:
+        jwt_validator = JwtValidationFacade()
+        try:
+            kid = jwt_validator.parse(token).header.get("kid")
+        except jwt.exceptions.DecodeError as e:
+            return VerificationResult(None, str(e))
+        if not isinstance(kid, str) or kid not in self._pems:
+            return VerificationResult(None, "No verification key for kid {0}".format(kid))
+        jwt_validator.loadPEM(self._pems[kid])
+        jwt_validator.checkToken(token, verify_time_claims=self._verify_time_claims)
+        if jwt_validator.getErrorRC() != 0:
+            return VerificationResult(None, jwt_validator.getErrorDescription())
+        return VerificationResult(jwt_validator.getJWPayload(), None)
+
+
+_worker_verifier: Optional[_TokenVerifier] = None
+
+
+def _init_worker(pems: Dict[str, str], verify_time_claims: bool):
+    global _worker_verifier  # pylint: disable=global-statement
+    _worker_verifier = _TokenVerifier(pems, verify_time_claims)
+
+
+def _verify_in_worker(token: str) -> VerificationResult:
+    return _worker_verifier.verify(token)
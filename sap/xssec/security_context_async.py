@@ -0,0 +1,136 @@
+""" Async creation of security contexts """
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from sap.xssec import key_cache_v2
+from sap.xssec.security_context_ias import SecurityContextIAS, ServiceBindingIAS
+from sap.xssec.security_context_xsuaa import SecurityContextXSUAA, ServiceBindingXSUAA
+from sap.xssec.token_cache import ValidatedTokenCache
+
+
+class _VerificationKeyRequired(Exception):
+    """ Raised while creating a security context if the verification key has to be downloaded first. """
+    def __init__(self, params: Dict[str, Any]):
+        super(_VerificationKeyRequired, self).__init__(params)
+        self.params = params
+
+
+class _AsyncKeySource(object):
+    """
+    Key source passed to the security contexts, it only returns keys which are available without a download.
+    Missing keys are reported with _VerificationKeyRequired and resolved asynchronously by the caller.
+    """
+
+    def __init__(self, is_cached: Callable[..., bool], load: Callable[..., Any],
+                 load_async: Callable[..., Awaitable[Any]]):
+        self._is_cached = is_cached
+        self._load = load
+        self._load_async = load_async
+        self._resolved: Dict[Tuple, Tuple[Any, Exception]] = {}
+
+    def get(self, **params):
+        resolved = self._resolved.get(self._key(params))
+        if resolved is not None:
+            key, error = resolved
+            if error is not None:
+                raise error
+            return key
+        if not self._is_cached(**params):
+            raise _VerificationKeyRequired(params)
+        return self._load(**params)
+
+    async def resolve(self, params: Dict[str, Any]):
+        try:
+            self._resolved[self._key(params)] = (await self._load_async(**params), None)
+        except Exception as e:  # pylint: disable=broad-except
+            # the error is raised where the context asks for the key, just like with a synchronous download
+            self._resolved[self._key(params)] = (None, e)
+
+    def load_key(self, jku, kid):
+        return self.get(jku=jku, kid=kid)
+
+    def get_verification_key_ias(self, **params):
+        return self.get(**params)
+
+    @staticmethod
+    def _key(params: Dict[str, Any]) -> Tuple:
+        return tuple(sorted(params.items()))
+
+
+async def _create(create: Callable[[_AsyncKeySource], Any], key_source: _AsyncKeySource):
+    while True:
+        try:
+            return create(key_source)
+        except _VerificationKeyRequired as e:
+            await key_source.resolve(e.params)
+
+
+async def _create_cached(token_type: str, token: str, service_credentials: Dict[str, str],
+                         token_cache: Optional[ValidatedTokenCache], create: Callable[[], Awaitable[Any]]):
+    security_context = token_cache.get(token_type, token, service_credentials) if token_cache else None
+    if security_context is None:
+        security_context = await create()
+        if token_cache is not None:
+            token_cache.put(token_type, token, service_credentials, security_context)
+    return security_context
+
+
+async def create_security_context_xsuaa_async(token, service_credentials: Dict[str, str], key_cache=None,
+                                              token_cache: ValidatedTokenCache = None):
+    """
+    Creates the XSUAA Security Context by validating the received access token.
+    Verification keys are downloaded without blocking the event loop.
+
+    :param token: string containing the access_token
+    :param service_credentials: dict containing the uaa/ias credentials
+    :param key_cache: key_cache_v2.VerificationKeyCache or KeyCache to use instead of
+        SecurityContextXSUAA.verificationKeyCache
+    :param token_cache: ValidatedTokenCache, which returns the security context of a token validated before
+    :return: SecurityContextXSUAA object
+    """
+    return await _create_security_context_xsuaa_async(token, service_credentials, key_cache, token_cache)
+
+
+async def _create_security_context_xsuaa_async(token, service_credentials: Dict[str, str], key_cache,
+                                               token_cache: Optional[ValidatedTokenCache],
+                                               binding: ServiceBindingXSUAA = None):
+    key_cache = key_cache or SecurityContextXSUAA.verificationKeyCache
+    key_source = _AsyncKeySource(
+        is_cached=lambda jku, kid: key_cache.is_cached(jku, kid),
+        load=lambda jku, kid: key_cache.load_key(jku, kid),
+        load_async=lambda jku, kid: key_cache.load_key_async(jku, kid))
+    return await _create_cached(
+        "xsuaa", token, service_credentials, token_cache,
+        lambda: _create(lambda source: SecurityContextXSUAA(token, service_credentials, key_cache=source,
+                                                            binding=binding),
+                        key_source))
+
+
+async def create_security_context_ias_async(token, service_credentials: Dict[str, str], key_cache=None,
+                                            token_cache: ValidatedTokenCache = None):
+    """
+    Creates the IAS Security Context by validating the received access token.
+    Verification keys are downloaded without blocking the event loop.
+
+    :param token: string containing the access_token
+    :param service_credentials: dict containing the uaa/ias credentials
+    :param key_cache: key_cache_v2.VerificationKeyCache to use instead of key_cache_v2.default_key_cache
+    :param token_cache: ValidatedTokenCache, which returns the security context of a token validated before
+    :return: SecurityContextIAS object
+    """
+    return await _create_security_context_ias_async(token, service_credentials, key_cache, token_cache)
+
+
+async def _create_security_context_ias_async(token, service_credentials: Dict[str, str], key_cache,
+                                             token_cache: Optional[ValidatedTokenCache],
+                                             binding: ServiceBindingIAS = None):
+    # the module level functions of key_cache_v2 use its default cache
+    key_cache = key_cache or key_cache_v2
+    key_source = _AsyncKeySource(
+        is_cached=key_cache.is_verification_key_ias_cached,
+        load=key_cache.get_verification_key_ias,
+        load_async=key_cache.get_verification_key_ias_async)
+    return await _create_cached(
+        "ias", token, service_credentials, token_cache,
+        lambda: _create(lambda source: SecurityContextIAS(token, service_credentials, key_cache=source,
+                                                          binding=binding),
+                        key_source))
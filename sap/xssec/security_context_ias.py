@@ -1,29 +1,59 @@
 """ Security Context class for IAS support"""
 import logging
 import re
-from typing import List, Dict
+from functools import lru_cache
+from typing import Any, List, Dict, Optional, Pattern, Tuple
 from urllib3.util import Url, parse_url  # type: ignore
+from sap.xssec import metrics
+from sap.xssec.constants import IAS_ISSUER_VALIDATION_CACHE_SIZE
 from sap.xssec.jwt_audience_validator import JwtAudienceValidator
 from sap.xssec.jwt_validation_facade import JwtValidationFacade, DecodeError
-from sap.xssec.key_cache import KeyCache
-from sap.xssec.key_cache_v2 import get_verification_key_ias
+from sap.xssec.key_cache_v2 import default_key_cache, get_verification_key_ias
+
+
+class ServiceBindingIAS(object):
+    """
+    Everything the validation of IAS tokens derives from the service credentials alone: the audience validator
+    and the domains of the issuer.
+    It is created once per validation if not passed to SecurityContextIAS, a TokenValidator keeps it.
+    """
+
+    def __init__(self, service_credentials: Dict[str, str]):
+        self.service_credentials = service_credentials
+        self.audience_validator = JwtAudienceValidator(service_credentials["clientid"])
+        domains: List[str] = service_credentials.get("domains") or (
+            [service_credentials["domain"]] if "domain" in service_credentials else [])
+        self.domains: Tuple[str, ...] = tuple(domains)
 
 
 class SecurityContextIAS(object):
     """ SecurityContextIAS class """
 
-    verificationKeyCache = KeyCache()
+    verificationKeyCache = default_key_cache
 
-    def __init__(self, token: str, service_credentials: Dict[str, str]):
+    def __init__(self, token: str, service_credentials: Dict[str, str], key_cache=None,
+                 binding: ServiceBindingIAS = None):
+        """
+        :param binding: ServiceBindingIAS of service_credentials, to validate many tokens without deriving it again
+        """
         self.token = token
-        self.service_credentials = service_credentials
+        self.binding = binding or ServiceBindingIAS(service_credentials)
+        self.service_credentials = self.binding.service_credentials
+        self.key_cache = key_cache
         self.logger = logging.getLogger(__name__)
         self.jwt_validator = JwtValidationFacade()
-        self.audience_validator = JwtAudienceValidator(self.service_credentials["clientid"])
+        self.audience_validator = self.binding.audience_validator
         try:
-            self.token_payload = self.jwt_validator.decode(token, False)
-            self.token_header = self.jwt_validator.get_unverified_header(token)
-            self.validate_issuer().validate_timestamp().validate_audience().validate_signature()
+            with metrics.timed("validation.ias.total_seconds"):
+                self.token_payload = self.jwt_validator.decode(token, False)
+                self.token_header = self.jwt_validator.get_unverified_header(token)
+                with metrics.timed("validation.ias.issuer_seconds"):
+                    self.validate_issuer()
+                with metrics.timed("validation.ias.timestamp_seconds"):
+                    self.validate_timestamp()
+                with metrics.timed("validation.ias.audience_seconds"):
+                    self.validate_audience()
+                self.validate_signature()
         except DecodeError:
             raise ValueError("Failed to decode provided token")
 
@@ -35,34 +65,19 @@ class SecurityContextIAS(object):
         """
         check `ias_iss` or `iss` in jwt token
         """
-        issuer_url: Url = parse_url(self.get_issuer())
-        if issuer_url.scheme != "https":
-            raise ValueError("Token's issuer has wrong protocol ({})".format(issuer_url.scheme))
-
-        if issuer_url.query is not None:
-            raise ValueError("Token's issuer has unallowed query value ({})".format(issuer_url.query))
-
-        if issuer_url.fragment is not None:
-            raise ValueError("Token's issuer has unallowed hash value ({})".format(issuer_url.fragment))
-
-        domains: List[str] = self.service_credentials.get("domains") or (
-            [self.service_credentials["domain"]] if "domain" in self.service_credentials else [])
-
-        def validate_issuer_subdomain(parent_domain) -> bool:
-            pattern = r'^https://[a-zA-Z0-9-]{{1,63}}\.{parent_domain}$'.format(parent_domain=re.escape(parent_domain))
-            return bool(re.match(pattern, self.get_issuer()))
-
-        if not any(map(validate_issuer_subdomain, domains)):
-            raise ValueError("Token's issuer is not found in domain list {}".format(", ".join(domains)))
-
+        error = _validate_issuer(self.get_issuer(), self.binding.domains)
+        if error is not None:
+            raise ValueError(error)
         return self
 
     def validate_timestamp(self):
         """
-        check `exp` in jwt token
+        check `exp` and `nbf` in jwt token
         """
         if self.jwt_validator.has_token_expired(self.token):
             raise ValueError("Token has expired")
+        if not self.jwt_validator.is_token_valid_yet(self.token):
+            raise ValueError("Token is not yet valid")
         return self
 
     def validate_audience(self):
@@ -82,19 +97,22 @@ class SecurityContextIAS(object):
         """
         check signature in jwt token
         """
-        verification_key: str = get_verification_key_ias(
-            issuer_url=self.get_issuer(),
-            app_tid=self.token_payload.get("app_tid") or self.token_payload.get("zone_uuid"),
-            azp=self.token_payload.get("azp"),
-            client_id=self.service_credentials["clientid"],
-            kid=self.token_header["kid"],
-        )
-
-        result_code = self.jwt_validator.loadPEM(verification_key)
-        if result_code != 0:
-            raise RuntimeError('Invalid verification key, result code {0}'.format(result_code))
-
-        self.jwt_validator.checkToken(self.token)
+        load_key = self.key_cache.get_verification_key_ias if self.key_cache else get_verification_key_ias
+        with metrics.timed("validation.ias.key_lookup_seconds"):
+            verification_key: Any = load_key(
+                issuer_url=self.get_issuer(),
+                app_tid=self.token_payload.get("app_tid") or self.token_payload.get("zone_uuid"),
+                azp=self.token_payload.get("azp"),
+                client_id=self.service_credentials["clientid"],
+                kid=self.token_header["kid"],
+            )
+
+        with metrics.timed("validation.ias.signature_seconds"):
+            result_code = self.jwt_validator.loadPEM(verification_key)
+            if result_code != 0:
+                raise RuntimeError('Invalid verification key, result code {0}'.format(result_code))
+
+            self.jwt_validator.checkToken(self.token)
         error_description = self.jwt_validator.getErrorDescription()
         if error_description != '':
             raise RuntimeError(
@@ -102,3 +120,32 @@ class SecurityContextIAS(object):
                     error_description, self.jwt_validator.getErrorRC()))
 
         return self
+
+
+@lru_cache(maxsize=IAS_ISSUER_VALIDATION_CACHE_SIZE)
+def _validate_issuer(issuer: str, domains: Tuple[str, ...]) -> Optional[str]:
+    """
+    :return: why the issuer is not accepted for the domains, or None. Verdicts of known issuers are cached.
+    """
+    issuer_url: Url = parse_url(issuer)
+    if issuer_url.scheme != "https":
+        return "Token's issuer has wrong protocol ({})".format(issuer_url.scheme)
+
+    if issuer_url.query is not None:
+        return "Token's issuer has unallowed query value ({})".format(issuer_url.query)
+
+    if issuer_url.fragment is not None:
+        return "Token's issuer has unallowed hash value ({})".format(issuer_url.fragment)
+
+    if not _issuer_pattern(domains).match(issuer):
+        return "Token's issuer is not found in domain list {}".format(", ".join(domains))
+    return None
+
+
+@lru_cache(maxsize=IAS_ISSUER_VALIDATION_CACHE_SIZE)
+def _issuer_pattern(domains: Tuple[str, ...]) -> Pattern:
+    """ one compiled pattern, which matches the subdomains of all domains """
+    if not domains:
+        return re.compile(r'(?!)')
+    return re.compile(r'^https://[a-zA-Z0-9-]{{1,63}}\.(?:{domains})$'.format(
+        domains="|".join(map(re.escape, domains))))
@@ -8,13 +8,12 @@ from os import environ, unlink
 import json
 from datetime import datetime
 import logging
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import httpx
 
-from sap.xssec import constants
+from sap.xssec import constants, key_cache_v2, metrics
 from sap.xssec.jwt_validation_facade import JwtValidationFacade, DecodeError
-from sap.xssec.key_cache import KeyCache
 from sap.xssec.jwt_audience_validator import JwtAudienceValidator
 
 _client_secret_props = ('clientid', 'clientsecret', 'url')  # props for client secret authentication
@@ -87,30 +86,43 @@ def _delete_cert_and_key_files(cert_file_name, key_file_name):
         unlink(key_file_name)
 
 
-class SecurityContextXSUAA(object):
-    """ SecurityContext class """
+def _get_uaa_domain(config) -> Optional[str]:
+    uaa_domain: str = config.get('uaadomain') or config.get('url')
+    return re.sub(r'^https://', '', uaa_domain) if uaa_domain else None
 
-    verificationKeyCache = KeyCache()
 
-    def __init__(self, token, config):
-        _check_if_valid(token, 'token')
-        self._token = token
+def _compose_jku_for_domain(uaa_domain, zid):
+    if not uaa_domain:
+        raise RuntimeError("Service is not properly configured in 'VCAP_SERVICES'")
+    return f"https://{uaa_domain}/token_keys?zid={zid}" if zid else f"https://{uaa_domain}/token_keys"
+
+
+def _compose_jku(config, zid):
+    return _compose_jku_for_domain(_get_uaa_domain(config), zid)
+
+
+class ServiceBindingXSUAA(object):
+    """
+    Everything the validation of XSUAA tokens derives from the service credentials alone: the checked config,
+    the xsappname, the audience validator and the uaa domain of the jku.
+    It is created once per validation if not passed to SecurityContextXSUAA, a TokenValidator keeps it.
+    """
+
+    def __init__(self, config):
         _check_config(config)
-        self._config = config
-        self._jwt_validator = JwtValidationFacade()
+        self.config = config
         self._logger = logging.getLogger(__name__)
-        self._properties = {}
-        self._init_properties()
+        self.xsappname = self._init_xsappname()
+        self.audience_validator = JwtAudienceValidator(config['clientid'])
+        if config.get('xsappname'):
+            self.audience_validator.configure_trusted_clientId(config['xsappname'])
+        self._uaa_domain = _get_uaa_domain(config)
 
-    def _init_properties(self):
-        self._init_xsappname()
-        self._set_properties_defaults()
-        self._set_token_properties()
-        self._offline_validation()
-        self._audience_validation()
+    def compose_jku(self, zid):
+        return _compose_jku_for_domain(self._uaa_domain, zid)
 
     def _init_xsappname(self):
-        if 'xsappname' not in self._config:
+        if 'xsappname' not in self.config:
             if 'XSAPPNAME' not in environ:
                 raise ValueError('Invalid config: Missing xsappname.'
                                  ' The application name needs to be defined in xs-security.json.')
@@ -118,11 +130,10 @@ class SecurityContextXSUAA(object):
                 self._logger.warning('XSAPPNAME defined in manifest.yml (legacy).'
                                      ' You should switch to defining xsappname'
                                      ' in xs-security.json.')
-                self._properties['xsappname'] = environ['XSAPPNAME']
+                return environ['XSAPPNAME']
         else:
-            self._properties['xsappname'] = self._config['xsappname']
             if 'XSAPPNAME' in environ:
-                if self._config['xsappname'] == environ['XSAPPNAME']:
+                if self.config['xsappname'] == environ['XSAPPNAME']:
                     self._logger.warning('The application name is defined both in the manifest.yml'
                                          ' (legacy) as well as in xs-security.json.'
                                          ' Remove it in manifest.yml.')
@@ -131,15 +142,41 @@ class SecurityContextXSUAA(object):
                                      ' The application name is defined with different values in'
                                      ' the manifest.yml (legacy) as well as in xs-security.json.'
                                      ' Remove it in manifest.yml.')
+            return self.config['xsappname']
+
+
+class SecurityContextXSUAA(object):
+    """ SecurityContext class """
+
+    # shared with SecurityContextIAS, a KeyCache can still be assigned or passed as key_cache
+    verificationKeyCache = key_cache_v2.default_key_cache
+
+    def __init__(self, token, config, key_cache=None, binding: ServiceBindingXSUAA = None):
+        """
+        :param binding: ServiceBindingXSUAA of config, to validate many tokens without deriving it again
+        """
+        _check_if_valid(token, 'token')
+        self._token = token
+        self._key_cache = key_cache
+        self._binding = binding or ServiceBindingXSUAA(config)
+        self._config = self._binding.config
+        self._jwt_validator = JwtValidationFacade()
+        self._logger = logging.getLogger(__name__)
+        self._properties = {}
+        self._init_properties()
+
+    def _init_properties(self):
+        with metrics.timed("validation.xsuaa.total_seconds"):
+            self._properties['xsappname'] = self._binding.xsappname
+            self._set_properties_defaults()
+            self._set_token_properties()
+            self._offline_validation()
+            with metrics.timed("validation.xsuaa.audience_seconds"):
+                self._audience_validation()
 
     def _get_jku(self):
-        uaa_domain: str = self._config.get('uaadomain') or self._config.get('url')
-        if not uaa_domain:
-            raise RuntimeError("Service is not properly configured in 'VCAP_SERVICES'")
-        uaa_domain = re.sub(r'^https://', '', uaa_domain)
         payload = self._jwt_validator.decode(self._token, verify=False)
-        zid = payload.get("zid")
-        return f"https://{uaa_domain}/token_keys?zid={zid}" if zid else f"https://{uaa_domain}/token_keys"
+        return self._binding.compose_jku(payload.get("zid"))
 
     def _set_token_properties(self):
 
@@ -353,14 +390,18 @@ class SecurityContextXSUAA(object):
         if self._properties['kid']:
             try:
                 jku = self._get_jku()
-                verification_key = SecurityContextXSUAA.verificationKeyCache.load_key(jku, self._properties['kid'])
-                return self._get_jwt_payload(verification_key)
+                key_cache = self._key_cache or SecurityContextXSUAA.verificationKeyCache
+                with metrics.timed("validation.xsuaa.key_lookup_seconds"):
+                    verification_key = key_cache.load_key(jku, self._properties['kid'])
+                with metrics.timed("validation.xsuaa.signature_seconds"):
+                    return self._get_jwt_payload(verification_key)
             except (DecodeError, RuntimeError, IOError) as e:
                 self._logger.warning("Warning: Could not validate key: {} Will retry with configured key.".format(e))
 
         if "verificationkey" in self._config:
             self._logger.debug("Validate token with configured verifcation key")
-            return self._get_jwt_payload(self._config["verificationkey"])
+            with metrics.timed("validation.xsuaa.signature_seconds"):
+                return self._get_jwt_payload(self._config["verificationkey"])
         else:
             raise RuntimeError("Cannot validate token without verificationkey")
 
@@ -380,10 +421,7 @@ class SecurityContextXSUAA(object):
         self._set_audience(jwt_payload)
 
     def _audience_validation(self):
-        audience_validator = JwtAudienceValidator(self._config['clientid'])
-        if(self._config['xsappname']):
-            audience_validator.configure_trusted_clientId(self._config['xsappname'])
-        validation_result = audience_validator.validate_token(self.get_clientid(), self.get_audience(), self._properties['scopes'])
+        validation_result = self._binding.audience_validator.validate_token(self.get_clientid(), self.get_audience(), self._properties['scopes'])
 
         if validation_result is False:
                 raise RuntimeError('Audience Validation Failed')
@@ -0,0 +1,199 @@
+"""
+Key store shared by all processes of a host, e.g. the workers of a pre-fork server like gunicorn or uwsgi.
+Each key set is stored in its own file of a directory which should be located on a memory backed file system
+like /dev/shm. When a key set has to be downloaded, only one process downloads it while holding a file lock,
+the other processes wait for the lock and use the key set that has just been stored.
+The key sets share a fixed number of lock files, and files of key sets which have not been downloaded again
+for longer than they can be used are removed, so the directory does not grow with every key set ever requested.
+load_async does the same for asyncio applications, the files are read and written in the default executor.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from sap.xssec.constants import KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES, \
+    KEYCACHE_MAX_EXPIRATION_TIME_IN_SECONDS, KEYCACHE_SHARED_LOCK_COUNT
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE_IN_SECONDS = KEYCACHE_MAX_EXPIRATION_TIME_IN_SECONDS + \
+    KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES * 60
+# interval in which load_async tries to get a file lock held by another thread or process
+LOCK_POLL_INTERVAL_IN_SECONDS = 0.01
+
+
+class SharedKeyStore(object):
+    """
+    Stores key sets as pem strings by kid together with the time they have been downloaded.
+    """
+
+    def __init__(self, directory: str, max_age_in_seconds: float = DEFAULT_MAX_AGE_IN_SECONDS):
+        """
+        :param max_age_in_seconds: time after which a stored key set is not used anymore and its file is removed
+        """
+        self.directory = directory
+        self.max_age_in_seconds = max_age_in_seconds
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        check_is_private(directory, "Shared key store directory")
+
+    def get(self, section: str, cache_key: Any) -> Optional[Tuple[float, Dict[str, str]]]:
+        """
+        :return: (fetch timestamp, keys by kid) of the stored key set or None
+        """
+        try:
+            with open(self._path(section, cache_key), "r") as f:
+                stored = json.load(f)
+            return float(stored["fetch_timestamp"]), dict(stored["keys"])
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Could not read shared key set %s: %s", cache_key, e)
+            return None
+
+    def load(self, section: str, cache_key: Any, is_usable: Callable[[float, Dict[str, str]], bool],
+             download: Callable[[], Dict[str, str]]) -> Tuple[float, Dict[str, str]]:
+        """
+        returns the stored key set if it is usable, otherwise downloads and stores it.
+        Concurrent calls of different processes for the same key set download it only once.
+        """
+        with self._locked(section, cache_key):
+            stored = self.get(section, cache_key)
+            if stored is not None and is_usable(*stored):
+                logger.debug("Using shared key set %s", cache_key)
+                return stored
+            keys = download()
+            fetch_timestamp = time.time()
+            self._store(section, cache_key, fetch_timestamp, keys)
+            return fetch_timestamp, keys
+
+    async def load_async(self, section: str, cache_key: Any, is_usable: Callable[[float, Dict[str, str]], bool],
+                         download: Callable[[], Awaitable[Dict[str, str]]]) -> Tuple[float, Dict[str, str]]:
+        """
+        like load, but without blocking the event loop
+        """
+        loop = asyncio.get_running_loop()
+        async with self._locked_async(section, cache_key):
+            stored = await loop.run_in_executor(None, self.get, section, cache_key)
+            if stored is not None and is_usable(*stored):
+                logger.debug("Using shared key set %s", cache_key)
+                return stored
+            keys = await download()
+            fetch_timestamp = time.time()
+            await loop.run_in_executor(None, self._store, section, cache_key, fetch_timestamp, keys)
+            return fetch_timestamp, keys
+
+    def _store(self, section: str, cache_key: Any, fetch_timestamp: float, keys: Dict[str, str]):
+        self._write(section, cache_key, fetch_timestamp, keys)
+        self._remove_expired()
+
+    def _path(self, section: str, cache_key: Any) -> str:
+        return os.path.join(self.directory, _hash(section, cache_key) + ".json")
+
+    def _lock_path(self, section: str, cache_key: Any) -> str:
+        return os.path.join(self.directory,
+                            "lock-{}".format(int(_hash(section, cache_key), 16) % KEYCACHE_SHARED_LOCK_COUNT))
+
+    @contextmanager
+    def _locked(self, section: str, cache_key: Any):
+        if fcntl is None:
+            yield
+            return
+        with open(self._lock_path(section, cache_key), "a") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    @asynccontextmanager
+    async def _locked_async(self, section: str, cache_key: Any):
+        if fcntl is None:
+            yield
+            return
+        lock_file = await asyncio.get_running_loop().run_in_executor(None, open, self._lock_path(section, cache_key),
+                                                                     "a")
+        try:
+            # polled, a cancelled task must not get the lock later in an executor thread
+            while True:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(LOCK_POLL_INTERVAL_IN_SECONDS)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+        finally:
+            lock_file.close()
+
+    def _write(self, section: str, cache_key: Any, fetch_timestamp: float, keys: Dict[str, str]):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"fetch_timestamp": fetch_timestamp, "keys": keys}, f)
+                os.replace(tmp_path, self._path(section, cache_key))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning("Could not store shared key set %s: %s", cache_key, e)
+
+    def _remove_expired(self):
+        """
+        removes key sets which have not been stored for max_age_in_seconds, e.g. of tenants which are gone,
+        and temporary files left behind by crashed processes
+        """
+        oldest = time.time() - self.max_age_in_seconds
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    try:
+                        if entry.name.endswith((".json", ".tmp")) and entry.stat().st_mtime < oldest:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass  # removed by another process
+        except OSError as e:
+            logger.warning("Could not remove expired shared key sets: %s", e)
+
+
+def _hash(section: str, cache_key: Any) -> str:
+    return hashlib.sha256(json.dumps([section, cache_key]).encode()).hexdigest()
+
+
+def check_is_private(path: str, description: str):
+    """
+    keys of a file or directory which can be written by other users could be forged, so it is not accepted
+    """
+    status = os.stat(path)
+    if hasattr(os, "getuid") and status.st_uid != os.getuid():
+        raise ValueError("{} {} is not owned by the current user".format(description, path))
+    if status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise ValueError("{} {} must not be writable by other users".format(description, path))
+
+
+def create_shared_key_store(directory: Optional[str], max_age_in_seconds: float = DEFAULT_MAX_AGE_IN_SECONDS) \
+        -> Optional[SharedKeyStore]:
+    """
+    :return: the shared key store for the directory or None if no directory is given or it cannot be used
+    """
+    if not directory:
+        return None
+    try:
+        return SharedKeyStore(directory, max_age_in_seconds)
+    except (OSError, ValueError) as e:
+        logger.warning("Shared key store is disabled: %s", e)
+        return None
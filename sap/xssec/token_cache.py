@@ -0,0 +1,95 @@
+"""
+Optional cache of validated tokens. Clients often send the same token with many requests, with a ValidatedTokenCache
+the security context of a token that has been validated before is returned without validating it again.
+Entries are looked up by a SHA-256 digest of the token and the service credentials, and expire with the token,
+but after max_ttl_in_seconds at the latest, so a token is not trusted longer than the keys which verified it
+are cached. Tokens that fail the validation are not cached.
+"""
+import calendar
+import hashlib
+import json
+import time
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from cachetools import TLRUCache
+
+from sap.xssec import metrics
+from sap.xssec.constants import VALIDATED_TOKEN_CACHE_DEFAULT_SIZE, \
+    KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES
+from sap.xssec.security_context_ias import SecurityContextIAS
+
+METRICS_PREFIX = "validated_token_cache"
+
+
+class ValidatedTokenCache(object):
+    """
+    Thread safe cache of security contexts, which can be passed as token_cache to the create_security_context
+    functions. There are a maximum of max_size tokens in the cache, the least recently used token is evicted first.
+    """
+
+    def __init__(self, max_size: int = VALIDATED_TOKEN_CACHE_DEFAULT_SIZE,
+                 max_ttl_in_seconds: float = KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES * 60):
+        self.max_ttl_in_seconds = max_ttl_in_seconds
+        # values are (expiration timestamp, security context)
+        self._cache = TLRUCache(maxsize=max_size, ttu=lambda _key, value, _now: value[0],
+                                 timer=lambda: time.time())
+        self._lock = Lock()
+
+    def get(self, token_type: str, token: str, service_credentials: Dict[str, Any]) -> Optional[Any]:
+        """
+        :param token_type: "xsuaa" or "ias"
+        :return: the security context of the token, or None if it is not cached
+        """
+        digest = _digest(token_type, token, service_credentials)
+        with self._lock:
+            value: Optional[Tuple[float, Any]] = self._cache.get(digest)
+        metrics.increment(METRICS_PREFIX + (".hits" if value is not None else ".misses"))
+        return value[1] if value is not None else None
+
+    def put(self, token_type: str, token: str, service_credentials: Dict[str, Any], security_context: Any):
+        """
+        caches the security context of a validated token until the token expires
+        """
+        expiration_timestamp = _get_expiration_timestamp(security_context)
+        if expiration_timestamp is None:
+            return
+        expiration_timestamp = min(expiration_timestamp, time.time() + self.max_ttl_in_seconds)
+        if expiration_timestamp <= time.time():
+            return
+        digest = _digest(token_type, token, service_credentials)
+        with self._lock:
+            self._cache[digest] = (expiration_timestamp, security_context)
+
+    def get_or_create(self, token_type: str, token: str, service_credentials: Dict[str, Any],
+                      create: Callable[[], Any]) -> Any:
+        """
+        :return: the cached security context of the token, or the one created by validating it with create
+        """
+        security_context = self.get(token_type, token, service_credentials)
+        if security_context is None:
+            security_context = create()
+            self.put(token_type, token, service_credentials, security_context)
+        return security_context
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        with self._lock:
+            self._cache.expire()
+            return len(self._cache)
+
+
+def _digest(token_type: str, token: str, service_credentials: Dict[str, Any]) -> bytes:
+    # the same token may be valid for one service instance and invalid for another
+    credentials = json.dumps(service_credentials, sort_keys=True, default=str)
+    return hashlib.sha256("\0".join((token_type, token, credentials)).encode()).digest()
+
+
+def _get_expiration_timestamp(security_context: Any) -> Optional[float]:
+    if isinstance(security_context, SecurityContextIAS):
+        return security_context.token_payload.get("exp")
+    expiration_date = security_context.get_expiration_date()
+    return calendar.timegm(expiration_date.utctimetuple()) if expiration_date else None
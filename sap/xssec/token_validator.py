@@ -0,0 +1,118 @@
+"""
+Validator of the tokens of one service binding. The config checks, the xsappname, the audience validator and the
+domains which only depend on the service credentials are derived once when the TokenValidator is created,
+validating a token then only does the work which depends on the token.
+"""
+from typing import Any, Callable, Dict, Iterable, List, Tuple, Union
+
+from sap.xssec import key_cache_v2
+from sap.xssec.security_context_async import _create_security_context_ias_async, \
+    _create_security_context_xsuaa_async
+from sap.xssec.security_context_ias import SecurityContextIAS, ServiceBindingIAS
+from sap.xssec.security_context_xsuaa import SecurityContextXSUAA, ServiceBindingXSUAA
+from sap.xssec.token_cache import ValidatedTokenCache
+
+TOKEN_TYPES = ("xsuaa", "ias")
+
+
+class TokenValidator(object):
+    """
+    Creates the security contexts of tokens for one service binding, e.g. once on startup:
+
+        validator = TokenValidator(uaa_service)
+        security_context = validator.validate(access_token)
+    """
+
+    def __init__(self, service_credentials: Dict[str, Any], token_type: str = "xsuaa", key_cache=None,
+                 token_cache: ValidatedTokenCache = None):
+        """
+        :param service_credentials: dict containing the uaa/ias credentials
+        :param token_type: "xsuaa" or "ias"
+        :param key_cache: passed to the security contexts, see create_security_context_xsuaa/_ias
+        :param token_cache: ValidatedTokenCache, which returns the security context of a token validated before
+        :raises ValueError: if the service credentials are invalid
+        """
+        if token_type not in TOKEN_TYPES:
+            raise ValueError('Invalid token type {0}, expected one of {1}'.format(token_type, ", ".join(TOKEN_TYPES)))
+        self.service_credentials = service_credentials
+        self.token_type = token_type
+        self.key_cache = key_cache
+        self.token_cache = token_cache
+        self.binding: Union[ServiceBindingXSUAA, ServiceBindingIAS] = \
+            ServiceBindingXSUAA(service_credentials) if token_type == "xsuaa" else ServiceBindingIAS(service_credentials)
+
+    def validate(self, token) -> Union[SecurityContextXSUAA, SecurityContextIAS]:
+        """
+        :param token: string containing the access_token
+        :return: the security context of the validated token
+        """
+        return self._validate(token, self.key_cache)
+
+    def validate_many(self, tokens: Iterable) -> List[Union[SecurityContextXSUAA, SecurityContextIAS, Exception]]:
+        """
+        Validates a batch of tokens without stopping at the first invalid one. Each verification key is loaded
+        once for the batch, and repeated tokens are validated once.
+
+        :param tokens: strings containing the access_tokens
+        :return: the security context of each valid token or the error raised for it, in the order of tokens
+        """
+        # the default caches are resolved like in the security contexts
+        key_source = _BatchKeySource(self.key_cache or (
+            SecurityContextXSUAA.verificationKeyCache if self.token_type == "xsuaa" else key_cache_v2))
+        tokens = list(tokens)
+        results = {}
+        for token in tokens:
+            if token not in results:
+                try:
+                    results[token] = self._validate(token, key_source)
+                except Exception as e:  # pylint: disable=broad-except
+                    results[token] = e
+        return [results[token] for token in tokens]
+
+    async def validate_async(self, token) -> Union[SecurityContextXSUAA, SecurityContextIAS]:
+        """
+        like validate, but missing verification keys are downloaded without blocking the event loop
+        """
+        create: Callable = _create_security_context_xsuaa_async if self.token_type == "xsuaa" \
+            else _create_security_context_ias_async
+        return await create(token, self.service_credentials, self.key_cache, self.token_cache, binding=self.binding)
+
+    def _validate(self, token, key_cache):
+        if self.token_cache is not None:
+            return self.token_cache.get_or_create(self.token_type, token, self.service_credentials,
+                                                  lambda: self._create(token, key_cache))
+        return self._create(token, key_cache)
+
+    def _create(self, token, key_cache):
+        if self.token_type == "xsuaa":
+            return SecurityContextXSUAA(token, self.service_credentials, key_cache=key_cache, binding=self.binding)
+        return SecurityContextIAS(token, self.service_credentials, key_cache=key_cache, binding=self.binding)
+
+
+class _BatchKeySource(object):
+    """
+    Key source passed to the security contexts of one batch. The key or error for the same key parameters, e.g. the
+    jku and kid, is loaded from the key cache once and returned to all tokens signed with this key.
+    """
+
+    def __init__(self, key_cache):
+        self._key_cache = key_cache
+        self._loaded: Dict[Tuple, Tuple[Any, Exception]] = {}
+
+    def get(self, load: Callable[..., Any], **params):
+        loaded_key = tuple(sorted(params.items()))
+        if loaded_key not in self._loaded:
+            try:
+                self._loaded[loaded_key] = (load(**params), None)
+            except Exception as e:  # pylint: disable=broad-except
+                self._loaded[loaded_key] = (None, e)
+        key, error = self._loaded[loaded_key]
+        if error is not None:
+            raise error
+        return key
+
+    def load_key(self, jku, kid):
+        return self.get(self._key_cache.load_key, jku=jku, kid=kid)
+
+    def get_verification_key_ias(self, **params):
+        return self.get(self._key_cache.get_verification_key_ias, **params)
@@ -0,0 +1,11 @@
+import pytest
+
+from sap.xssec.fetch_policy import reset_circuit_breakers
+
+
+@pytest.fixture(autouse=True)
+def close_circuits():
+    # failed requests of one test must not open the circuit for the hosts of the next tests
+    reset_circuit_breakers()
+    yield
+    reset_circuit_breakers()
@@ -50,3 +50,7 @@ TOKEN_INVALID_AUDIENCE = sign(merge(PAYLOAD, {
 TOKEN_EXPIRED = sign(merge(PAYLOAD, {
         "exp": 1470815434,
 }), headers=HEADER)
+
+TOKEN_NOT_YET_VALID = sign(merge(PAYLOAD, {
+        "nbf": 2101535000,
+}), headers=HEADER)
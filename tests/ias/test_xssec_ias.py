@@ -7,7 +7,7 @@ from sap.xssec import jwt_validation_facade, security_context_ias
 from tests.ias import ias_configs
 from tests.ias.ias_configs import SERVICE_CREDENTIALS
 from tests.ias.ias_tokens import TOKEN_INVALID_ISSUER, VALID_TOKEN, TOKEN_INVALID_AUDIENCE, TOKEN_EXPIRED, PAYLOAD, \
-    HEADER
+    HEADER, TOKEN_NOT_YET_VALID
 from tests.keys import JWT_SIGNING_PUBLIC_KEY
 
 try:
@@ -48,12 +48,44 @@ class IASXSSECTest(unittest.TestCase):
         self.assertEqual("Token's issuer is not found in domain list " + SERVICE_CREDENTIALS["domain"],
                          str(ctx.exception))
 
+    @patch('sap.xssec.security_context_ias.get_verification_key_ias', return_value=JWT_SIGNING_PUBLIC_KEY)
+    def test_issuer_in_domain_list(self, get_verification_key_ias_mock):
+        service_credentials = dict(SERVICE_CREDENTIALS, domains=["accounts.ondemand.com", "accounts400.ondemand.com"])
+        with patch('sap.xssec.security_context_ias.parse_url', wraps=security_context_ias.parse_url) as mock_parse_url:
+            for _ in range(3):
+                xssec.create_security_context_ias(VALID_TOKEN, service_credentials)
+        # the verdict for a known issuer is cached
+        mock_parse_url.assert_called_once()
+
+        with self.assertRaises(ValueError) as ctx:
+            xssec.create_security_context_ias(VALID_TOKEN, dict(SERVICE_CREDENTIALS, domains=["accounts.ondemand.com"]))
+        self.assertEqual("Token's issuer is not found in domain list accounts.ondemand.com", str(ctx.exception))
+
     def test_input_validation_token_expired(self):
         with self.assertRaises(ValueError) as ctx:
             xssec.create_security_context_ias(TOKEN_EXPIRED, ias_configs.SERVICE_CREDENTIALS)
         self.assertEqual("Token has expired", str(ctx.exception))
 
+    @patch('sap.xssec.security_context_ias.get_verification_key_ias')
+    def test_input_validation_token_not_yet_valid(self, get_verification_key_ias_mock):
+        with self.assertRaises(ValueError) as ctx:
+            xssec.create_security_context_ias(TOKEN_NOT_YET_VALID, ias_configs.SERVICE_CREDENTIALS)
+        self.assertEqual("Token is not yet valid", str(ctx.exception))
+        get_verification_key_ias_mock.assert_not_called()
+
+    @patch('sap.xssec.security_context_ias.get_verification_key_ias', return_value=JWT_SIGNING_PUBLIC_KEY)
+    def test_token_is_parsed_once(self, get_verification_key_ias_mock):
+        with patch('sap.xssec.jwt_validation_facade._parse', wraps=jwt_validation_facade._parse) as mock_parse:
+            xssec.create_security_context_ias(VALID_TOKEN, ias_configs.SERVICE_CREDENTIALS)
+        mock_parse.assert_called_once()
+
     def test_input_validation_invalid_audience(self):
         with self.assertRaises(RuntimeError) as ctx:
             xssec.create_security_context_ias(TOKEN_INVALID_AUDIENCE, ias_configs.SERVICE_CREDENTIALS)
         self.assertEqual("Audience Validation Failed", str(ctx.exception))
+
+    def test_input_validation_valid_token_with_key_cache(self):
+        key_cache = MagicMock()
+        key_cache.get_verification_key_ias.return_value = JWT_SIGNING_PUBLIC_KEY
+        xssec.create_security_context_ias(VALID_TOKEN, ias_configs.SERVICE_CREDENTIALS, key_cache=key_cache)
+        key_cache.get_verification_key_ias.assert_called_once_with(**VERIFICATION_KEY_PARAMS)
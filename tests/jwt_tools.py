@@ -1,4 +1,7 @@
+import json
+
 import jwt
+from jwt.utils import base64url_encode
 
 from tests.keys import JWT_SIGNING_PRIVATE_KEY
 
@@ -11,3 +14,10 @@ def sign(payload, headers=None):
         }
     payload = {k: payload[k] for k in payload if payload[k] is not None}
     return jwt.encode(payload, JWT_SIGNING_PRIVATE_KEY, algorithm="RS256", headers=headers)
+
+
+def replace_header(token, header):
+    """ replaces the header of a signed token, e.g. with values pyjwt refuses to encode """
+    segments = token.split(".")
+    segments[0] = base64url_encode(json.dumps(header).encode()).decode()
+    return ".".join(segments)
@@ -0,0 +1,98 @@
+# pylint: disable=missing-docstring,invalid-name,missing-docstring
+import asyncio
+import unittest
+
+import httpx
+import respx
+from httpx import HTTPStatusError, Response
+
+from sap.xssec import constants, fetch_policy
+from sap.xssec.fetch_policy import CircuitOpenError, get_with_retry, get_with_retry_async
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+URL = "https://api.cf.test.com/token_keys"
+
+
+@patch('time.sleep')
+class FetchPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        fetch_policy.reset_circuit_breakers()
+        self.addCleanup(fetch_policy.reset_circuit_breakers)
+
+    @respx.mock
+    def test_transient_errors_are_retried_with_jitter(self, mock_sleep):
+        route = respx.get(URL).mock(side_effect=[Response(503), httpx.ConnectError("refused"), Response(200)])
+
+        self.assertEqual(200, get_with_retry(URL, 2, "test").status_code)
+
+        self.assertEqual(3, route.call_count)
+        delays = [call.args[0] for call in mock_sleep.call_args_list]
+        self.assertEqual(2, len(delays))
+        for retry, delay in enumerate(delays):
+            self.assertTrue(0 <= delay <= 2 ** retry * constants.HTTP_RETRY_BACKOFF_FACTOR)
+
+    @respx.mock
+    def test_client_errors_are_not_retried(self, mock_sleep):
+        route = respx.get(URL).mock(return_value=Response(404))
+
+        with self.assertRaises(HTTPStatusError):
+            get_with_retry(URL, 2, "test")
+        self.assertEqual(1, route.call_count)
+        self.assertFalse(fetch_policy.get_circuit_breaker("api.cf.test.com").is_open())
+
+    @respx.mock
+    def test_not_modified_is_returned_if_allowed(self, mock_sleep):
+        respx.get(URL).mock(return_value=Response(304))
+
+        self.assertEqual(304, get_with_retry(URL, 2, "test", {"If-None-Match": '"v1"'},
+                                             allow_not_modified=True).status_code)
+        with self.assertRaises(HTTPStatusError):
+            get_with_retry(URL, 2, "test")
+
+    @respx.mock
+    @patch('sap.xssec.fetch_policy.HTTP_RETRY_DEADLINE_IN_SECONDS', 0)
+    def test_no_retry_after_deadline(self, mock_sleep):
+        route = respx.get(URL).mock(return_value=Response(503))
+
+        with self.assertRaises(HTTPStatusError):
+            get_with_retry(URL, 2, "test")
+        self.assertEqual(1, route.call_count)
+
+    @respx.mock
+    @patch('time.monotonic', return_value=1000.0)
+    def test_open_circuit_fails_fast(self, mock_monotonic, mock_sleep):
+        route = respx.get(URL).mock(return_value=Response(503))
+        with self.assertRaises(HTTPStatusError):
+            get_with_retry(URL, 2, "test")
+        # the retries stop as soon as the circuit opens
+        with self.assertRaises(CircuitOpenError):
+            get_with_retry(URL, 2, "test")
+        self.assertEqual(constants.HTTP_CIRCUIT_BREAKER_FAILURE_THRESHOLD, route.call_count)
+
+        # the host is not requested while the circuit is open
+        with self.assertRaises(CircuitOpenError):
+            get_with_retry(URL, 2, "test")
+        self.assertEqual(constants.HTTP_CIRCUIT_BREAKER_FAILURE_THRESHOLD, route.call_count)
+        # other hosts are not affected
+        respx.get("https://other.test.com/token_keys").mock(return_value=Response(200))
+        self.assertEqual(200, get_with_retry("https://other.test.com/token_keys", 2, "test").status_code)
+
+        # a single request closes the circuit again after the reset timeout
+        mock_monotonic.return_value += constants.HTTP_CIRCUIT_BREAKER_RESET_TIMEOUT_IN_SECONDS
+        route.mock(return_value=Response(200))
+        self.assertEqual(200, get_with_retry(URL, 2, "test").status_code)
+        self.assertFalse(fetch_policy.get_circuit_breaker("api.cf.test.com").is_open())
+
+    @respx.mock
+    def test_async_transient_errors_are_retried(self, mock_sleep):
+        route = respx.get(URL).mock(side_effect=[httpx.ReadTimeout("timeout"), Response(200)])
+
+        response = asyncio.run(get_with_retry_async(URL, 2, "test"))
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, route.call_count)
@@ -0,0 +1,62 @@
+from unittest.mock import patch
+
+import httpx
+import pytest
+
+from sap.xssec import http_client
+from sap.xssec.constants import HTTP_TIMEOUT_IN_SECONDS
+
+
+def test_client_is_reused():
+    http_client.close_http_client()
+    client = http_client.get_http_client()
+    assert client is http_client.get_http_client()
+    assert HTTP_TIMEOUT_IN_SECONDS == client.timeout.read
+
+
+def test_close_client():
+    client = http_client.get_http_client()
+    http_client.close_http_client()
+    assert client.is_closed
+    assert client is not http_client.get_http_client()
+
+
+def test_configure_client():
+    client = http_client.get_http_client()
+    try:
+        http_client.configure_http_client(timeout=7, headers={"x-test": "test"})
+        configured_client = http_client.get_http_client()
+        assert client.is_closed
+        assert 7 == configured_client.timeout.read
+        assert "test" == configured_client.headers["x-test"]
+    finally:
+        http_client.configure_http_client()
+
+
+def test_new_client_after_fork():
+    client = http_client.get_http_client()
+    with patch('os.getpid', return_value=-1):
+        child_client = http_client.get_http_client()
+    assert child_client is not client
+    assert not client.is_closed
+    assert isinstance(child_client, httpx.Client)
+    client.close()
+
+
+@pytest.mark.parametrize("cache_control, max_age", [
+    (None, None),
+    ("public, max-age=600", 600),
+    ("max-age=\"60\", must-revalidate", 60),
+    ("max-age=invalid", None),
+    ("no-cache", 0),
+    ("private", None),
+])
+def test_get_max_age(cache_control, max_age):
+    headers = {"Cache-Control": cache_control} if cache_control else {}
+    assert max_age == http_client.get_max_age(httpx.Response(200, headers=headers))
+
+
+def test_get_conditional_headers():
+    assert {} == http_client.get_conditional_headers(None, None)
+    assert {"If-None-Match": '"v1"', "If-Modified-Since": "Wed, 21 Oct 2026 07:28:00 GMT"} == \
+        http_client.get_conditional_headers('"v1"', "Wed, 21 Oct 2026 07:28:00 GMT")
@@ -1,8 +1,14 @@
+import os
+import tempfile
+import threading
+from time import sleep
+
 from httpx import HTTPStatusError, Response
 from httpx import TimeoutException
 
 from sap.xssec import constants
 from sap.xssec.key_cache import KeyCache
+from sap.xssec.key_cache_v2 import VerificationKeyCache
 import unittest
 try:
     from unittest.mock import MagicMock, patch
@@ -16,7 +22,7 @@ threadErrors = False
 
 
 @patch('time.time', return_value=MOCKED_CURRENT_TIME)
-@patch('sap.xssec.key_cache.httpx.get', return_value=MagicMock())
+@patch('httpx.Client.get', return_value=MagicMock())
 class CacheTest(unittest.TestCase):
 
     def setUp(self):
@@ -59,24 +65,103 @@ class CacheTest(unittest.TestCase):
         mock_requests.return_value = self.mock
         self.mock.json.side_effect = [HTTP_SUCCESS_DUMMY, HTTP_SUCCESS]
 
+        mock_time.return_value = MOCKED_CURRENT_TIME - (constants.KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES +
+                                                        constants.KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES + 1) * 60
+        self.cache.load_key("jku1", "key-id-1")
+        mock_time.return_value = MOCKED_CURRENT_TIME
+
+        key = self.cache.load_key("jku1", "key-id-1")
+
+        self.assert_key_equal(KEY_ID_1, key)
+        self.assertEqual(2, mock_requests.call_count)
+
+    def test_expired_key_within_grace_period_refreshed_in_background(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.side_effect = [HTTP_SUCCESS_DUMMY, HTTP_SUCCESS]
+
         mock_time.return_value = MOCKED_CURRENT_TIME - (constants.KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES + 1) * 60
         self.cache.load_key("jku1", "key-id-1")
         mock_time.return_value = MOCKED_CURRENT_TIME
 
         key = self.cache.load_key("jku1", "key-id-1")
+        self.assert_key_equal("dummy-key", key)
+        self.wait_for_background_refresh()
 
+        key = self.cache.load_key("jku1", "key-id-1")
         self.assert_key_equal(KEY_ID_1, key)
         self.assertEqual(2, mock_requests.call_count)
 
-    def test_kid_does_not_match(self, mock_requests, mock_time):
+    def test_failed_background_refresh_keeps_expired_key(self, mock_requests, mock_time):
+        response = Response(status_code=500)
+        mock_requests.side_effect = [self.mock, HTTPStatusError(message=..., request=..., response=response)]
+        self.mock.json.return_value = HTTP_SUCCESS_DUMMY
+
+        mock_time.return_value = MOCKED_CURRENT_TIME - (constants.KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES + 1) * 60
+        self.cache.load_key("jku1", "key-id-1")
+        mock_time.return_value = MOCKED_CURRENT_TIME
+
+        self.cache.load_key("jku1", "key-id-1")
+        self.wait_for_background_refresh()
+
+        key = self.cache.load_key("jku1", "key-id-1")
+        self.assert_key_equal("dummy-key", key)
+        self.wait_for_background_refresh()
+
+    def test_other_kid_of_cached_keys_does_not_load_key(self, mock_requests, mock_time):
         mock_requests.return_value = self.mock
         self.mock.json.side_effect = [HTTP_SUCCESS_DUMMY, HTTP_SUCCESS]
         self.cache.load_key("jku2", "key-id-1")
 
         key = self.cache.load_key("jku2", "key-id-0")
 
+        self.assert_key_equal("dummy-key", key)
+        self.assertEqual(1, mock_requests.call_count)
+
+    def test_kid_does_not_match(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.side_effect = [{"keys": [{"kid": "key-id-1", "value": "dummy-key"}]}, HTTP_SUCCESS]
+        mock_time.return_value = MOCKED_CURRENT_TIME - constants.KEYCACHE_DEFAULT_MIN_REFRESH_INTERVAL_IN_SECONDS
+        self.cache.load_key("jku2", "key-id-1")
+        mock_time.return_value = MOCKED_CURRENT_TIME
+
+        key = self.cache.load_key("jku2", "key-id-0")
+
         self.assert_key_equal(KEY_ID_0, key)
         self.assertEqual(2, mock_requests.call_count)
+        self.assertEqual(1, len(self.cache.key_cache))
+
+    def test_kid_does_not_match_recently_loaded_keys(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS_DUMMY
+        self.cache.load_key("jku1", "key-id-1")
+
+        for kid in ["unknown-kid-1", "unknown-kid-2"]:
+            with self.assertRaises(ValueError):
+                self.cache.load_key("jku1", kid)
+
+        self.assertEqual(1, mock_requests.call_count)
+
+    def test_missing_kid_is_not_loaded_again(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS
+
+        for _ in range(0, 10):
+            with self.assertRaises(ValueError):
+                self.cache.load_key("jku1", "key-id-3")
+
+        mock_requests.assert_called_once_with("jku1", timeout=constants.HTTP_TIMEOUT_IN_SECONDS)
+
+    def test_client_error_is_not_loaded_again(self, mock_requests, mock_time):
+        response = Response(status_code=404)
+        mock_requests.side_effect = HTTPStatusError(message=..., request=..., response=response)
+
+        with self.assertRaises(HTTPStatusError):
+            self.cache.load_key("jku1", "key-id-1")
+        for _ in range(0, 10):
+            with self.assertRaises(ValueError):
+                self.cache.load_key("jku1", "key-id-1")
+
+        self.assertEqual(1, mock_requests.call_count)
 
     def test_cache_max_size(self, mock_requests, mock_time):
         mock_requests.return_value = self.mock
@@ -84,47 +169,74 @@ class CacheTest(unittest.TestCase):
         for i in range(0, constants.KEYCACHE_DEFAULT_CACHE_SIZE):
             self.cache.load_key("jku-" + str(i), "key-id-1")
 
-        self.assertEqual(len(self.cache._cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
-        self.assertTrue(KeyCache._create_cache_key("jku-0", "key-id-1") in self.cache._cache)
+        self.assertEqual(len(self.cache.key_cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
+        self.assertTrue(("jku-0",) in self.cache.key_cache)
 
         self.mock.json.return_value = HTTP_SUCCESS
         key = self.cache.load_key("jku1", "key-id-0")
 
         self.assert_key_equal(KEY_ID_0, key)
         self.assertEqual(constants.KEYCACHE_DEFAULT_CACHE_SIZE + 1, mock_requests.call_count)
-        self.assertEqual(len(self.cache._cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
+        self.assertEqual(len(self.cache.key_cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
         # assert that least recently inserted key got deleted
-        self.assertFalse(KeyCache._create_cache_key("jku-0", "key-id-1") in self.cache._cache)
+        self.assertFalse(("jku-0",) in self.cache.key_cache)
 
     def test_update_increases_insertion_order(self, mock_requests, mock_time):
         mock_requests.return_value = self.mock
         self.mock.json.return_value = HTTP_SUCCESS_DUMMY
         for i in range(0, constants.KEYCACHE_DEFAULT_CACHE_SIZE):
             self.cache.load_key("jku-" + str(i), "key-id-1")
-        self.assertEqual(len(self.cache._cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
-        self.assertTrue(KeyCache._create_cache_key("jku-0", "key-id-1") in self.cache._cache)
+        self.assertEqual(len(self.cache.key_cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
+        self.assertTrue(("jku-0",) in self.cache.key_cache)
 
         # first cache entry is invalid -> must be updated
-        self.cache._cache[KeyCache._create_cache_key("jku-0", "key-id-1")].insert_timestamp = 0
+        self.cache.key_cache[("jku-0",)].fetch_timestamp = 0
 
         self.mock.json.return_value = HTTP_SUCCESS
         # update first cache entry -> should not deleted if new key is added
         self.cache.load_key("jku-0", "key-id-1")
-        self.assertTrue(KeyCache._create_cache_key("jku-0", "key-id-1") in self.cache._cache)
-        self.assertTrue(KeyCache._create_cache_key("jku-1", "key-id-1") in self.cache._cache)
+        self.assertTrue(("jku-0",) in self.cache.key_cache)
+        self.assertTrue(("jku-1",) in self.cache.key_cache)
 
         # add new key
         self.cache.load_key("jku1", "key-id-0")
 
-        self.assertTrue(KeyCache._create_cache_key("jku-0", "key-id-1") in self.cache._cache)
-        self.assertFalse(KeyCache._create_cache_key("jku-1", "key-id-1") in self.cache._cache)
-        self.assertEqual(len(self.cache._cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
+        self.assertTrue(("jku-0",) in self.cache.key_cache)
+        self.assertFalse(("jku-1",) in self.cache.key_cache)
+        self.assertEqual(len(self.cache.key_cache), constants.KEYCACHE_DEFAULT_CACHE_SIZE)
 
-    @patch('sap.xssec.key_cache.CacheEntry.is_valid', return_value=False)
+    def test_cached_read_marks_key_as_recently_used(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS_DUMMY
+        for i in range(0, constants.KEYCACHE_DEFAULT_CACHE_SIZE):
+            self.cache.load_key("jku-" + str(i), "key-id-1")
+
+        # reading the oldest key keeps it in the cache
+        self.cache.load_key("jku-0", "key-id-1")
+        self.cache.load_key("jku1", "key-id-1")
+
+        self.assertTrue(("jku-0",) in self.cache.key_cache)
+        self.assertFalse(("jku-1",) in self.cache.key_cache)
+
+    def test_configured_limits(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS
+        cache = KeyCache(max_size=2, expiration_time_in_minutes=1, grace_period_in_minutes=0,
+                         http_timeout_in_seconds=5)
+        for i in range(0, 3):
+            cache.load_key("jku-" + str(i), "key-id-1")
+        self.assertEqual(2, len(cache.key_cache))
+        mock_requests.assert_called_with("jku-2", timeout=5)
+
+        # the key expires after one minute without grace period
+        mock_time.return_value = MOCKED_CURRENT_TIME + 61
+        cache.load_key("jku-2", "key-id-1")
+        self.assertEqual(4, mock_requests.call_count)
+
+    @patch('sap.xssec.key_cache_v2.CacheEntry.is_stale', return_value=True)
     def test_parallel_access_works(self, mock_valid, mock_requests, mock_time):
         # All entries are invalid, so each load updates the cache.
         # This leads to problems if the threads are not correctly synchronized.
-        import threading
         mock_requests.return_value = self.mock
         self.mock.json.return_value = HTTP_SUCCESS
 
@@ -144,9 +256,163 @@ class CacheTest(unittest.TestCase):
             t.start()
         for t in threads:
             t.join()
+        self.wait_for_background_refresh()
 
         self.assertFalse(threadErrors)
 
+    def test_parallel_misses_share_one_request(self, mock_requests, mock_time):
+
+        def slow_get(*args, **kwargs):
+            sleep(0.2)
+            return self.mock
+        mock_requests.side_effect = slow_get
+        self.mock.json.return_value = HTTP_SUCCESS
+
+        threads = [threading.Thread(target=self.cache.load_key, args=["jku1", "key-id-0"]) for _ in range(0, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, mock_requests.call_count)
+        self.assertEqual({}, self.cache._load_locks.locks)
+
+    def test_parallel_misses_for_different_kids_share_one_request(self, mock_requests, mock_time):
+
+        def slow_get(*args, **kwargs):
+            sleep(0.2)
+            return self.mock
+        mock_requests.side_effect = slow_get
+        self.mock.json.return_value = HTTP_SUCCESS
+        keys = []
+
+        threads = [threading.Thread(target=lambda kid: keys.append(self.cache.load_key("jku1", kid)),
+                                    args=["key-id-" + str(i % 2)]) for i in range(0, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(10, len(keys))
+        self.assertEqual(1, mock_requests.call_count)
+
+    @patch('time.sleep')
+    def test_parallel_misses_share_failed_request(self, mock_sleep, mock_requests, mock_time):
+
+        def failing_get(*args, **kwargs):
+            # fail once all threads are waiting for the request
+            while sum(lock.waiters for lock in self.cache._load_locks.locks.values()) < 10:
+                threading.Event().wait(0.01)
+            raise TimeoutException("timeout")
+        mock_requests.side_effect = failing_get
+        errors = []
+
+        def load():
+            try:
+                self.cache.load_key("jku1", "key-id-0")
+            except TimeoutException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=load) for _ in range(0, 10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # one request with its retries, all waiting threads get its error
+        self.assertEqual(10, len(errors))
+        self.assertEqual(constants.HTTP_RETRY_NUMBER_RETRIES + 1, mock_requests.call_count)
+        self.assertEqual({}, self.cache._load_locks.locks)
+
+    def test_cached_read_not_blocked_by_other_miss(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS
+        self.cache.load_key("jku1", "key-id-0")
+
+        fetch_started = threading.Event()
+        release_fetch = threading.Event()
+
+        def blocking_get(*args, **kwargs):
+            fetch_started.set()
+            release_fetch.wait(5)
+            return self.mock
+        mock_requests.side_effect = blocking_get
+
+        t = threading.Thread(target=self.cache.load_key, args=["jku2", "key-id-0"])
+        t.start()
+        fetch_started.wait(5)
+        try:
+            key = self.cache.load_key("jku1", "key-id-0")
+            self.assert_key_equal(KEY_ID_0, key)
+        finally:
+            release_fetch.set()
+            t.join()
+
+    def test_keys_restored_from_cache_file(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = os.path.join(directory, "keys.json")
+            KeyCache(cache_file=cache_file).load_key("jku1", "key-id-1")
+
+            # a new cache, e.g. after a restart, uses the keys of the file without requesting them
+            restarted_cache = KeyCache(cache_file=cache_file)
+            self.assert_key_equal(KEY_ID_0, restarted_cache.load_key("jku1", "key-id-0"))
+            self.assertEqual(1, mock_requests.call_count)
+
+            # expired keys are not restored
+            mock_time.return_value = MOCKED_CURRENT_TIME + (constants.KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES +
+                                                            constants.KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES + 1) * 60
+            KeyCache(cache_file=cache_file).load_key("jku1", "key-id-0")
+            self.assertEqual(2, mock_requests.call_count)
+
+    def test_cached_read_while_saving_cache_file(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS
+        with tempfile.TemporaryDirectory() as directory:
+            cache = KeyCache(cache_file=os.path.join(directory, "keys.json"))
+            cache.load_key("jku1", "key-id-0")
+            readers = []
+            save = cache.cache_file.save
+
+            def read_while_saving(*args):
+                # a cached read of another thread while the cache is saved
+                reader = threading.Thread(target=cache.load_key, args=["jku1", "key-id-0"])
+                readers.append(reader)
+                reader.start()
+                reader.join(1)
+                save(*args)
+
+            with patch.object(cache.cache_file, "save", side_effect=read_while_saving):
+                cache.load_key("jku2", "key-id-0")
+
+            self.assertFalse(readers[0].is_alive())
+            self.assertEqual(2, mock_requests.call_count)
+
+    def test_cache_file_shared_with_verification_key_cache(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS
+        with tempfile.TemporaryDirectory() as directory:
+            cache_file = os.path.join(directory, "keys.json")
+            KeyCache(cache_file=cache_file).load_key("jku1", "key-id-0")
+            VerificationKeyCache(cache_file=cache_file).load_key("jku2", "key-id-0")
+
+            # each cache restores its own key sets
+            self.assert_key_equal(KEY_ID_0, KeyCache(cache_file=cache_file).load_key("jku1", "key-id-0"))
+            VerificationKeyCache(cache_file=cache_file).load_key("jku2", "key-id-0")
+            self.assertEqual(2, mock_requests.call_count)
+
+    def test_keys_shared_between_caches(self, mock_requests, mock_time):
+        mock_requests.return_value = self.mock
+        self.mock.json.return_value = HTTP_SUCCESS
+        with tempfile.TemporaryDirectory() as directory:
+            # caches of different worker processes using the same directory
+            KeyCache(shared_key_store_directory=directory).load_key("jku1", "key-id-1")
+            key = KeyCache(shared_key_store_directory=directory).load_key("jku1", "key-id-0")
+
+            self.assert_key_equal(KEY_ID_0, key)
+            self.assertEqual(1, mock_requests.call_count)
+
     def test_get_returns_empty(self, mock_requests, mock_time):
         mock_requests.return_value = self.mock
         self.mock.json.return_value = {}
@@ -165,6 +431,44 @@ class CacheTest(unittest.TestCase):
 
         mock_requests.assert_called_once_with("jku1", timeout=constants.HTTP_TIMEOUT_IN_SECONDS)
 
+    def test_server_max_age_and_revalidation(self, mock_requests, mock_time):
+        response = MagicMock(status_code=200, headers={"ETag": '"v1"', "Cache-Control": "max-age=3600"})
+        response.json.return_value = HTTP_SUCCESS
+        not_modified = MagicMock(status_code=304, headers={"Cache-Control": "max-age=3600"})
+        mock_requests.side_effect = [response, not_modified]
+
+        key = self.cache.load_key("jku1", "key-id-1")
+        self.assertEqual(3600, self.cache.key_cache[("jku1",)].expiration_time_in_seconds)
+
+        # still valid after the default expiration time
+        mock_time.return_value = MOCKED_CURRENT_TIME + constants.KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES * 60 + 1
+        self.assertIs(key, self.cache.load_key("jku1", "key-id-1"))
+        self.assertEqual(1, mock_requests.call_count)
+
+        # expired keys are revalidated and not parsed again if not modified
+        mock_time.return_value = MOCKED_CURRENT_TIME + 3600 + constants.KEYCACHE_DEFAULT_CACHE_ENTRY_GRACE_PERIOD_IN_MINUTES * 60 + 1
+        self.assertIs(key, self.cache.load_key("jku1", "key-id-1"))
+        mock_requests.assert_called_with("jku1", timeout=constants.HTTP_TIMEOUT_IN_SECONDS,
+                                         headers={"If-None-Match": '"v1"'})
+        self.assertEqual(1, response.json.call_count)
+        entry = self.cache.key_cache[("jku1",)]
+        self.assertEqual('"v1"', entry.etag)
+        self.assertEqual(mock_time.return_value, entry.fetch_timestamp)
+
+    def test_server_max_age_is_bounded(self, mock_requests, mock_time):
+        mock_requests.return_value = MagicMock(status_code=200, headers={"Cache-Control": "max-age=1"})
+        mock_requests.return_value.json.return_value = HTTP_SUCCESS
+        self.cache.load_key("jku1", "key-id-1")
+        self.assertEqual(constants.KEYCACHE_MIN_EXPIRATION_TIME_IN_SECONDS,
+                         self.cache.key_cache[("jku1",)].expiration_time_in_seconds)
+
+    def wait_for_background_refresh(self):
+        for _ in range(0, 100):
+            if not self.cache._refreshing:
+                return
+            sleep(0.05)
+        self.fail("background refresh did not finish")
+
     def assert_key_equal(self, key1, key2):
         self.assertEqual(strip_white_space(key1), strip_white_space(key2))
 
@@ -0,0 +1,65 @@
+import json
+import os
+import tempfile
+import unittest
+
+from sap.xssec.key_cache_file import KeyCacheFile
+
+
+class KeyCacheFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.path = os.path.join(self.directory.name, "keys.json")
+        self.cache_file = KeyCacheFile(self.path)
+
+    def test_load_missing_file(self):
+        self.assertEqual([], self.cache_file.load("xsuaa"))
+
+    def test_save_and_load(self):
+        self.cache_file.save("xsuaa", [("jku1", 1.5, {"key-id-0": "key-0"})])
+        self.cache_file.save("ias", [(("issuer", "app_tid", None, "client_id"), 2.5, {"kid": "key"})])
+
+        self.assertEqual([("jku1", 1.5, {"key-id-0": "key-0"})], self.cache_file.load("xsuaa"))
+        self.assertEqual([(("issuer", "app_tid", None, "client_id"), 2.5, {"kid": "key"})],
+                         self.cache_file.load("ias"))
+
+    def test_save_replaces_section(self):
+        self.cache_file.save("xsuaa", [("jku1", 1.5, {"key-id-0": "key-0"})])
+        self.cache_file.save("xsuaa", [("jku2", 2.5, {"key-id-1": "key-1"})])
+
+        self.assertEqual([("jku2", 2.5, {"key-id-1": "key-1"})], self.cache_file.load("xsuaa"))
+        self.assertEqual(["keys.json"], os.listdir(self.directory.name))
+
+    def test_load_invalid_file(self):
+        with open(self.path, "w") as f:
+            f.write("{invalid")
+        self.assertEqual([], self.cache_file.load("xsuaa"))
+
+    def test_load_ignores_invalid_entries(self):
+        with open(self.path, "w") as f:
+            json.dump({"version": 1, "xsuaa": [{"cache_key": "jku1"},
+                                               {"cache_key": "jku2", "fetch_timestamp": 1, "keys": {}}]}, f)
+        self.assertEqual([("jku2", 1.0, {})], self.cache_file.load("xsuaa"))
+
+    def test_save_to_missing_directory_does_not_raise(self):
+        cache_file = KeyCacheFile(os.path.join(self.directory.name, "missing", "keys.json"))
+        cache_file.save("xsuaa", [("jku1", 1.5, {"key-id-0": "key-0"})])
+        self.assertEqual([], cache_file.load("xsuaa"))
+
+    def test_load_file_writable_by_others(self):
+        self.cache_file.save("xsuaa", [("jku1", 1.5, {"key-id-0": "key-0"})])
+        os.chmod(self.path, 0o666)
+        self.assertEqual([], KeyCacheFile(self.path).load("xsuaa"))
+
+    def test_directory_writable_by_others_is_not_used(self):
+        os.chmod(self.directory.name, 0o777)
+        with self.assertLogs("sap.xssec.key_cache_file", level="WARNING") as logs:
+            cache_file = KeyCacheFile(self.path)
+            cache_file.save("xsuaa", [("jku1", 1.5, {"key-id-0": "key-0"})])
+            cache_file.save("xsuaa", [("jku2", 2.5, {"key-id-1": "key-1"})])
+            self.assertEqual([], cache_file.load("xsuaa"))
+
+        self.assertEqual(1, len(logs.output))
+        self.assertEqual([], os.listdir(self.directory.name))
@@ -1,11 +1,9 @@
 import threading
-from time import sleep
-from typing import List, Callable
 
 import pytest
 from httpx import Response, HTTPStatusError, Request
 
-from sap.xssec.key_tools import jwk_to_pem
+from sap.xssec.key_tools import jwk_to_public_key
 from tests.ias.ias_configs import JWKS, WELL_KNOWN, SERVICE_CREDENTIALS
 from tests.ias.ias_tokens import PAYLOAD, HEADER, merge
 
@@ -18,39 +16,10 @@ VERIFICATION_KEY_PARAMS = {
 }
 
 
-def test_thread_safe_decorator():
-    sum = 0
-
-    def add_to_sum(x: int):
-        nonlocal sum
-        local_sum = sum
-        sleep(0.1)
-        sum = local_sum + x
-
-    def run_func_in_threads(func: Callable[[int], None], func_args: List[int]):
-        threads = []
-        for arg in func_args:
-            t = threading.Thread(target=func, args=[arg])
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
-
-    # not thread-safe without decorator
-    sum = 0
-    run_func_in_threads(add_to_sum, [1] * 10)
-    assert 10 != sum
-
-    # thread-safe when args are same
-    sum = 0
-    from sap.xssec.key_cache_v2 import thread_safe_by_args
-    run_func_in_threads(thread_safe_by_args(add_to_sum), [1] * 10)
-    assert 10 == sum
-
-    # not thread-safe when args are different
-    sum = 0
-    run_func_in_threads(thread_safe_by_args(add_to_sum), list(range(1, 11)))
-    assert 55 != sum
+@pytest.fixture(autouse=True)
+def clear_jwks_uri_cache():
+    from sap.xssec.key_cache_v2 import jwks_uri_cache
+    jwks_uri_cache.clear()
 
 
 @pytest.fixture
@@ -74,11 +43,11 @@ def jwk_endpoint_mock(respx_mock):
 def test_get_verification_key_ias_should_return_key(well_known_endpoint_mock, jwk_endpoint_mock):
     from sap.xssec.key_cache_v2 import get_verification_key_ias, key_cache
     key_cache.clear()
-    pem_key = get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    key = get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
     assert well_known_endpoint_mock.called
     assert jwk_endpoint_mock.called
     jwk = next(filter(lambda k: k["kid"] == HEADER["kid"], JWKS["keys"]))
-    assert jwk_to_pem(jwk) == pem_key
+    assert jwk_to_public_key(jwk).public_numbers() == key.public_numbers()
 
 
 def test_get_verification_key_ias_should_cache_key(well_known_endpoint_mock, jwk_endpoint_mock):
@@ -90,28 +59,76 @@ def test_get_verification_key_ias_should_cache_key(well_known_endpoint_mock, jwk
 
     for _ in range(0, 10):
         get_verification_key_ias(**merge(VERIFICATION_KEY_PARAMS, {"app_tid": "another-app-tid"}))
-    assert 2 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+    assert 2 == jwk_endpoint_mock.call_count
 
     for _ in range(0, 10):
         get_verification_key_ias(**merge(VERIFICATION_KEY_PARAMS, {"azp": "another-azp"}))
-    assert 3 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+    assert 3 == jwk_endpoint_mock.call_count
 
     for _ in range(0, 10):
         get_verification_key_ias(**merge(VERIFICATION_KEY_PARAMS, {"client_id": "another-client-id"}))
-    assert 4 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+    assert 4 == jwk_endpoint_mock.call_count
 
+    # another kid of an already downloaded key set is served from the cache
     for _ in range(0, 10):
         get_verification_key_ias(**merge(VERIFICATION_KEY_PARAMS, {"kid": "another-kid"}))
-    assert 5 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+    assert 4 == jwk_endpoint_mock.call_count
+
+    # the openid configuration of the issuer is requested only once
+    assert 1 == well_known_endpoint_mock.call_count
+
+
+def test_get_verification_key_ias_should_refresh_stale_key_in_background(well_known_endpoint_mock,
+                                                                        jwk_endpoint_mock):
+    from sap.xssec import key_cache_v2
+    from sap.xssec.constants import KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES
+    key_cache_v2.key_cache.clear()
+    key = key_cache_v2.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    entry = next(iter(key_cache_v2.key_cache.values()))
+    entry.fetch_timestamp -= KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES * 60 + 1
+
+    # stale key is returned immediately and refreshed by a background thread
+    assert key is key_cache_v2.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    for _ in range(0, 100):
+        if not key_cache_v2.default_key_cache._refreshing:
+            break
+        sleep(0.05)
+    assert 1 == well_known_endpoint_mock.call_count
+    assert 2 == jwk_endpoint_mock.call_count
+    assert not next(iter(key_cache_v2.key_cache.values())).is_stale()
 
 
 def test_get_verification_key_ias_should_throw_error_for_missing_key(well_known_endpoint_mock, jwk_endpoint_mock):
-    from sap.xssec.key_cache_v2 import get_verification_key_ias, key_cache
+    from sap.xssec.key_cache_v2 import get_verification_key_ias, key_cache, missing_key_cache
     key_cache.clear()
+    missing_key_cache.clear()
     for _ in range(0, 10):
         with pytest.raises(ValueError):
             get_verification_key_ias(**merge(VERIFICATION_KEY_PARAMS, {"kid": "non-existing-kid"}))
-    assert 10 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+    # the missing key is remembered and not requested again
+    assert 1 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+
+    # other unknown kids are not requested either, as the key set has just been downloaded
+    missing_key_cache.clear()
+    for i in range(0, 10):
+        with pytest.raises(ValueError):
+            get_verification_key_ias(**merge(VERIFICATION_KEY_PARAMS, {"kid": "non-existing-kid-{}".format(i)}))
+    assert 1 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+
+
+def test_get_verification_key_ias_should_not_request_keys_again_after_client_error(well_known_endpoint_mock,
+                                                                                   respx_mock):
+    jwk_endpoint_mock = respx_mock.get(WELL_KNOWN["jwks_uri"]).mock(return_value=Response(404))
+    from sap.xssec.key_cache_v2 import get_verification_key_ias, key_cache, missing_key_cache
+    key_cache.clear()
+    missing_key_cache.clear()
+    with pytest.raises(HTTPStatusError):
+        get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    for _ in range(0, 10):
+        with pytest.raises(ValueError):
+            get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    missing_key_cache.clear()
+    assert 1 == jwk_endpoint_mock.call_count
 
 
 def test_get_verification_key_ias_should_raise_http_error(respx_mock):
@@ -121,3 +138,237 @@ def test_get_verification_key_ias_should_raise_http_error(respx_mock):
     key_cache.clear()
     with pytest.raises(HTTPStatusError):
         get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+
+
+def test_get_verification_key_ias_should_restore_keys_from_cache_file(well_known_endpoint_mock, jwk_endpoint_mock,
+                                                                      tmp_path):
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    cache_file = str(tmp_path / "keys.json")
+    key = VerificationKeyCache(cache_file=cache_file).get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+
+    # simulate a restart
+    restored_key = VerificationKeyCache(cache_file=cache_file).get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+
+    assert key.public_numbers() == restored_key.public_numbers()
+    assert 1 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+
+
+def test_keys_are_serialized_once_for_cache_file(tmp_path):
+    from unittest.mock import patch
+    from sap.xssec import key_cache_v2
+    cache = key_cache_v2.VerificationKeyCache(cache_file=str(tmp_path / "keys.json"))
+    key = jwk_to_public_key(JWKS["keys"][0])
+    with patch("sap.xssec.key_cache_v2.public_key_to_pem", wraps=key_cache_v2.public_key_to_pem) as to_pem:
+        cache._set_cache_entry(("jku1",), {"kid1": key})
+        cache._set_cache_entry(("jku2",), {"kid2": key})
+        cache._set_cache_entry(("jku3",), {"kid3": key})
+
+    # each key set is serialized when it is added, not again whenever the file is written
+    assert 3 == to_pem.call_count
+    assert 3 == len(key_cache_v2.KeyCacheFile(str(tmp_path / "keys.json")).load(cache.CACHE_FILE_SECTION))
+
+
+def test_get_verification_key_ias_async_should_download_key_once(well_known_endpoint_mock, jwk_endpoint_mock):
+    import asyncio
+    from sap.xssec import key_cache_v2
+    key_cache_v2.key_cache.clear()
+    key_cache_v2.missing_key_cache.clear()
+    assert not key_cache_v2.is_verification_key_ias_cached(**VERIFICATION_KEY_PARAMS)
+
+    async def get_keys():
+        return await asyncio.gather(
+            *[key_cache_v2.get_verification_key_ias_async(**VERIFICATION_KEY_PARAMS) for _ in range(10)])
+
+    keys = asyncio.run(get_keys())
+    assert 1 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+    assert all(key is keys[0] for key in keys)
+    assert keys[0] is key_cache_v2.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    assert key_cache_v2.is_verification_key_ias_cached(**VERIFICATION_KEY_PARAMS)
+
+
+def test_prefetch_verification_key_url_ias(well_known_endpoint_mock, jwk_endpoint_mock):
+    from sap.xssec import key_cache_v2
+    key_cache_v2.key_cache.clear()
+    key_cache_v2.missing_key_cache.clear()
+    assert WELL_KNOWN["jwks_uri"] == key_cache_v2.prefetch_verification_key_url_ias(SERVICE_CREDENTIALS)
+    key_cache_v2.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    assert 1 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+
+
+def test_jwks_uri_is_requested_again_if_key_set_is_not_found(well_known_endpoint_mock, respx_mock):
+    jwk_endpoint_mock = respx_mock.get(WELL_KNOWN["jwks_uri"]).mock(return_value=Response(404))
+    from sap.xssec import key_cache_v2
+    key_cache_v2.key_cache.clear()
+    key_cache_v2.missing_key_cache.clear()
+    with pytest.raises(HTTPStatusError):
+        key_cache_v2.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    assert PAYLOAD["iss"] not in key_cache_v2.jwks_uri_cache
+    key_cache_v2.missing_key_cache.clear()
+    with pytest.raises(HTTPStatusError):
+        key_cache_v2.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    assert 2 == well_known_endpoint_mock.call_count == jwk_endpoint_mock.call_count
+
+
+def test_verification_key_cache_should_use_own_limits(well_known_endpoint_mock, jwk_endpoint_mock):
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    cache = VerificationKeyCache(max_size=1, expiration_time_in_minutes=1, grace_period_in_minutes=0)
+    cache.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    cache.get_verification_key_ias(**merge(VERIFICATION_KEY_PARAMS, {"app_tid": "another-app-tid"}))
+    assert 1 == len(cache.key_cache)
+
+    # the key set of the first tenant has been evicted
+    cache.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    assert 3 == jwk_endpoint_mock.call_count
+
+    # the key set expires after one minute without grace period
+    next(iter(cache.key_cache.values())).fetch_timestamp -= 61
+    cache.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    assert 4 == jwk_endpoint_mock.call_count
+
+
+def test_expired_key_set_is_revalidated(well_known_endpoint_mock, respx_mock):
+    def jwks_response(request: Request):
+        if request.headers.get("If-None-Match") == '"v1"':
+            return Response(304, headers={"Cache-Control": "max-age=600"})
+        return Response(200, json=JWKS, headers={"ETag": '"v1"', "Cache-Control": "max-age=600"})
+
+    jwk_endpoint_mock = respx_mock.get(WELL_KNOWN["jwks_uri"]).mock(side_effect=jwks_response)
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    cache = VerificationKeyCache(grace_period_in_minutes=0)
+    key = cache.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    entry = next(iter(cache.key_cache.values()))
+    assert 600 == entry.expiration_time_in_seconds
+
+    entry.fetch_timestamp -= 601
+    assert key is cache.get_verification_key_ias(**VERIFICATION_KEY_PARAMS)
+    assert 2 == jwk_endpoint_mock.call_count
+    assert not next(iter(cache.key_cache.values())).is_stale()
+
+
+XSUAA_JKU = "https://api.cf.test.com/token_keys?zid=test-idz"
+
+
+def test_get_verification_key_xsuaa_should_cache_key_set(respx_mock):
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    from sap.xssec.key_tools import pem_to_public_key
+    from tests.http_responses import HTTP_SUCCESS, KEY_ID_0
+    token_keys_mock = respx_mock.get(XSUAA_JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+    cache = VerificationKeyCache()
+
+    key = cache.get_verification_key_xsuaa(XSUAA_JKU, "key-id-0")
+    assert pem_to_public_key(KEY_ID_0).public_numbers() == key.public_numbers()
+    assert cache.is_verification_key_xsuaa_cached(XSUAA_JKU, "key-id-1")
+    for _ in range(0, 10):
+        assert key is cache.load_key(XSUAA_JKU, "key-id-0")
+    assert 1 == token_keys_mock.call_count
+
+
+def test_get_verification_key_xsuaa_should_retry(respx_mock):
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    from tests.http_responses import HTTP_SUCCESS
+    token_keys_mock = respx_mock.get(XSUAA_JKU).mock(
+        side_effect=[Response(503), Response(200, json=HTTP_SUCCESS)])
+    cache = VerificationKeyCache()
+
+    cache.get_verification_key_xsuaa(XSUAA_JKU, "key-id-0")
+    assert 2 == token_keys_mock.call_count
+
+
+def test_get_verification_key_xsuaa_should_not_remember_throttled_kid(respx_mock):
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    from tests.http_responses import HTTP_SUCCESS
+    token_keys_mock = respx_mock.get(XSUAA_JKU).mock(
+        side_effect=[Response(429), Response(200, json=HTTP_SUCCESS)])
+    cache = VerificationKeyCache()
+
+    with pytest.raises(HTTPStatusError):
+        cache.get_verification_key_xsuaa(XSUAA_JKU, "key-id-0")
+
+    # too many requests does not mean that the kid does not exist
+    assert cache.get_verification_key_xsuaa(XSUAA_JKU, "key-id-0") is not None
+    assert 2 == token_keys_mock.call_count
+
+
+def test_get_verification_key_xsuaa_async_should_cache_key_set(respx_mock):
+    import asyncio
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    from tests.http_responses import HTTP_SUCCESS
+    token_keys_mock = respx_mock.get(XSUAA_JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+    cache = VerificationKeyCache()
+
+    async def load():
+        return await asyncio.gather(*[cache.get_verification_key_xsuaa_async(XSUAA_JKU, "key-id-0")
+                                      for _ in range(0, 10)])
+
+    keys = asyncio.run(load())
+    assert all(key is keys[0] for key in keys)
+    assert 1 == token_keys_mock.call_count
+
+
+def test_sync_and_async_loads_of_a_key_set_share_one_download(respx_mock):
+    import asyncio
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    from tests.http_responses import HTTP_SUCCESS
+    started = threading.Event()
+    release = threading.Event()
+
+    def token_keys(_):
+        started.set()
+        release.wait(5)
+        return Response(200, json=HTTP_SUCCESS)
+    token_keys_mock = respx_mock.get(XSUAA_JKU).mock(side_effect=token_keys)
+    cache = VerificationKeyCache()
+    sync_load = threading.Thread(target=cache.get_verification_key_xsuaa, args=[XSUAA_JKU, "key-id-0"])
+    sync_load.start()
+    started.wait(5)
+
+    async def load():
+        task = asyncio.ensure_future(cache.get_verification_key_xsuaa_async(XSUAA_JKU, "key-id-0"))
+        await asyncio.sleep(0.1)
+        release.set()
+        return await task
+
+    try:
+        key = asyncio.run(load())
+    finally:
+        release.set()
+        sync_load.join()
+    assert key is cache.get_verification_key_xsuaa(XSUAA_JKU, "key-id-0")
+    assert 1 == token_keys_mock.call_count
+
+
+def test_get_verification_key_xsuaa_async_should_use_shared_key_store(respx_mock, tmp_path):
+    import asyncio
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    from tests.http_responses import HTTP_SUCCESS
+    token_keys_mock = respx_mock.get(XSUAA_JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+    # caches of different worker processes using the same directory
+    directory = str(tmp_path / "keys")
+    key = VerificationKeyCache(shared_key_store_directory=directory).get_verification_key_xsuaa(XSUAA_JKU, "key-id-0")
+
+    async_key = asyncio.run(VerificationKeyCache(shared_key_store_directory=directory)
+                            .get_verification_key_xsuaa_async(XSUAA_JKU, "key-id-0"))
+
+    assert key.public_numbers() == async_key.public_numbers()
+    assert 1 == token_keys_mock.call_count
+
+
+def test_get_verification_key_xsuaa_async_should_access_cache_file_outside_event_loop(respx_mock, tmp_path):
+    import asyncio
+    from unittest.mock import patch
+    from sap.xssec.key_cache_v2 import VerificationKeyCache
+    from tests.http_responses import HTTP_SUCCESS
+    respx_mock.get(XSUAA_JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+    cache = VerificationKeyCache(cache_file=str(tmp_path / "keys.json"))
+    threads = []
+
+    def record_thread(*_):
+        threads.append(threading.get_ident())
+        return []
+
+    with patch.object(cache.cache_file, "load", side_effect=record_thread), \
+            patch.object(cache.cache_file, "save", side_effect=record_thread):
+        asyncio.run(cache.get_verification_key_xsuaa_async(XSUAA_JKU, "key-id-0"))
+
+    assert 2 == len(threads)
+    assert threading.get_ident() not in threads
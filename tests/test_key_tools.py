@@ -1,4 +1,6 @@
-from sap.xssec.key_tools import jwk_to_pem
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+
+from sap.xssec.key_tools import jwk_to_pem, jwk_to_public_key, pem_to_public_key
 from tests.ias.ias_configs import JWKS
 
 
@@ -13,3 +15,25 @@ def test_jwk_to_pem():
                'ZwIDAQAB\n' \
                '-----END PUBLIC KEY-----\n'
     assert expected == jwk_to_pem(JWKS["keys"][0])
+
+
+def test_jwk_to_public_key():
+    key = jwk_to_public_key(JWKS["keys"][0])
+    assert jwk_to_pem(JWKS["keys"][0]) == key.public_bytes(Encoding.PEM, PublicFormat.SubjectPublicKeyInfo).decode()
+
+
+def test_pem_to_public_key_is_cached():
+    pem = jwk_to_pem(JWKS["keys"][0])
+    key = pem_to_public_key(pem)
+    assert jwk_to_public_key(JWKS["keys"][0]).public_numbers() == key.public_numbers()
+    assert key is pem_to_public_key(pem)
+
+
+def test_pem_to_public_key_without_line_breaks():
+    pem = jwk_to_pem(JWKS["keys"][0])
+    key = pem_to_public_key(pem.replace('\n', ''))
+    assert jwk_to_public_key(JWKS["keys"][0]).public_numbers() == key.public_numbers()
+
+
+def test_pem_to_public_key_returns_invalid_key_unchanged():
+    assert "not-a-key" == pem_to_public_key("not-a-key")
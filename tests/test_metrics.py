@@ -0,0 +1,81 @@
+# pylint: disable=missing-docstring,invalid-name,missing-docstring
+import unittest
+
+from httpx import TimeoutException
+
+from sap.xssec import constants, metrics
+from sap.xssec.key_cache import KeyCache
+from tests.http_responses import HTTP_SUCCESS
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+
+class InMemoryMetricsSinkTest(unittest.TestCase):
+
+    def test_snapshot(self):
+        sink = metrics.InMemoryMetricsSink()
+        sink.increment("counter")
+        sink.increment("counter", 2)
+        sink.observe("histogram", 1.0)
+        sink.observe("histogram", 3.0)
+        sink.update_gauge("gauge", 1)
+        sink.update_gauge("gauge", -1)
+
+        self.assertEqual({
+            "counters": {"counter": 3},
+            "histograms": {"histogram": {"count": 2, "sum": 4.0, "min": 1.0, "max": 3.0}},
+            "gauges": {"gauge": 0},
+        }, sink.snapshot())
+
+        sink.reset()
+        self.assertEqual({"counters": {}, "histograms": {}, "gauges": {}}, sink.snapshot())
+
+
+@patch('httpx.Client.get')
+class KeyCacheMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sink = metrics.InMemoryMetricsSink()
+        metrics.set_metrics_sink(self.sink)
+        self.addCleanup(metrics.set_metrics_sink, metrics.MetricsSink())
+        self.cache = KeyCache()
+
+    def test_hits_misses_and_fetches(self, mock_requests):
+        mock_requests.return_value.json.return_value = HTTP_SUCCESS
+        for _ in range(0, 3):
+            self.cache.load_key("jku1", "key-id-0")
+
+        snapshot = self.sink.snapshot()
+        self.assertEqual(2, snapshot["counters"]["key_cache.xsuaa.hits"])
+        self.assertEqual(1, snapshot["counters"]["key_cache.xsuaa.misses"])
+        self.assertEqual(1, snapshot["histograms"]["key_cache.xsuaa.fetch_seconds"]["count"])
+        self.assertEqual(0, snapshot["gauges"]["key_cache.xsuaa.fetches_in_flight"])
+        self.assertNotIn("key_cache.xsuaa.fetch_errors", snapshot["counters"])
+
+    @patch('time.time')
+    def test_expiration_is_counted_once_per_key_set(self, mock_time, mock_requests):
+        mock_requests.return_value.json.return_value = HTTP_SUCCESS
+        mock_time.return_value = 1000.0
+        self.cache.load_key("jku1", "key-id-0")
+
+        # read during the grace period while the key set is refreshed
+        mock_time.return_value += constants.KEYCACHE_DEFAULT_CACHE_ENTRY_EXPIRATION_TIME_IN_MINUTES * 60 + 1
+        with patch.object(self.cache, "_refresh_in_background"):
+            for _ in range(0, 3):
+                self.cache.load_key("jku1", "key-id-0")
+                self.cache.is_cached("jku1", "key-id-0")
+
+        self.assertEqual(1, self.sink.snapshot()["counters"]["key_cache.xsuaa.expirations"])
+
+    @patch('time.sleep')
+    def test_retries_and_fetch_errors(self, _, mock_requests):
+        mock_requests.side_effect = TimeoutException("timeout")
+        with self.assertRaises(TimeoutException):
+            self.cache.load_key("jku1", "key-id-0")
+
+        snapshot = self.sink.snapshot()
+        self.assertEqual(3, snapshot["counters"]["key_cache.xsuaa.retries"])
+        self.assertEqual(1, snapshot["counters"]["key_cache.xsuaa.fetch_errors"])
@@ -0,0 +1,44 @@
+# pylint: disable=missing-docstring,invalid-name,missing-docstring
+import unittest
+
+from sap.xssec.key_tools import pem_to_public_key
+from sap.xssec.parallel_verification import ParallelTokenVerifier
+from tests import jwt_payloads
+from tests.jwt_tools import sign, replace_header
+from tests.keys import JWT_SIGNING_PUBLIC_KEY
+
+TOKENS = [sign(jwt_payloads.USER_TOKEN), "invalid", sign(jwt_payloads.USER_TOKEN_EXPIRED),
+          sign(jwt_payloads.USER_TOKEN, headers={"kid": "unknown"}), sign(jwt_payloads.USER_TOKEN_NO_ATTR),
+          replace_header(sign(jwt_payloads.USER_TOKEN), {"alg": "RS256", "kid": ["key-id-0"]}), None]
+
+
+class ParallelTokenVerifierTest(unittest.TestCase):
+
+    def _check_results(self, results):
+        self.assertEqual(len(TOKENS), len(results))
+        self.assertEqual(jwt_payloads.USER_TOKEN["zid"], results[0].payload["zid"])
+        self.assertIsNone(results[0].error)
+        self.assertEqual("Not enough segments", results[1].error)
+        self.assertEqual("Signature has expired", results[2].error)
+        self.assertEqual("No verification key for kid unknown", results[3].error)
+        self.assertIsNone(results[4].error)
+        # malformed input does not abort the batch
+        self.assertIsNone(results[5].payload)
+        self.assertIsNotNone(results[5].error)
+        self.assertIsNone(results[6].payload)
+        self.assertIsNotNone(results[6].error)
+
+    def test_process_pool(self):
+        with ParallelTokenVerifier({"key-id-0": JWT_SIGNING_PUBLIC_KEY}, max_workers=2) as verifier:
+            self._check_results(verifier.verify(TOKENS, chunk_size=2))
+
+    def test_thread_pool(self):
+        with ParallelTokenVerifier({"key-id-0": pem_to_public_key(JWT_SIGNING_PUBLIC_KEY)}, max_workers=2,
+                                   use_processes=False) as verifier:
+            self._check_results(verifier.verify(TOKENS))
+
+    def test_without_time_claims(self):
+        with ParallelTokenVerifier({"key-id-0": JWT_SIGNING_PUBLIC_KEY}, use_processes=False,
+                                   verify_time_claims=False) as verifier:
+            result = verifier.verify([sign(jwt_payloads.USER_TOKEN_EXPIRED)])[0]
+        self.assertIsNone(result.error)
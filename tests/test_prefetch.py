@@ -0,0 +1,63 @@
+# pylint: disable=missing-docstring,invalid-name,missing-docstring
+import unittest
+
+import respx
+from httpx import HTTPStatusError, Response
+
+from sap import xssec
+from sap.xssec.key_cache import KeyCache
+from sap.xssec.key_cache_v2 import VerificationKeyCache, jwks_uri_cache
+from tests import uaa_configs
+from tests.http_responses import HTTP_SUCCESS
+from tests.ias.ias_configs import JWKS, WELL_KNOWN, SERVICE_CREDENTIALS
+from tests.ias.ias_tokens import PAYLOAD
+
+UAA_CONFIG = uaa_configs.VALID['uaa_no_verification_key']
+
+
+class PrefetchTest(unittest.TestCase):
+
+    def test_prefetch_does_not_shadow_its_module(self):
+        import importlib
+        self.assertIs(xssec.prefetch, importlib.import_module("sap.xssec.key_prefetch").prefetch)
+
+    @respx.mock
+    def test_prefetch_xsuaa(self):
+        respx.get("https://api.cf.test.com/token_keys?zid=zone-1").mock(return_value=Response(200, json=HTTP_SUCCESS))
+        respx.get("https://api.cf.test.com/token_keys?zid=zone-2").mock(return_value=Response(404))
+        key_cache = KeyCache()
+
+        results = xssec.prefetch(UAA_CONFIG, zone_ids=["zone-1", "zone-2"], key_cache=key_cache)
+
+        self.assertIsNone(results["zone-1"])
+        self.assertIsInstance(results["zone-2"], HTTPStatusError)
+        self.assertTrue(key_cache.is_cached("https://api.cf.test.com/token_keys?zid=zone-1", "key-id-0"))
+
+        # cached keys are not downloaded again
+        route = respx.get("https://api.cf.test.com/token_keys?zid=zone-1")
+        xssec.prefetch(UAA_CONFIG, zone_ids=["zone-1"], key_cache=key_cache)
+        self.assertEqual(1, route.call_count)
+
+    @respx.mock
+    def test_prefetch_ias(self):
+        jwks_uri_cache.clear()
+        well_known = respx.get(PAYLOAD["iss"] + '/.well-known/openid-configuration').mock(
+            return_value=Response(200, json=WELL_KNOWN))
+        jwks = respx.get(WELL_KNOWN["jwks_uri"]).mock(return_value=Response(200, json=JWKS))
+        key_cache = VerificationKeyCache()
+
+        results = xssec.prefetch(SERVICE_CREDENTIALS, issuers=[(PAYLOAD["iss"], PAYLOAD["app_tid"])],
+                                 key_cache=key_cache)
+
+        self.assertEqual({(PAYLOAD["iss"], PAYLOAD["app_tid"]): None}, results)
+        self.assertTrue(key_cache.is_verification_key_ias_cached(
+            PAYLOAD["iss"], PAYLOAD["app_tid"], SERVICE_CREDENTIALS["clientid"], SERVICE_CREDENTIALS["clientid"],
+            JWKS["keys"][0]["kid"]))
+        self.assertEqual(1, well_known.call_count)
+        self.assertEqual(1, jwks.call_count)
+
+    def test_prefetch_requires_either_zone_ids_or_issuers(self):
+        with self.assertRaises(ValueError):
+            xssec.prefetch(UAA_CONFIG)
+        with self.assertRaises(ValueError):
+            xssec.prefetch(UAA_CONFIG, zone_ids=["zone-1"], issuers=[PAYLOAD["iss"]])
@@ -102,7 +102,7 @@ class ReqTokenForClientTest(unittest.TestCase):
             sign(jwt_payloads.USER_TOKEN_JWT_BEARER_FOR_CLIENT), uaa_configs.VALID['uaa'])
         return sec_context
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
     def test_req_client_for_user_401_error(self, mock_get):
         self._setup_get_error(mock_get)
 
@@ -117,7 +117,7 @@ class ReqTokenForClientTest(unittest.TestCase):
         self._request_token_for_client_error(
             sec_context, flask_url + '/401', expected_message)
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
     def test_req_client_for_user_500_error(self, mock_get):
         self._setup_get_error(mock_get)
 
@@ -125,7 +125,7 @@ class ReqTokenForClientTest(unittest.TestCase):
         self._request_token_for_client_error(
             sec_context, flask_url + '/500', 'HTTP status code: 500')
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
     def test_req_client_for_user(self, mock_get):
         self._setup_get_error(mock_get)
 
@@ -134,7 +134,7 @@ class ReqTokenForClientTest(unittest.TestCase):
         token = sec_context.request_token_for_client(service_credentials, None)
         self.assertEqual(token, 'access_token')
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
     def test_req_client_for_user_with_mtls(self, mock_get):
         self._setup_get_error(mock_get)
 
@@ -148,7 +148,7 @@ class ReqTokenForClientTest(unittest.TestCase):
         }
         token = sec_context.request_token_for_client(service_credentials, None)
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
     def test_req_client_for_user_async(self, mock_get):
         self._setup_get_error(mock_get)
 
@@ -0,0 +1,86 @@
+# pylint: disable=missing-docstring,invalid-name,missing-docstring
+import asyncio
+import unittest
+
+import respx
+from httpx import HTTPStatusError, Response
+
+from sap import xssec
+from sap.xssec.key_cache import KeyCache
+from tests import uaa_configs
+from tests import jwt_payloads
+from tests.http_responses import HTTP_SUCCESS
+from tests.ias import ias_configs
+from tests.ias.ias_tokens import VALID_TOKEN, TOKEN_INVALID_ISSUER
+from tests.jwt_tools import sign
+from tests.keys import JWT_SIGNING_PUBLIC_KEY
+from tests.test_key_cache_v2 import VERIFICATION_KEY_PARAMS
+
+try:
+    from unittest.mock import AsyncMock, patch
+except ImportError:
+    from mock import AsyncMock, patch
+
+JKU = "https://api.cf.test.com/token_keys?zid=test-idz"
+
+
+class XSUAAAsyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key_cache = KeyCache()
+
+    @respx.mock
+    def test_create_security_context_xsuaa_async(self):
+        route = respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        sec_context = asyncio.run(xssec.create_security_context_xsuaa_async(
+            sign(jwt_payloads.USER_TOKEN), uaa_configs.VALID['uaa_no_verification_key'], key_cache=self.key_cache))
+
+        self.assertEqual('NODETESTUSER', sec_context.get_logon_name())
+        self.assertEqual(1, route.call_count)
+        self.assertTrue(self.key_cache.is_cached(JKU, "key-id-0"))
+
+    @respx.mock
+    def test_concurrent_contexts_request_keys_once(self):
+        route = respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+
+        async def create_contexts():
+            return await asyncio.gather(*[xssec.create_security_context_xsuaa_async(
+                sign(jwt_payloads.USER_TOKEN), uaa_configs.VALID['uaa_no_verification_key'],
+                key_cache=self.key_cache) for _ in range(10)])
+
+        sec_contexts = asyncio.run(create_contexts())
+        self.assertEqual(10, len(sec_contexts))
+        self.assertEqual(1, route.call_count)
+
+    @respx.mock
+    def test_failed_key_request_raises_error(self):
+        respx.get(JKU).mock(return_value=Response(404))
+        with self.assertRaises(HTTPStatusError):
+            asyncio.run(xssec.create_security_context_xsuaa_async(
+                sign(jwt_payloads.USER_TOKEN), uaa_configs.VALID['uaa_no_verification_key'], key_cache=self.key_cache))
+        # the missing key is remembered like with the synchronous factory
+        self.assertTrue(self.key_cache.is_cached(JKU, "key-id-0"))
+
+
+class IASAsyncTest(unittest.TestCase):
+
+    @patch('sap.xssec.key_cache_v2.is_verification_key_ias_cached', return_value=False)
+    @patch('sap.xssec.key_cache_v2.get_verification_key_ias_async', new_callable=AsyncMock,
+           return_value=JWT_SIGNING_PUBLIC_KEY)
+    def test_create_security_context_ias_async(self, get_verification_key_ias_async_mock, _):
+        asyncio.run(xssec.create_security_context_ias_async(VALID_TOKEN, ias_configs.SERVICE_CREDENTIALS))
+        get_verification_key_ias_async_mock.assert_awaited_once_with(**VERIFICATION_KEY_PARAMS)
+
+    @patch('sap.xssec.key_cache_v2.get_verification_key_ias_async', new_callable=AsyncMock)
+    def test_invalid_issuer_does_not_load_keys(self, get_verification_key_ias_async_mock):
+        with self.assertRaises(ValueError):
+            asyncio.run(xssec.create_security_context_ias_async(TOKEN_INVALID_ISSUER,
+                                                                ias_configs.SERVICE_CREDENTIALS))
+        get_verification_key_ias_async_mock.assert_not_awaited()
+
+    @patch('sap.xssec.key_cache_v2.is_verification_key_ias_cached', return_value=False)
+    @patch('sap.xssec.key_cache_v2.get_verification_key_ias_async', new_callable=AsyncMock,
+           side_effect=ValueError("Could not find key with kid kid-custom"))
+    def test_missing_key_raises_error(self, *_):
+        with self.assertRaises(ValueError):
+            asyncio.run(xssec.create_security_context_ias_async(VALID_TOKEN, ias_configs.SERVICE_CREDENTIALS))
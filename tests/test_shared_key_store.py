@@ -0,0 +1,125 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from sap.xssec.constants import KEYCACHE_SHARED_LOCK_COUNT
+from sap.xssec.shared_key_store import SharedKeyStore, create_shared_key_store
+
+
+class SharedKeyStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = os.path.join(directory.name, "keys")
+
+    def test_get_missing_key_set(self):
+        self.assertIsNone(SharedKeyStore(self.directory).get("xsuaa", "jku1"))
+
+    def test_load_downloads_and_stores_key_set(self):
+        store = SharedKeyStore(self.directory)
+        downloads = []
+
+        def download():
+            downloads.append(1)
+            return {"key-id-0": "key-0"}
+
+        fetch_timestamp, keys = store.load("xsuaa", "jku1", lambda *_: True, download)
+
+        self.assertEqual({"key-id-0": "key-0"}, keys)
+        self.assertEqual((fetch_timestamp, keys), store.get("xsuaa", "jku1"))
+        # another process using the same directory does not download the key set again
+        self.assertEqual((fetch_timestamp, keys),
+                         SharedKeyStore(self.directory).load("xsuaa", "jku1", lambda *_: True, download))
+        self.assertEqual(1, len(downloads))
+
+    def test_load_downloads_unusable_key_set_again(self):
+        store = SharedKeyStore(self.directory)
+        store.load("ias", ("issuer", None), lambda *_: True, lambda: {"kid": "old-key"})
+
+        _, keys = store.load("ias", ("issuer", None), lambda *_: False, lambda: {"kid": "new-key"})
+
+        self.assertEqual({"kid": "new-key"}, keys)
+        self.assertEqual({"kid": "new-key"}, store.get("ias", ("issuer", None))[1])
+
+    def test_concurrent_load_downloads_once(self):
+        downloads = []
+
+        def download():
+            downloads.append(1)
+            time.sleep(0.2)
+            return {"key-id-0": "key-0"}
+
+        def load():
+            # separate stores (and lock files) like in separate processes
+            SharedKeyStore(self.directory).load("xsuaa", "jku1", lambda *_: True, download)
+
+        threads = [threading.Thread(target=load) for _ in range(0, 5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len(downloads))
+
+    def test_load_async_waits_for_download_of_other_process(self):
+        started = threading.Event()
+        downloads = []
+
+        def download():
+            started.set()
+            time.sleep(0.2)
+            downloads.append(1)
+            return {"key-id-0": "key-0"}
+
+        async def download_async():
+            downloads.append(1)
+            return {"key-id-0": "other-key-0"}
+
+        other_process = threading.Thread(target=SharedKeyStore(self.directory).load,
+                                         args=("xsuaa", "jku1", lambda *_: True, download))
+        other_process.start()
+        started.wait(5)
+        _, keys = asyncio.run(SharedKeyStore(self.directory).load_async("xsuaa", "jku1", lambda *_: True,
+                                                                        download_async))
+        other_process.join()
+
+        self.assertEqual({"key-id-0": "key-0"}, keys)
+        self.assertEqual(1, len(downloads))
+
+    def test_key_sets_share_a_fixed_number_of_lock_files(self):
+        store = SharedKeyStore(self.directory)
+        for i in range(0, 200):
+            store.load("xsuaa", "jku{}".format(i), lambda *_: True, lambda: {"key-id-0": "key-0"})
+
+        lock_files = [name for name in os.listdir(self.directory) if name.startswith("lock-")]
+        self.assertLessEqual(len(lock_files), KEYCACHE_SHARED_LOCK_COUNT)
+        self.assertFalse([name for name in os.listdir(self.directory) if name.endswith(".lock")])
+
+    def test_expired_key_sets_are_removed(self):
+        store = SharedKeyStore(self.directory, max_age_in_seconds=60)
+        store.load("xsuaa", "jku1", lambda *_: True, lambda: {"key-id-0": "key-0"})
+        expired = time.time() - 120
+        os.utime(store._path("xsuaa", "jku1"), (expired, expired))
+        leftover = os.path.join(self.directory, "crashed.tmp")
+        open(leftover, "w").close()
+        os.utime(leftover, (expired, expired))
+
+        store.load("xsuaa", "jku2", lambda *_: True, lambda: {"key-id-1": "key-1"})
+
+        self.assertIsNone(store.get("xsuaa", "jku1"))
+        self.assertFalse(os.path.exists(leftover))
+        self.assertIsNotNone(store.get("xsuaa", "jku2"))
+
+    def test_directory_writable_by_others_is_not_used(self):
+        os.makedirs(self.directory)
+        os.chmod(self.directory, 0o777)
+        with self.assertRaises(ValueError):
+            SharedKeyStore(self.directory)
+        self.assertIsNone(create_shared_key_store(self.directory))
+
+    def test_no_directory(self):
+        self.assertIsNone(create_shared_key_store(None))
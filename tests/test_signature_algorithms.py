@@ -5,7 +5,7 @@ from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from jwt.algorithms import ECAlgorithm, RSAAlgorithm
 
 from sap.xssec.jwt_validation_facade import JwtValidationFacade
-from sap.xssec.key_tools import jwk_to_pem
+from sap.xssec.key_tools import jwk_to_pem, jwk_to_public_key
 
 RSA_ALGS = ["RS256", "RS384", "RS512", "PS256", "PS384", "PS512"]
 EC_ALGS = ["ES256", "ES384", "ES512"]
@@ -55,3 +55,32 @@ def test_detects_tampered_signature(alg):
     tampered = good.rsplit(".", 1)[0] + "." + other.rsplit(".", 1)[1]
     jwk = _public_jwk(alg, key)
     assert _validate(alg, tampered, jwk) == 1
+
+
+@pytest.mark.parametrize("alg", ALL_ALGS)
+def test_supports_public_key_object(alg):
+    import jwt
+    key = _keypair(alg)
+    token = jwt.encode({"foo": "bar"}, key, algorithm=alg)
+    facade = JwtValidationFacade()
+    facade.loadPEM(jwk_to_public_key(_public_jwk(alg, key)))
+    facade.checkToken(token)
+    assert facade.getErrorRC() == 0
+
+
+def test_rejects_unknown_critical_extension():
+    import jwt
+    key = _keypair("RS256")
+    token = jwt.encode({"foo": "bar"}, key, algorithm="RS256", headers={"crit": ["exp-unknown"], "exp-unknown": 1})
+    assert _validate("RS256", token, _public_jwk("RS256", key)) == 1
+
+
+def test_rejects_non_string_kid():
+    import jwt
+    from sap.xssec.jwt_validation_facade import DecodeError
+    from tests.jwt_tools import replace_header
+    key = _keypair("RS256")
+    token = replace_header(jwt.encode({"foo": "bar"}, key, algorithm="RS256"), {"alg": "RS256", "kid": ["x"]})
+    with pytest.raises(DecodeError):
+        JwtValidationFacade().get_unverified_header(token)
+    assert _validate("RS256", token, _public_jwk("RS256", key)) == 1
@@ -0,0 +1,84 @@
+# pylint: disable=missing-docstring,invalid-name,missing-docstring
+import asyncio
+import unittest
+
+import respx
+from httpx import Response
+
+from sap import xssec
+from sap.xssec.key_cache_v2 import VerificationKeyCache
+from sap.xssec.security_context_xsuaa import SecurityContextXSUAA
+from tests import uaa_configs
+from tests import jwt_payloads
+from tests.http_responses import HTTP_SUCCESS
+from tests.jwt_tools import sign
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+JKU = "https://api.cf.test.com/token_keys?zid=test-idz"
+UAA_CONFIG = uaa_configs.VALID['uaa_no_verification_key']
+
+
+class ValidatedTokenCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key_cache = VerificationKeyCache()
+        self.token_cache = xssec.ValidatedTokenCache(max_size=2)
+        self.token = sign(jwt_payloads.USER_TOKEN)
+
+    @respx.mock
+    def test_validated_token_is_cached(self):
+        respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        sec_context = xssec.create_security_context_xsuaa(self.token, UAA_CONFIG, key_cache=self.key_cache,
+                                                          token_cache=self.token_cache)
+
+        with patch('sap.xssec.SecurityContextXSUAA', side_effect=SecurityContextXSUAA) as mock_context:
+            self.assertIs(sec_context, xssec.create_security_context_xsuaa(
+                self.token, UAA_CONFIG, key_cache=self.key_cache, token_cache=self.token_cache))
+            mock_context.assert_not_called()
+
+            # the same token is validated again for other credentials
+            xssec.create_security_context_xsuaa(self.token, dict(UAA_CONFIG, clientsecret="other"),
+                                                key_cache=self.key_cache, token_cache=self.token_cache)
+            mock_context.assert_called_once()
+
+    @respx.mock
+    def test_entry_expires_with_token(self):
+        respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        xssec.create_security_context_xsuaa(self.token, UAA_CONFIG, key_cache=self.key_cache,
+                                            token_cache=self.token_cache)
+        self.assertEqual(1, len(self.token_cache))
+
+        with patch('time.time', return_value=jwt_payloads.USER_TOKEN["exp"]):
+            self.assertIsNone(self.token_cache.get("xsuaa", self.token, UAA_CONFIG))
+
+    @respx.mock
+    def test_entry_expires_after_max_ttl(self):
+        respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        token_cache = xssec.ValidatedTokenCache(max_ttl_in_seconds=0)
+        xssec.create_security_context_xsuaa(self.token, UAA_CONFIG, key_cache=self.key_cache,
+                                            token_cache=token_cache)
+        self.assertEqual(0, len(token_cache))
+
+    @respx.mock
+    def test_invalid_token_is_not_cached(self):
+        respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        with self.assertRaises(RuntimeError):
+            xssec.create_security_context_xsuaa(sign(jwt_payloads.USER_TOKEN_EXPIRED), UAA_CONFIG,
+                                                key_cache=self.key_cache, token_cache=self.token_cache)
+        self.assertEqual(0, len(self.token_cache))
+
+    @respx.mock
+    def test_async_validated_token_is_cached(self):
+        route = respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+
+        async def create_contexts():
+            return [await xssec.create_security_context_xsuaa_async(
+                self.token, UAA_CONFIG, key_cache=self.key_cache, token_cache=self.token_cache) for _ in range(3)]
+
+        sec_contexts = asyncio.run(create_contexts())
+        self.assertTrue(all(sec_context is sec_contexts[0] for sec_context in sec_contexts))
+        self.assertEqual(1, route.call_count)
@@ -0,0 +1,93 @@
+# pylint: disable=missing-docstring,invalid-name,missing-docstring
+import asyncio
+import unittest
+
+import respx
+from httpx import Response
+
+from sap import xssec
+from sap.xssec.key_cache_v2 import VerificationKeyCache
+from tests import uaa_configs
+from tests import jwt_payloads
+from tests.http_responses import HTTP_SUCCESS
+from tests.ias import ias_configs
+from tests.ias.ias_tokens import VALID_TOKEN, TOKEN_INVALID_AUDIENCE
+from tests.jwt_tools import sign
+from tests.keys import JWT_SIGNING_PUBLIC_KEY
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+JKU = "https://api.cf.test.com/token_keys?zid=test-idz"
+UAA_CONFIG = uaa_configs.VALID['uaa_no_verification_key']
+
+
+class TokenValidatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.key_cache = VerificationKeyCache()
+
+    @respx.mock
+    def test_xsuaa_binding_is_derived_once(self):
+        respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        with patch('sap.xssec.security_context_xsuaa._check_config') as mock_check_config, \
+                patch('sap.xssec.security_context_xsuaa.JwtAudienceValidator',
+                      wraps=xssec.security_context_xsuaa.JwtAudienceValidator) as mock_audience_validator:
+            validator = xssec.TokenValidator(UAA_CONFIG, key_cache=self.key_cache)
+            for _ in range(3):
+                sec_context = validator.validate(sign(jwt_payloads.USER_TOKEN))
+                self.assertEqual('test-idz', sec_context.get_zone_id())
+        mock_check_config.assert_called_once_with(UAA_CONFIG)
+        mock_audience_validator.assert_called_once()
+
+    def test_invalid_config_is_rejected_on_creation(self):
+        with self.assertRaises(ValueError):
+            xssec.TokenValidator(uaa_configs.INVALID['uaa_xsappname_undefined'])
+        with self.assertRaises(ValueError):
+            xssec.TokenValidator(UAA_CONFIG, token_type="saml")
+
+    def test_ias_tokens(self):
+        key_cache = MagicMock()
+        key_cache.get_verification_key_ias.return_value = JWT_SIGNING_PUBLIC_KEY
+        validator = xssec.TokenValidator(ias_configs.SERVICE_CREDENTIALS, token_type="ias", key_cache=key_cache)
+
+        self.assertIsInstance(validator.validate(VALID_TOKEN), xssec.SecurityContextIAS)
+        with self.assertRaises(RuntimeError):
+            validator.validate(TOKEN_INVALID_AUDIENCE)
+
+    @respx.mock
+    def test_validate_async_with_token_cache(self):
+        route = respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        validator = xssec.TokenValidator(UAA_CONFIG, key_cache=self.key_cache,
+                                         token_cache=xssec.ValidatedTokenCache())
+        token = sign(jwt_payloads.USER_TOKEN)
+
+        async def validate():
+            return [await validator.validate_async(token) for _ in range(2)]
+
+        sec_contexts = asyncio.run(validate())
+        self.assertIs(sec_contexts[0], sec_contexts[1])
+        self.assertIs(sec_contexts[0], validator.validate(token))
+        self.assertEqual(1, route.call_count)
+
+    @respx.mock
+    def test_validate_many(self):
+        route = respx.get(JKU).mock(return_value=Response(200, json=HTTP_SUCCESS))
+        key_cache = MagicMock(wraps=self.key_cache)
+        validator = xssec.TokenValidator(UAA_CONFIG, key_cache=key_cache)
+        tokens = [sign(jwt_payloads.USER_TOKEN), sign(jwt_payloads.USER_TOKEN_NO_ATTR),
+                  sign(jwt_payloads.USER_TOKEN_EXPIRED), "invalid", sign(jwt_payloads.USER_TOKEN)]
+
+        results = validator.validate_many(tokens)
+
+        self.assertEqual(len(tokens), len(results))
+        self.assertIsInstance(results[0], xssec.SecurityContextXSUAA)
+        self.assertIsInstance(results[1], xssec.SecurityContextXSUAA)
+        self.assertIsInstance(results[2], RuntimeError)
+        self.assertIsInstance(results[3], Exception)
+        self.assertIs(results[0], results[4])
+        # all tokens are signed with the same key
+        key_cache.load_key.assert_called_once_with(jku=JKU, kid="key-id-0")
+        self.assertEqual(1, route.call_count)
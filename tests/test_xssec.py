@@ -6,10 +6,11 @@ from os import environ
 from datetime import datetime
 from sap import xssec
 from sap.xssec import constants, jwt_validation_facade, security_context_xsuaa
+from sap.xssec.key_cache_v2 import VerificationKeyCache
 from tests import uaa_configs
 from tests import jwt_payloads
 from tests.http_responses import HTTP_SUCCESS
-from tests.jwt_tools import sign
+from tests.jwt_tools import sign, replace_header
 
 
 try:
@@ -27,10 +28,12 @@ class XSSECTest(unittest.TestCase):
     def setUp(self):
         reload(jwt_validation_facade)
         reload(security_context_xsuaa)
+        # the default key cache is not recreated by reloading the module
+        security_context_xsuaa.SecurityContextXSUAA.verificationKeyCache = VerificationKeyCache()
         jwt_validation_facade.ALGORITHMS = ['RS256', 'HS256']
         self.addCleanup(reload, jwt_validation_facade)
 
-        patcher = patch('httpx.get')
+        patcher = patch('httpx.Client.get')
         self.mock_httpx_get = patcher.start()
         self.addCleanup(patcher.stop)
         self.mock_httpx_get.side_effect = SSLError
@@ -58,6 +61,12 @@ class XSSECTest(unittest.TestCase):
             'Failed to decode provided token',
             str(ctx.exception))
 
+    def test_input_validation_non_string_kid(self):
+        with self.assertRaises(ValueError) as ctx:
+            xssec.create_security_context(replace_header(sign(jwt_payloads.USER_TOKEN), {
+                "alg": "RS256", "jku": "https://api.cf.test.com", "kid": ["key-id-0"]}), uaa_configs.VALID['uaa'])
+        self.assertEqual('Failed to decode provided token', str(ctx.exception))
+
     def test_input_validation_none_config(self):
         ''' input validation: None config '''
         self._check_invalid_params(
@@ -440,7 +449,7 @@ class XSSECTest(unittest.TestCase):
         self.assertTrue(
             'Error in offline validation of access token:' in str(ctx.exception))
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
     def test_get_verification_key_from_uaa(self, mock_requests):
         from sap.xssec.key_cache import KeyCache
         xssec.SecurityContextXSUAA.verificationKeyCache = KeyCache()
@@ -461,7 +470,19 @@ class XSSECTest(unittest.TestCase):
         mock_requests.assert_called_once_with("https://api.cf.test.com/token_keys?zid=test-idz",
                                               timeout=constants.HTTP_TIMEOUT_IN_SECONDS)
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
+    def test_token_is_parsed_once(self, mock_requests):
+        mock = MagicMock()
+        mock_requests.return_value = mock
+        mock.json.return_value = HTTP_SUCCESS
+
+        with patch('sap.xssec.jwt_validation_facade._parse', wraps=jwt_validation_facade._parse) as mock_parse:
+            sec_context = xssec.create_security_context(
+                sign(jwt_payloads.USER_TOKEN), uaa_configs.VALID['uaa_no_verification_key'])
+        self._check_user_token(sec_context)
+        mock_parse.assert_called_once()
+
+    @patch('httpx.Client.get')
     def test_composed_jku_with_uaadomain(self, mock_requests):
         from sap.xssec.key_cache import KeyCache
         xssec.SecurityContextXSUAA.verificationKeyCache = KeyCache()
@@ -491,7 +512,7 @@ class XSSECTest(unittest.TestCase):
         self.assertEqual(
             sec_context.get_logon_name(), 'ADMIN')
 
-    @patch('httpx.get')
+    @patch('httpx.Client.get')
     def test_ignored_invalid_jku_in_token_header(self, mock_requests):
         from sap.xssec.key_cache import KeyCache
         xssec.SecurityContextXSUAA.verificationKeyCache = KeyCache()